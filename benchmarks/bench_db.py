@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк вставки постов в SQLite: старая схема (соединение и коммит
+на каждый пост, журнал по умолчанию) против общего соединения с WAL.
+Использование: python -m benchmarks.bench_db --posts 20000
+"""
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+from src import config, database
+
+
+def _rows(count: int, channel: str = "bench"):
+    return [
+        (channel, i, f"Пост номер {i}: " + "текст новости " * 20, 1_700_000_000 + i, f"https://t.me/{channel}/{i}", i % 3 == 0)
+        for i in range(count)
+    ]
+
+
+def bench_legacy(path: str, rows: list) -> float:
+    """Так работал add_post до общего соединения: connect → INSERT → commit → close на каждый пост."""
+    for row in rows:
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute(
+                "INSERT INTO posts (channel, message_id, text, date, source_link, has_media) VALUES (?, ?, ?, ?, ?, ?)",
+                row
+            )
+            conn.commit()
+        except sqlite3.IntegrityError:
+            pass
+        finally:
+            conn.close()
+    return len(rows)
+
+
+def bench_shared_single(rows: list) -> float:
+    """Общее соединение с WAL, но по одному посту на транзакцию (add_post)."""
+    for row in rows:
+        database.add_post(*row)
+    return len(rows)
+
+
+def bench_shared_batched(rows: list, batch: int) -> float:
+    """Общее соединение с WAL и пачечная вставка (add_posts)."""
+    for i in range(0, len(rows), batch):
+        database.add_posts(rows[i:i + batch])
+    return len(rows)
+
+
+def _fresh_db(directory: str, name: str, wal: bool) -> str:
+    path = os.path.join(directory, name)
+    database.close_db()
+    config.DB_NAME = path
+    database.init_db()
+    if not wal:
+        # Старая схема: журнал отката вместо WAL
+        database.close_db()
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+    return path
+
+
+def _report(label: str, count: int, seconds: float):
+    print(f"{label:<42} {count:>8} постов  {seconds:8.3f} с  {count / seconds:10.0f} вставок/с")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк вставки постов в SQLite.")
+    parser.add_argument("--posts", type=int, default=20000, help="Количество постов для вставки")
+    parser.add_argument("--legacy-posts", type=int, default=2000, help="Постов для медленной старой схемы")
+    parser.add_argument("--batch", type=int, default=200, help="Размер пачки для add_posts")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = _fresh_db(directory, "legacy.db", wal=False)
+        rows = _rows(args.legacy_posts)
+        start = time.perf_counter()
+        count = bench_legacy(path, rows)
+        _report("До: соединение на пост, journal=DELETE", count, time.perf_counter() - start)
+
+        _fresh_db(directory, "single.db", wal=True)
+        rows = _rows(args.posts)
+        start = time.perf_counter()
+        count = bench_shared_single(rows)
+        _report("После: общее соединение, WAL, add_post", count, time.perf_counter() - start)
+
+        _fresh_db(directory, "batched.db", wal=True)
+        start = time.perf_counter()
+        count = bench_shared_batched(rows, args.batch)
+        _report(f"После: общее соединение, WAL, add_posts({args.batch})", count, time.perf_counter() - start)
+        database.close_db()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк полнотекстового поиска (FTS5) на синтетической базе постов.
+Сравнивает database.search_posts с полным сканированием через LIKE.
+Использование: python -m benchmarks.bench_fts --posts 1000000
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from src import config, database
+from benchmarks.synthetic import fill_database
+
+# Частые слова, сочетания и редкие термины из длинного хвоста словаря
+QUERIES = ["модель", "OpenAI релиз", "чип дата-центр", "проект42", "проект777 Qwen", "проект31337"]
+
+
+def _percentiles(samples: list) -> str:
+    samples = sorted(samples)
+    p50 = statistics.median(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    return f"p50 {p50 * 1000:8.2f} мс  p95 {p95 * 1000:8.2f} мс"
+
+
+def _like_search(query: str, limit: int):
+    """Поиск без индекса (новые посты первыми): так пришлось бы искать до появления FTS5."""
+    conn = database._get_connection()
+    # Пробел в конце шаблона, чтобы "проект42" не совпадал с "проект421"
+    clauses = " AND ".join("text || ' ' LIKE ?" for _ in query.split())
+    params = [f"%{w} %" for w in query.split()]
+    return conn.execute(f"SELECT id FROM posts WHERE {clauses} ORDER BY id DESC LIMIT ?", (*params, limit)).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк FTS5-поиска по постам.")
+    parser.add_argument("--posts", type=int, default=1_000_000, help="Сколько синтетических постов создать")
+    parser.add_argument("--repeat", type=int, default=20, help="Повторов каждого запроса")
+    parser.add_argument("--limit", type=int, default=20, help="LIMIT для поиска")
+    parser.add_argument("--slow-repeat", type=int, default=3, help="Повторов для медленных вариантов (bm25, LIKE)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        config.DB_NAME = os.path.join(directory, "fts.db")
+        database.init_db()
+
+        start = time.perf_counter()
+        inserted = fill_database(args.posts)
+        print(f"Создано {inserted} постов за {time.perf_counter() - start:.1f} с (вместе с индексом FTS5)")
+        size_mb = os.path.getsize(config.DB_NAME) / 1024 / 1024
+        print(f"Размер базы: {size_mb:.1f} МБ\n")
+
+        for query in QUERIES:
+            fts, ranked, like = [], [], []
+            hits = 0
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                hits = len(database.search_posts(query, limit=args.limit))
+                fts.append(time.perf_counter() - t0)
+            for _ in range(args.slow_repeat):
+                t0 = time.perf_counter()
+                database.search_posts(query, limit=args.limit, by_rank=True)
+                ranked.append(time.perf_counter() - t0)
+            for _ in range(args.slow_repeat):
+                t0 = time.perf_counter()
+                _like_search(query, args.limit)
+                like.append(time.perf_counter() - t0)
+            print(f"{query!r:<20} найдено {hits:>3}")
+            print(f"    FTS5, новые первыми: {_percentiles(fts)}")
+            print(f"    FTS5, по bm25:       {_percentiles(ranked)}")
+            print(f"    LIKE, полный скан:   {_percentiles(like)}")
+
+        database.close_db()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк задержки запросов к OpenAI: новый AsyncOpenAI на каждый вызов (как было)
+против общего клиента с пулом соединений (article_generator.get_client).
+Запросы идут на локальный сервер, имитирующий Responses API; --handshake-ms задаёт
+задержку установки нового соединения (TCP + TLS до api.openai.com), --server-ms — время ответа.
+Использование: python -m benchmarks.bench_openai_client --requests 50 --handshake-ms 120
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from openai import AsyncOpenAI
+from src import article_generator, config
+
+_RESPONSE = {
+    "id": "resp_bench",
+    "object": "response",
+    "created_at": 0,
+    "model": "gpt-5",
+    "status": "completed",
+    "output": [{
+        "type": "message",
+        "id": "msg_bench",
+        "role": "assistant",
+        "status": "completed",
+        "content": [{"type": "output_text", "text": "ok", "annotations": []}],
+    }],
+    "parallel_tool_calls": False,
+    "tool_choice": "auto",
+    "tools": [],
+}
+
+
+def _start_server(handshake_ms: float, server_ms: float):
+    body = json.dumps(_RESPONSE).encode("utf-8")
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, как у настоящего API
+        # Заголовки и тело уходят одним пакетом, иначе Nagle и отложенный ACK добавляют ~40 мс
+        disable_nagle_algorithm = True
+        wbufsize = 64 * 1024
+
+        def setup(self):
+            # Новое соединение: имитируем рукопожатие
+            time.sleep(handshake_ms / 1000)
+            super().setup()
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(server_ms / 1000)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def _measure(get_client, count: int) -> list:
+    samples = []
+    for _ in range(count):
+        t0 = time.perf_counter()
+        client = get_client()
+        await client.responses.create(model="gpt-5", input="Вот подборка новостей за неделю: ...")
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+def _report(name: str, samples: list):
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"{name:<28} среднее {statistics.mean(samples) * 1000:7.1f} мс  p50 {statistics.median(samples) * 1000:7.1f} мс  p95 {p95 * 1000:7.1f} мс")
+
+
+async def _run(args):
+    legacy = await _measure(lambda: AsyncOpenAI(api_key=config.OPENAI_API_KEY), args.requests)
+    pooled = await _measure(article_generator.get_client, args.requests)
+    await article_generator.close_client()
+    _report("Новый клиент на запрос:", legacy)
+    _report("Общий клиент с пулом:", pooled)
+    print(f"Экономия на запрос: {(statistics.mean(legacy) - statistics.mean(pooled)) * 1000:.1f} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк общего клиента OpenAI.")
+    parser.add_argument("--requests", type=int, default=50, help="Сколько последовательных запросов в каждом режиме")
+    parser.add_argument("--handshake-ms", type=float, default=120, help="Задержка установки нового соединения")
+    parser.add_argument("--server-ms", type=float, default=20, help="Время обработки запроса сервером")
+    args = parser.parse_args()
+
+    server = _start_server(args.handshake_ms, args.server_ms)
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    config.OPENAI_API_KEY = "bench"
+    try:
+        asyncio.run(_run(args))
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Сквозной офлайн-бенчмарк weekly_digest_job: парсинг, пакетная обработка, свёртка,
+статья, публикация и уведомление на локальных заменителях Telegram, OpenAI, Telegraph
+и Bot API (benchmarks/fakes.py). Отчёт: время по этапам, время в SQLite, пиковая память.
+Использование:
+    python -m benchmarks.bench_pipeline --posts 10000
+    python -m benchmarks.bench_pipeline --posts 20000 --backlog 1000000 --openai-ms 3000 --openai-429 0.05
+    python -m benchmarks.bench_pipeline --posts 20000 --openai-batch --batch-seconds 5
+"""
+
+import argparse
+import asyncio
+import contextlib
+import functools
+import inspect
+import io
+import json
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+from benchmarks import fakes
+from benchmarks.synthetic import fill_database, generate_posts
+from src import (
+    article_generator,
+    config,
+    database,
+    metrics,
+    postprocess,
+    telegram_notifier,
+    openai_batch,
+    telegram_parser,
+    telegraph_publisher,
+)
+
+
+class _Stage:
+    """Время, когда этап был активен хотя бы в одном вызове: параллельные и вложенные
+    вызовы не суммируются, поэтому доля этапа не превышает 100% общего времени.
+    calls считает все вызовы, включая вложенные (add_post → add_posts).
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.busy = 0.0
+        self._active = 0
+        self._since = 0.0
+
+    def enter(self):
+        if not self._active:
+            self._since = time.perf_counter()
+        self._active += 1
+
+    def exit(self):
+        self._active -= 1
+        if not self._active:
+            self.busy += time.perf_counter() - self._since
+
+
+_stages = {}
+
+# Сдвиг message_id новых постов, чтобы они не совпадали с постами из --backlog
+_NEW_ID_OFFSET = 10_000_000
+
+
+def _stage(name: str) -> _Stage:
+    return _stages.setdefault(name, _Stage())
+
+
+def _instrument(module, attr: str, stage_of):
+    """Оборачивает module.attr так, чтобы время вызовов шло в этап stage_of(*args, **kwargs)."""
+    fn = getattr(module, attr)
+
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            stage = _stage(stage_of(*args, **kwargs))
+            stage.calls += 1
+            stage.enter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                stage.exit()
+    elif inspect.isgeneratorfunction(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            stage = _stage(stage_of(*args, **kwargs))
+            stage.calls += 1
+            generator = fn(*args, **kwargs)
+            while True:
+                stage.enter()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    stage.exit()
+                yield item
+    else:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            stage = _stage(stage_of(*args, **kwargs))
+            stage.calls += 1
+            stage.enter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                stage.exit()
+
+    setattr(module, attr, wrapper)
+
+
+def _openai_stage(posts, prompt_template=None, **kwargs) -> str:
+    if prompt_template == config.SUMMARY_PROMPT:
+        return "openai: саммари пачек"
+    if prompt_template == config.REDUCE_PROMPT:
+        return "openai: свёртка"
+    return "openai: статья"
+
+
+def _instrument_all():
+    _instrument(telegram_parser, "parse_channels", lambda *a, **k: "telegram: парсинг")
+    _instrument(article_generator, "generate_article_and_summary", _openai_stage)
+    _instrument(openai_batch, "submit", lambda *a, **k: "openai: batch api")
+    _instrument(openai_batch, "poll", lambda *a, **k: "openai: batch api")
+    _instrument(postprocess, "add_navigation_and_split", lambda *a, **k: "постобработка")
+    _instrument(telegraph_publisher, "publish_to_telegraph", lambda *a, **k: "telegraph")
+    _instrument(telegram_notifier, "send_notification", lambda *a, **k: "bot api")
+    # Все публичные функции базы: другие модули вызывают их через атрибуты модуля
+    for name, fn in list(vars(database).items()):
+        if inspect.isfunction(fn) and fn.__module__ == database.__name__ and not name.startswith("_"):
+            _instrument(database, name, lambda *a, **k: "sqlite")
+
+
+def _configure(directory: str, channels: list, per_channel: int, args):
+    values = {
+        "API_ID": "1",
+        "API_HASH": "bench",
+        "BOT_TOKEN": "bench",
+        "TELEGRAM_RECIPIENTS": json.dumps([{"chat_id": 1}]),
+        "OPENAI_API_KEY": "bench",
+        "TELEGRAM_CHANNELS": ",".join(channels),
+        "SUMMARY_PROMPT": "Отбери самые важные посты и верни их без изменений.",
+        "REDUCE_PROMPT": "Сверни подборку постов, оставив самое важное.",
+        "ARTICLE_PROMPT": "Напиши лонгрид в HTML, затем строку ---SUMMARY--- и короткий анонс.",
+        "DB_NAME": os.path.join(directory, "bench.db"),
+        "TELEGRAM_PARSE_LIMIT": str(per_channel),
+        "TELEGRAM_INCREMENTAL_MAX": "0",
+        "TELEGRAPH_ACCESS_TOKEN": "bench",
+        "LLM_CACHE_PATH": os.path.join(directory, "llm_cache.db"),
+        "LLM_CACHE_ENABLED": "false",
+        "DIGEST_STREAMING": "false" if args.sequential else "true",
+        "SUMMARY_CONCURRENCY": str(args.concurrency),
+        "RATE_LIMIT_TELEGRAM_RPM": str(args.telegram_rpm),
+        "RATE_LIMIT_OPENAI_RPM": str(args.openai_rpm),
+        "RATE_LIMIT_TELEGRAPH_RPM": "600",
+        "RATE_LIMIT_BOT_API_RPM": "600",
+        "PREFILTER_ENABLED": "true",
+        "RANKING_ENABLED": "true" if args.top_percent else "false",
+        "RANKING_TOP_PERCENT": str(args.top_percent),
+        "OPENAI_BATCH_MODE": "true" if args.openai_batch else "false",
+        "OPENAI_BATCH_DIR": os.path.join(directory, "openai_batches"),
+    }
+    path = os.path.join(directory, ".env.bench")
+    with open(path, "w", encoding="utf-8") as env_file:
+        env_file.writelines(f"{key}={json.dumps(value, ensure_ascii=False)}\n" for key, value in values.items())
+    # Значения из окружения оболочки не должны перебивать параметры бенчмарка
+    os.environ.update(values)
+    config.load_config(path)
+    config.SESSION_NAME = "bench"
+
+
+async def _run_batch_mode(bot):
+    """Как по расписанию: отправка пачек в Batch API, опрос до готовности, затем цикл дайджеста."""
+    await bot.batch_submit_job()
+    while database.get_open_openai_batches():
+        await asyncio.sleep(0.2)
+        await bot.batch_poll_job()
+    await bot.weekly_digest_job()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сквозной офлайн-бенчмарк цикла дайджеста.")
+    parser.add_argument("--posts", type=int, default=10_000, help="Сколько новых постов отдаёт фейковый Telegram")
+    parser.add_argument("--backlog", type=int, default=0, help="Сколько необработанных постов уже лежит в базе")
+    parser.add_argument("--channels", type=int, default=80, help="Число каналов")
+    parser.add_argument("--noise", type=float, default=0.1, help="Доля рекламы, розыгрышей и пустых постов")
+    parser.add_argument("--top-percent", type=float, default=0, help="Ранжирование: отправлять в OpenAI только топ N%% постов")
+    parser.add_argument("--concurrency", type=int, default=4, help="SUMMARY_CONCURRENCY")
+    parser.add_argument("--sequential", action="store_true", help="Без потокового режима (DIGEST_STREAMING=false)")
+    parser.add_argument("--telegram-ms", type=float, default=50, help="Задержка одного запроса к Telegram")
+    parser.add_argument("--telegram-flood", type=float, default=0.0, help="Доля запросов к Telegram с FloodWait")
+    parser.add_argument("--telegram-rpm", type=int, default=6000, help="RATE_LIMIT_TELEGRAM_RPM")
+    parser.add_argument("--openai-ms", type=float, default=500, help="Задержка ответа OpenAI")
+    parser.add_argument("--openai-429", type=float, default=0.0, help="Доля запросов к OpenAI с ответом 429")
+    parser.add_argument("--openai-rpm", type=int, default=6000, help="RATE_LIMIT_OPENAI_RPM")
+    parser.add_argument("--openai-batch", action="store_true", help="Суммаризация пачек через Batch API (OPENAI_BATCH_MODE)")
+    parser.add_argument("--batch-seconds", type=float, default=5, help="Через сколько секунд готово задание Batch API")
+    parser.add_argument("--telegraph-ms", type=float, default=300, help="Задержка публикации в Telegraph")
+    parser.add_argument("--bot-ms", type=float, default=100, help="Задержка Bot API")
+    parser.add_argument("--tracemalloc", action="store_true", help="Считать пик памяти Python (замедляет прогон)")
+    parser.add_argument("--metrics", action="store_true", help="Вывести метрики бота в формате Prometheus (как на /metrics)")
+    parser.add_argument("--verbose", action="store_true", help="Показывать вывод бота")
+    args = parser.parse_args()
+
+    # Новые посты идут после постов из --backlog в тех же каналах: сдвигаем их message_id
+    posts = [
+        (channel, message_id + _NEW_ID_OFFSET, text, date, link, has_media)
+        for channel, message_id, text, date, link, has_media in generate_posts(
+            args.posts, channels=args.channels, seed=1, start_date=int(time.time()) - 7 * 86400, decorated=True,
+            noise_rate=args.noise)
+    ]
+    services = fakes.FakeServices(
+        telegram=fakes.FakeTelegram(posts, fakes.ServiceProfile(args.telegram_ms / 1000, limit_rate=args.telegram_flood)),
+        openai=fakes.FakeOpenAI(fakes.ServiceProfile(args.openai_ms / 1000, limit_rate=args.openai_429),
+                                batch_seconds=args.batch_seconds),
+        telegraph=fakes.FakeTelegraphService(fakes.ServiceProfile(args.telegraph_ms / 1000)),
+        bot=fakes.FakeBotService(fakes.ServiceProfile(args.bot_ms / 1000)),
+    )
+    channels = sorted(services.telegram.messages)
+    per_channel = max(len(messages) for messages in services.telegram.messages.values())
+
+    with tempfile.TemporaryDirectory() as directory:
+        _configure(directory, channels, per_channel, args)
+        database.init_db()
+        if args.backlog:
+            start = time.perf_counter()
+            fill_database(args.backlog, channels=args.channels, seed=2, start_date=int(time.time()) - 30 * 86400,
+                          decorated=True, noise_rate=args.noise)
+            database.close_db()
+            print(f"База заполнена {args.backlog} постами за {time.perf_counter() - start:.1f} с")
+
+        import main as bot  # после настройки config: main читает его при импорте модулей src
+        fakes.install(services)
+        _instrument_all()
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        output = None if args.verbose else io.StringIO()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(output) if output else contextlib.nullcontext():
+            asyncio.run(_run_batch_mode(bot) if args.openai_batch else bot.weekly_digest_job())
+        wall = time.perf_counter() - start
+        traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+
+        conn = database._get_connection()
+        processed = conn.execute("SELECT COUNT(*) FROM posts WHERE is_processed = 1").fetchone()[0]
+        batches = conn.execute("SELECT COUNT(*) FROM batch_summaries").fetchone()[0]
+        skipped = conn.execute("SELECT COUNT(*) FROM posts WHERE skip_reason IS NOT NULL AND skip_reason != 'low_rank'").fetchone()[0]
+        low_rank = conn.execute("SELECT COUNT(*) FROM posts WHERE skip_reason = 'low_rank'").fetchone()[0]
+        metric_rows = conn.execute("SELECT COUNT(*) FROM metrics").fetchone()[0]
+        database.close_db()
+
+    print(f"\nПостов от Telegram: {args.posts}, в базе до запуска: {args.backlog}, обработано: {processed}, "
+          f"отсеяно предфильтром: {skipped}, ранжированием: {low_rank}")
+    print(f"Пачек: {batches}, запросов к OpenAI: {services.openai.profile.calls} "
+          f"(429: {services.openai.profile.limited}), запросов к Telegram: {services.telegram.profile.calls} "
+          f"(FloodWait: {services.telegram.profile.limited})")
+    print(f"Общее время: {wall:.2f} с, {processed / wall:.0f} постов/с\n")
+    print(f"{'Этап':<24}{'вызовов':>9}{'время, с':>11}{'доля':>8}")
+    for name, stage in sorted(_stages.items(), key=lambda item: -item[1].busy):
+        print(f"{name:<24}{stage.calls:>9}{stage.busy:>11.2f}{stage.busy / wall * 100:>7.1f}%")
+    print(f"\nПиковая память процесса (RSS): {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} МБ")
+    if traced_peak is not None:
+        print(f"Пик памяти Python за цикл (tracemalloc): {traced_peak / 1024 / 1024:.1f} МБ")
+    print(f"Строк в таблице metrics: {metric_rows}")
+    if args.metrics:
+        print("\n" + metrics.render(), end="")
+
+
+if __name__ == "__main__":
+    main()
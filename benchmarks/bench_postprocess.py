@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк постобработки статьи (postprocess.add_navigation_and_split) на больших синтетических
+статьях: прежняя реализация на регулярных выражениях (несколько проходов по всему HTML
+и по каждому блоку) против разбора за один проход. Сначала проверяется, что на статьях
+со вложенными тегами, <h4> с атрибутами и обрезанным концом результат совпадает байт в байт
+при всех сочетаниях ENABLE_TOC, ENABLE_SECTION_SPLIT и NAVIGATION_STYLE.
+Использование: python -m benchmarks.bench_postprocess --news 20000
+"""
+
+import argparse
+import itertools
+import random
+import re
+import time
+from html import unescape
+from typing import List, Tuple
+from src import config, postprocess
+
+_CHANNELS = ["openai", "ozon", "wbnews", "ai_news", "ml_digest", "techcrunch_ru", "habr_com", "vcru"]
+_OFFICIAL = ["openai", "ozon", "wbnews"]
+_CATEGORIES = ["Модели", "Чипы", "Регулирование", "Продукты"]
+_WORDS = ["модель", "релиз", "агент", "GPU", "бенчмарк", "контекст", "API", "стартап", "данные", "обучение",
+          "Q&A", "«цитата»", "\"кавычки\"", "<тег>", "R&D", "🚀", "x<y"]
+
+
+# --- Прежняя реализация (до разбора за один проход), скопирована без изменений ---
+
+def _legacy_extract_username_from_tme(url: str) -> str:
+    m = re.search(r"https?://t\.me/([^/]+)/", url)
+    return m.group(1).lower() if m else ""
+
+
+def _legacy_split_news_blocks(html: str) -> Tuple[str, List[dict]]:
+    blocks = []
+    h4_pattern = re.compile(r"(<h4[^>]*>.*?</h4>)", re.DOTALL | re.IGNORECASE)
+    h4_content_pattern = re.compile(r"<h4[^>]*>(.*?)</h4>", re.DOTALL | re.IGNORECASE)
+
+    all_h4_tags = [m.group(1) for m in h4_pattern.finditer(html)]
+    if not all_h4_tags:
+        return html, []
+
+    first_h4_match = h4_pattern.search(html)
+    prefix = html[:first_h4_match.start()] if first_h4_match else html
+
+    content_after_prefix = html[first_h4_match.start():]
+    split_content = h4_pattern.split(content_after_prefix)[1:]
+
+    news_html_blocks = [tag + content for tag, content in zip(split_content[::2], split_content[1::2])]
+
+    for block_html in news_html_blocks:
+        h4_tag_match = h4_pattern.search(block_html)
+        if not h4_tag_match:
+            continue
+
+        h4_full_tag = h4_tag_match.group(1)
+        h4_inner_match = h4_content_pattern.search(h4_full_tag)
+        h4_inner = h4_inner_match.group(1) if h4_inner_match else ""
+
+        href_match = re.search(r"<a\s+href=\"([^\"]+)\"", h4_inner, re.IGNORECASE)
+        href = href_match.group(1) if href_match else ""
+
+        title_text = unescape(re.sub(r"<[^>]+>", "", h4_inner).strip())
+
+        category_match = re.search(r"data-category=\"([^\"]+)\"", h4_full_tag, re.IGNORECASE)
+        category = category_match.group(1) if category_match else "Без категории"
+
+        blocks.append({
+            "h4_inner": h4_inner,
+            "href": href,
+            "title": title_text,
+            "html": block_html.strip(),
+            "category": category,
+        })
+
+    return prefix, blocks
+
+
+def _legacy_prepare_anchors(blocks: List[dict]) -> List[dict]:
+    updated = []
+    for block in blocks:
+        anchor_id = postprocess._slugify_telegraph(block["title"])
+        new_html = re.sub(r"<h4>", f"<h4 id=\"{anchor_id}\">", block["html"], count=1, flags=re.IGNORECASE)
+        updated.append({**block, "anchor_id": anchor_id, "html": new_html})
+    return updated
+
+
+def legacy_add_navigation_and_split(html: str, official_channels: List[str]) -> str:
+    official_set = {c.lower() for c in official_channels}
+
+    prefix, blocks = _legacy_split_news_blocks(html)
+    if not blocks:
+        return html
+
+    blocks = _legacy_prepare_anchors(blocks)
+    toc_html = postprocess._build_toc(blocks) if config.ENABLE_TOC else ""
+
+    official_blocks = []
+    other_blocks = []
+    for b in blocks:
+        username = _legacy_extract_username_from_tme(b["href"]) if b["href"] else ""
+        if username in official_set:
+            official_blocks.append(b["html"])
+        else:
+            other_blocks.append(b["html"])
+
+    body_parts: List[str] = [prefix]
+    if config.ENABLE_SECTION_SPLIT:
+        if official_blocks:
+            body_parts.append(f"<h3>{config.OFFICIAL_SECTION_TITLE}</h3>")
+            body_parts.extend(official_blocks)
+        if other_blocks:
+            body_parts.append(f"<h3>{config.OTHER_SECTION_TITLE}</h3>")
+            body_parts.extend(other_blocks)
+    else:
+        body_parts.extend([b["html"] for b in blocks])
+
+    body_html = "".join(body_parts)
+
+    if toc_html:
+        if config.ENABLE_SECTION_SPLIT:
+            insertion_marker = re.search(r"<h3[^>]*>", body_html, re.IGNORECASE)
+        else:
+            insertion_marker = re.search(r"<h4[^>]*>", body_html, re.IGNORECASE)
+
+        if insertion_marker:
+            insert_at = insertion_marker.start()
+            return body_html[:insert_at] + toc_html + body_html[insert_at:]
+        else:
+            return body_html + toc_html
+
+    return body_html
+
+
+# --- Синтетические статьи ---
+
+def _text(rng: random.Random, words: int) -> str:
+    # Текст модели уже экранирован, кроме редких «сырых» символов, которые тоже встречаются
+    return " ".join(rng.choice(_WORDS).replace("&", "&amp;") if rng.random() < 0.9 else rng.choice(_WORDS)
+                    for _ in range(words))
+
+
+def _header(rng: random.Random, number: int) -> str:
+    title = f"{_text(rng, rng.randint(2, 8))} #{number}"
+    link = f"https://t.me/{rng.choice(_CHANNELS)}/{rng.randint(1, 99999)}"
+    variant = rng.randrange(8)
+    if variant == 0:
+        return f"<h4>{title}</h4>"
+    if variant == 1:
+        return f"<h4 data-category=\"{rng.choice(_CATEGORIES)}\"><a href=\"{link}\">{title}</a></h4>"
+    if variant == 2:
+        return f"<H4><a href=\"{link}\"><b>{title}</b> <i>и <code>ещё</code></i></a></H4>"
+    if variant == 3:
+        return f"<h4 class=\"news\">\n  <span data-category=\"{rng.choice(_CATEGORIES)}\">{title}</span>\n</h4>"
+    if variant == 4:
+        return f"<h4 id=\"old\" data-category=\"{rng.choice(_CATEGORIES)}\"><h4>{title}</h4>"
+    if variant == 5:
+        return f"<h4><a href=\"{link}\" target=\"_blank\">{title}</a> — <a href=\"{link}\">ещё</a></h4>"
+    return f"<h4><a href=\"{link}\">{title}</a></h4>"
+
+
+def _body(rng: random.Random) -> str:
+    parts = [f"<p>{_text(rng, rng.randint(20, 80))}</p>"]
+    if rng.random() < 0.3:
+        parts.append("<ul>" + "".join(f"<li>{_text(rng, 8)}</li>" for _ in range(rng.randint(1, 4))) + "</ul>")
+    if rng.random() < 0.2:
+        parts.append(f"<blockquote>{_text(rng, 15)}</blockquote>")
+    if rng.random() < 0.1:
+        parts.append(f"<h3>{_text(rng, 3)}</h3>")
+    return rng.choice(["", "\n", "\n\n  "]).join(parts)
+
+
+def make_article(news: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    prefix = rng.choice([
+        "",
+        f"<p>{_text(rng, 30)}</p>\n",
+        f"<h3>Коротко о неделе</h3><p>{_text(rng, 30)}</p>",
+        f"<h3 class=\"lead\">Вступление</h3>\n<p>{_text(rng, 10)}</p><p>текст <h3",
+        "<H4 без закрывающего тега",
+    ])
+    blocks = [_header(rng, number) + rng.choice(["", "\n"]) + _body(rng) + rng.choice(["", "\n", "\n\n"])
+              for number in range(news)]
+    # Ответ модели бывает обрезан: последний заголовок без </h4>
+    suffix = rng.choice(["", "<h4>Обрезанный заголовок", "<h4 data-category=\"X\">хвост\n"])
+    return prefix + "".join(blocks) + suffix
+
+
+_SETTINGS = list(itertools.product([True, False], [True, False], ["list", "paragraph"]))
+
+
+def _apply(settings):
+    config.ENABLE_TOC, config.ENABLE_SECTION_SPLIT, config.NAVIGATION_STYLE = settings
+
+
+def check_equivalence(articles: int, news: int) -> int:
+    """Сравнивает обе реализации; возвращает число расхождений."""
+    mismatches = 0
+    for seed in range(articles):
+        html = make_article(max(0, news + seed % 7 - 3), seed)
+        for settings in _SETTINGS:
+            _apply(settings)
+            if legacy_add_navigation_and_split(html, _OFFICIAL) != postprocess.add_navigation_and_split(html, _OFFICIAL):
+                mismatches += 1
+                print(f"Расхождение: seed={seed}, ENABLE_TOC/ENABLE_SECTION_SPLIT/NAVIGATION_STYLE={settings}")
+    return mismatches
+
+
+def _time(fn, html: str, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(html, _OFFICIAL)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк постобработки статьи.")
+    parser.add_argument("--news", type=int, default=20_000, help="Новостей в самой большой статье")
+    parser.add_argument("--repeat", type=int, default=5, help="Повторов замера (берётся лучший)")
+    parser.add_argument("--check-articles", type=int, default=300, help="Статей для проверки совпадения результата")
+    args = parser.parse_args()
+
+    config.NAVIGATION_TITLE = "🧭 Навигация"
+    config.OFFICIAL_SECTION_TITLE = "Официальные источники"
+    config.OTHER_SECTION_TITLE = "Другие источники"
+
+    start = time.perf_counter()
+    mismatches = check_equivalence(args.check_articles, 12)
+    checked = args.check_articles * len(_SETTINGS)
+    print(f"Проверка совпадения: {checked - mismatches} из {checked} результатов байт в байт "
+          f"({time.perf_counter() - start:.1f} с)\n")
+
+    _apply((True, True, "list"))
+    print(f"{'Новостей':>9}{'HTML, КБ':>11}{'прежняя, мс':>14}{'один проход, мс':>18}{'ускорение':>12}")
+    for news in sorted({max(1, args.news // 100), max(1, args.news // 10), args.news}):
+        html = make_article(news, seed=news)
+        legacy = _time(legacy_add_navigation_and_split, html, args.repeat)
+        current = _time(postprocess.add_navigation_and_split, html, args.repeat)
+        print(f"{news:>9}{len(html) / 1024:>11.0f}{legacy * 1000:>14.1f}{current * 1000:>18.1f}{legacy / current:>11.1f}x")
+
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
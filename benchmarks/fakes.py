@@ -0,0 +1,387 @@
+"""
+Локальные заменители внешних сервисов для офлайн-бенчмарков: TelegramClient (Telethon),
+AsyncOpenAI (включая Files и Batch API), Telegraph и telegram.Bot. Повторяют только ту часть API, которую использует бот,
+с настраиваемой задержкой и инъекцией ограничений частоты (FloodWait, HTTP 429, Retry-After).
+install() подменяет ими настоящие клиенты в модулях src.
+"""
+
+import asyncio
+import datetime
+import json
+import random
+import re
+import time
+import uuid
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from openai import RateLimitError
+from telegram.error import RetryAfter
+from telethon.errors import FloodWaitError
+from src import article_generator, telegram_notifier, telegram_parser, telegraph_publisher
+from src.article_generator import httpx
+
+
+@dataclass
+class ServiceProfile:
+    """Поведение одного сервиса: задержка ответа и доля запросов, получающих ограничение частоты."""
+    latency: float = 0.0        # секунды на запрос
+    jitter: float = 0.2         # ± доля задержки
+    limit_rate: float = 0.0     # вероятность FloodWait / 429 / Retry-After
+    limit_seconds: float = 1.0  # сколько сервис просит подождать
+    calls: int = 0
+    limited: int = 0
+    _rng: random.Random = field(default_factory=lambda: random.Random(7), repr=False)
+
+    def delay(self) -> float:
+        self.calls += 1
+        return max(0.0, self.latency * (1 + self._rng.uniform(-self.jitter, self.jitter)))
+
+    def should_limit(self) -> bool:
+        if self.limit_rate and self._rng.random() < self.limit_rate:
+            self.limited += 1
+            return True
+        return False
+
+
+# --- Telegram (Telethon) ---
+
+class FakeChannel:
+    """Заменитель telethon.tl.types.Channel: только поля, которые читает парсер."""
+
+    def __init__(self, channel_id: int, username: str):
+        self.id = channel_id
+        self.access_hash = channel_id * 7919
+        self.username = username
+        self.title = f"Канал {username}"
+
+
+class FakeTelegram:
+    """Каналы и их посты. posts — строки из benchmarks.synthetic.generate_posts.
+
+    Просмотры, репосты и реакции детерминированы: у каждого канала свой масштаб аудитории,
+    а пост набирает просмотры в течение пары суток после публикации.
+    """
+
+    def __init__(self, posts, profile: ServiceProfile, page_size: int = 100):
+        self.profile = profile
+        self.page_size = page_size
+        self.messages = {}
+        for channel, message_id, text, date, _, has_media in posts:
+            self.messages.setdefault(channel, []).append((message_id, text, date, has_media))
+        self.channels = {name: FakeChannel(i + 1, name) for i, name in enumerate(sorted(self.messages))}
+        self._by_id = {channel.id: name for name, channel in self.channels.items()}
+        self._audience = {name: random.Random(name).lognormvariate(8, 1.5) for name in self.messages}
+
+    def message(self, channel: str, message_id: int, text: str, date: int, has_media: bool):
+        rng = random.Random(f"{channel}/{message_id}")
+        # Доля итоговых просмотров, набранная к текущему моменту
+        matured = min(1.0, max(0.05, (time.time() - date) / (2 * 86400)))
+        interest = rng.lognormvariate(0, 1)
+        views = int(self._audience[channel] * interest * matured)
+        return SimpleNamespace(
+            id=message_id,
+            text=text,
+            date=datetime.datetime.fromtimestamp(date, datetime.timezone.utc),
+            photo=has_media,
+            video=None,
+            document=None,
+            views=views,
+            forwards=int(views * 0.01 * interest),
+            reactions=SimpleNamespace(results=[SimpleNamespace(count=int(views * 0.02 * interest))]),
+        )
+
+    def client(self, *args, **kwargs):
+        """Фабрика с сигнатурой TelegramClient(session, api_id, api_hash)."""
+        return FakeTelegramClient(self)
+
+
+class FakeTelegramClient:
+    def __init__(self, backend: FakeTelegram):
+        self.backend = backend
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def _request(self):
+        profile = self.backend.profile
+        await asyncio.sleep(profile.delay())
+        if profile.should_limit():
+            raise FloodWaitError(request=None, capture=int(profile.limit_seconds))
+
+    async def get_entity(self, name: str):
+        await self._request()
+        if name not in self.backend.channels:
+            raise ValueError(f"No user has \"{name}\" as username")
+        return self.backend.channels[name]
+
+    async def iter_messages(self, peer, limit=None, min_id=0):
+        """Как у Telethon: от новых к старым, одна «страница» (запрос) на page_size сообщений."""
+        name = getattr(peer, "username", None) or self.backend._by_id[peer.channel_id]
+        messages = sorted(self.backend.messages.get(name, ()), reverse=True)
+        sent = 0
+        for message_id, text, date, has_media in messages:
+            if message_id <= min_id or (limit is not None and sent >= limit):
+                break
+            if sent % self.backend.page_size == 0:
+                await self._request()
+            sent += 1
+            yield self.backend.message(name, message_id, text, date, has_media)
+
+    async def get_messages(self, peer, ids=()):
+        """Сообщения по id одним запросом; отсутствующие — None, как у Telethon."""
+        await self._request()
+        name = getattr(peer, "username", None) or self.backend._by_id[peer.channel_id]
+        by_id = {message[0]: message for message in self.backend.messages.get(name, ())}
+        return [self.backend.message(name, *by_id[i]) if i in by_id else None for i in ids]
+
+
+# --- OpenAI ---
+
+def _usage(prompt: str, answer: str, chat: bool):
+    # Грубая оценка токенов, как в tokens.estimate_tokens: ~4 символа на токен
+    input_tokens, output_tokens = len(prompt) // 4, len(answer) // 4
+    if chat:
+        return SimpleNamespace(prompt_tokens=input_tokens, completion_tokens=output_tokens)
+    return SimpleNamespace(
+        input_tokens=input_tokens,
+        output_tokens=output_tokens + output_tokens // 2,
+        output_tokens_details=SimpleNamespace(reasoning_tokens=output_tokens // 2),
+    )
+
+
+class _FakeStream:
+    def __init__(self, text: str, chunk_delay: float, chat: bool, usage=None):
+        self.text = text
+        self.chunk_delay = chunk_delay
+        self.chat = chat
+        self.usage = usage
+
+    async def _events(self):
+        for start in range(0, len(self.text), 400):
+            await asyncio.sleep(self.chunk_delay)
+            delta = self.text[start:start + 400]
+            if self.chat:
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=delta))])
+            else:
+                yield SimpleNamespace(type="response.output_text.delta", delta=delta)
+        if self.chat:
+            yield SimpleNamespace(choices=[], usage=self.usage)
+        else:
+            yield SimpleNamespace(type="response.completed", response=SimpleNamespace(usage=self.usage))
+
+    def __aiter__(self):
+        return self._events()
+
+    async def close(self):
+        pass
+
+
+class FakeOpenAI:
+    """Модель-заглушка. На запрос с ---SUMMARY--- в инструкциях отвечает статьёй и анонсом,
+    на остальные — отбирает keep_share постов из входа, как это делает SUMMARY_PROMPT.
+    """
+
+    def __init__(self, profile: ServiceProfile, keep_share: float = 0.3, batch_seconds: float = 1.0):
+        self.profile = profile
+        self.keep_share = keep_share
+        self.input_chars = 0
+        # Batch API: задание выполняется целиком через batch_seconds после создания
+        self.batch_seconds = batch_seconds
+        self.files = {}
+        self.batches = {}
+
+    def client(self, *args, http_client=None, **kwargs):
+        """Фабрика с сигнатурой AsyncOpenAI(api_key=..., http_client=...)."""
+        return FakeAsyncOpenAI(self, http_client)
+
+    def answer(self, text: str) -> str:
+        self.input_chars += len(text)
+        if "---SUMMARY---" in text.split("### User Content", 1)[0]:
+            headings = "".join(f"<h3>Тема {i}</h3><p>Текст раздела {i}.</p>" for i in range(1, 11))
+            return f"{headings}\n---SUMMARY---\nГлавное за неделю."
+        posts = re.findall(r"<post>.*?</post>", text, re.DOTALL)
+        return "\n".join(posts[:max(1, int(len(posts) * self.keep_share))]) or text[-2000:]
+
+    async def respond(self, text: str, stream: bool, chat: bool):
+        profile = self.profile
+        delay = profile.delay()
+        if profile.should_limit():
+            await asyncio.sleep(delay / 10)
+            request = httpx.Request("POST", "https://api.openai.com/v1/responses")
+            response = httpx.Response(429, headers={"retry-after": str(profile.limit_seconds)}, request=request)
+            raise RateLimitError("Rate limit reached (fake)", response=response, body=None)
+        answer = self.answer(text)
+        await asyncio.sleep(delay)
+        if stream:
+            # Первый фрагмент приходит после «размышления», остальные — быстро
+            return _FakeStream(answer, 0.001, chat, _usage(text, answer, chat))
+        if chat:
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=answer))],
+                                   usage=_usage(text, answer, chat))
+        return SimpleNamespace(output_text=answer, usage=_usage(text, answer, chat))
+
+
+    def save_file(self, content: bytes) -> str:
+        file_id = f"file-{uuid.uuid4().hex[:12]}"
+        self.files[file_id] = content
+        return file_id
+
+    def run_batch(self, batch: SimpleNamespace):
+        """Выполняет задание, если подошло его время: пишет выходной файл, как настоящий Batch API.
+        Отменяемое задание завершается со статусом cancelled и ответами на ту долю запросов,
+        которая успела выполниться к моменту отмены.
+        """
+        elapsed = time.monotonic() - batch.started
+        if batch.status == "cancelling":
+            self._finish(batch, min(1.0, elapsed / self.batch_seconds), "cancelled")
+        elif batch.status == "in_progress" and elapsed >= self.batch_seconds:
+            self._finish(batch, 1.0, "completed")
+
+    def _finish(self, batch: SimpleNamespace, share: float, status: str):
+        requests = self.files[batch.input_file_id].decode("utf-8").splitlines()
+        lines = []
+        for line in requests[:int(len(requests) * share)]:
+            request = json.loads(line)
+            self.profile.calls += 1
+            if self.profile.should_limit():
+                response = {"status_code": 429, "body": {"error": {"message": "Rate limit reached (fake)"}}}
+            else:
+                text = self.answer(request["body"]["input"])
+                response = {"status_code": 200, "body": {
+                    "model": request["body"]["model"],
+                    "output": [{"type": "message", "content": [{"type": "output_text", "text": text}]}],
+                    "usage": vars(_usage(request["body"]["input"], text, chat=False)) | {
+                        "output_tokens_details": {"reasoning_tokens": len(text) // 8},
+                    },
+                }}
+            lines.append(json.dumps({"custom_id": request["custom_id"], "response": response}, ensure_ascii=False))
+        batch.output_file_id = self.save_file("\n".join(lines).encode("utf-8")) if lines else None
+        batch.request_counts = SimpleNamespace(total=len(requests), completed=len(lines), failed=0)
+        batch.status = status
+
+
+class FakeAsyncOpenAI:
+    def __init__(self, backend: FakeOpenAI, http_client=None):
+        self.backend = backend
+        self._http_client = http_client
+        self.responses = SimpleNamespace(create=self._responses_create)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat_create))
+        self.files = SimpleNamespace(create=self._files_create, content=self._files_content)
+        self.batches = SimpleNamespace(
+            create=self._batches_create,
+            retrieve=self._batches_retrieve,
+            cancel=self._batches_cancel,
+        )
+
+    async def _responses_create(self, model=None, input="", stream=False, **kwargs):
+        return await self.backend.respond(input, stream, chat=False)
+
+    async def _chat_create(self, model=None, messages=(), stream=False, **kwargs):
+        text = "\n".join(message["content"] for message in messages)
+        return await self.backend.respond(text, stream, chat=True)
+
+    async def _files_create(self, file=None, purpose=None):
+        return SimpleNamespace(id=self.backend.save_file(file.read()), purpose=purpose)
+
+    async def _files_content(self, file_id):
+        return SimpleNamespace(text=self.backend.files[file_id].decode("utf-8"))
+
+    async def _batches_create(self, input_file_id=None, endpoint=None, completion_window=None, **kwargs):
+        lines = self.backend.files[input_file_id].count(b"\n")
+        batch = SimpleNamespace(
+            id=f"batch_{uuid.uuid4().hex[:12]}",
+            status="in_progress",
+            input_file_id=input_file_id,
+            output_file_id=None,
+            request_counts=SimpleNamespace(total=lines, completed=0, failed=0),
+            started=time.monotonic(),
+        )
+        self.backend.batches[batch.id] = batch
+        return batch
+
+    async def _batches_retrieve(self, batch_id):
+        batch = self.backend.batches[batch_id]
+        self.backend.run_batch(batch)
+        return batch
+
+    async def _batches_cancel(self, batch_id):
+        batch = self.backend.batches[batch_id]
+        if batch.status == "in_progress":
+            batch.status = "cancelling"
+        return batch
+
+    async def close(self):
+        if self._http_client is not None:
+            await self._http_client.aclose()
+
+
+# --- Telegraph и Bot API ---
+
+class FakeTelegraphService:
+    def __init__(self, profile: ServiceProfile):
+        self.profile = profile
+        self.pages = []
+
+    def client(self, access_token=None):
+        return FakeTelegraph(self, access_token)
+
+
+class FakeTelegraph:
+    """Синхронный, как и библиотека telegraph: задержка блокирует цикл событий."""
+
+    def __init__(self, service: FakeTelegraphService, access_token=None):
+        self.service = service
+        self.access_token = access_token
+
+    def create_account(self, short_name=None, **kwargs):
+        time.sleep(self.service.profile.delay())
+        return {"access_token": "fake-token"}
+
+    def create_page(self, title, html_content=None, **kwargs):
+        profile = self.service.profile
+        time.sleep(profile.delay())
+        if profile.should_limit():
+            raise Exception(f"FLOOD_WAIT_{int(profile.limit_seconds)}")
+        self.service.pages.append((title, html_content))
+        return {"url": f"https://telegra.ph/fake-{len(self.service.pages)}"}
+
+
+class FakeBotService:
+    def __init__(self, profile: ServiceProfile):
+        self.profile = profile
+        self.messages = []
+
+    def client(self, token=None):
+        return FakeBot(self)
+
+
+class FakeBot:
+    def __init__(self, service: FakeBotService):
+        self.service = service
+
+    async def send_message(self, chat_id, text, message_thread_id=None, parse_mode=None, **kwargs):
+        profile = self.service.profile
+        await asyncio.sleep(profile.delay())
+        if profile.should_limit():
+            raise RetryAfter(int(profile.limit_seconds))
+        self.service.messages.append((chat_id, text))
+
+
+@dataclass
+class FakeServices:
+    telegram: FakeTelegram
+    openai: FakeOpenAI
+    telegraph: FakeTelegraphService
+    bot: FakeBotService
+
+
+def install(services: FakeServices):
+    """Подменяет настоящие клиенты в модулях src на заменители из services."""
+    telegram_parser.TelegramClient = services.telegram.client
+    telegram_parser.Channel = FakeChannel
+    article_generator.AsyncOpenAI = services.openai.client
+    telegraph_publisher.Telegraph = services.telegraph.client
+    telegram_notifier.telegram = SimpleNamespace(Bot=services.bot.client)
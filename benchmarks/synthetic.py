@@ -0,0 +1,116 @@
+"""
+Генератор синтетических постов для бенчмарков. Посты детерминированы по seed,
+похожи на новости из Telegram-каналов (русский и английский словарь, ссылки,
+хэштеги) и отдаются потоком, поэтому годятся и для 1k, и для 1M постов.
+"""
+
+import random
+
+_WORDS = (
+    "модель нейросеть релиз обновление компания стартап инвестиции раунд данные обучение "
+    "агент open source бенчмарк GPU кластер токены контекст контекстное окно API цены "
+    "исследование статья лаборатория ускоритель чип дата-центр регулирование закон "
+    "безопасность выравнивание мультимодальность видео изображения голос поиск браузер "
+    "OpenAI Google Anthropic Meta Microsoft NVIDIA Яндекс Сбер Mistral DeepSeek Qwen "
+    "запустила представила выпустила объявила показала купила привлекла открыла "
+    "новая новый первая быстрее дешевле точнее крупнейший рекорд миллиард миллион "
+    "пользователи разработчики бизнес рынок продукт платформа сервис приложение"
+).split()
+
+# Редкие слова (названия продуктов, проектов, людей) — длинный хвост словаря,
+# как в реальных новостях; без него любое слово встречается почти в каждом посте
+_RARE_WORDS = 50_000
+
+_TAILS = (
+    "Подписывайтесь на канал!",
+    "#новости #ai",
+    "Источник: пресс-релиз компании",
+    "",
+    "",
+    "",
+)
+
+
+def _word(rng: random.Random) -> str:
+    """Случайное слово: чаще из общего словаря, иногда — редкое из длинного хвоста."""
+    if rng.random() < 0.85:
+        # Квадрат случайного числа сдвигает выбор к началу словаря — частые слова чаще
+        return _WORDS[int(len(_WORDS) * rng.random() ** 2)]
+    # Закон Ципфа для хвоста: небольшие номера встречаются намного чаще больших
+    return f"проект{min(_RARE_WORDS, int(rng.paretovariate(1.0)))}"
+
+
+# Шум, который отсеивает предфильтр: реклама, розыгрыши, посты из одной картинки
+_NOISE = (
+    "Реклама. ООО «Ромашка», erid: 2Vtzqx{n}. Курс по нейросетям со скидкой 50% — успейте записаться!",
+    "🎁 РОЗЫГРЫШ! Разыгрываем {n} подписок. Условия: подпишись на канал и сделай репост. Итоги в пятницу.",
+    "😂😂😂",
+    "Мем дня 👇",
+    "Промокод AI{n} даёт скидку 30% на годовую подписку. Ссылка в профиле.",
+)
+
+
+def _channel_names(count: int):
+    return [f"channel_{i:03d}" for i in range(count)]
+
+
+def _decorate(text: str, channel: str, rng: random.Random) -> str:
+    """Оформление, как у настоящих каналов: эмодзи, markdown-ссылка, хэштеги и подпись канала."""
+    prefix = rng.choice(("", "", "🔥🔥 ", "⚡️ ", "🚀🚀🚀 "))
+    link = f"\n\n[Подробнее](https://example.com/{channel}/{rng.randint(1, 10**6)}?utm_source=telegram&utm_medium={channel})"
+    tags = rng.choice(("", "\n\n#ai #новости", "\n\n#нейросети #ai #технологии"))
+    # Подпись у каждого канала своя и повторяется почти в каждом посте
+    signature = f"\n\n👉 Подписывайтесь на @{channel} | [Чат](https://t.me/{channel}_chat)" if rng.random() < 0.8 else ""
+    return prefix + text + (link if rng.random() < 0.5 else "") + tags + signature
+
+
+def generate_posts(count: int, channels: int = 80, seed: int = 42, start_date: int = 1_700_000_000,
+                   duplicate_rate: float = 0.05, decorated: bool = False, noise_rate: float = 0.0):
+    """Отдаёт count строк для database.add_posts: (channel, message_id, text, date, source_link, has_media).
+
+    duplicate_rate — доля постов, повторяющих (с небольшой правкой) один из недавних постов
+    другого канала; это имитирует репосты одной новости. decorated=True добавляет к постам
+    эмодзи, ссылки с utm-метками, хэштеги и подписи каналов. noise_rate — доля рекламы,
+    розыгрышей и постов без текста.
+    """
+    rng = random.Random(seed)
+    names = _channel_names(channels)
+    next_id = {name: 1 for name in names}
+    recent = []
+    date = start_date
+    for _ in range(count):
+        channel = rng.choice(names)
+        message_id = next_id[channel]
+        next_id[channel] += 1
+        date += rng.randint(1, 120)
+
+        if noise_rate and rng.random() < noise_rate:
+            text = rng.choice(_NOISE).format(n=rng.randint(1, 10**6))
+        elif recent and rng.random() < duplicate_rate:
+            text = rng.choice(recent) + rng.choice(("", " 🔥", "\n\nПодробнее по ссылке."))
+        else:
+            length = rng.randint(15, 120)
+            words = [_word(rng) for _ in range(length)]
+            text = " ".join(words).capitalize() + ". " + rng.choice(_TAILS)
+            recent.append(text)
+            if len(recent) > 200:
+                recent.pop(0)
+
+        has_media = rng.random() < 0.3
+        if decorated:
+            text = _decorate(text, channel, rng)
+        yield channel, message_id, text, date, f"https://t.me/{channel}/{message_id}", has_media
+
+
+def fill_database(count: int, batch: int = 5000, **kwargs) -> int:
+    """Заполняет текущую базу (config.DB_NAME) синтетическими постами. Возвращает число вставленных."""
+    from src import database
+
+    inserted, rows = 0, []
+    for row in generate_posts(count, **kwargs):
+        rows.append(row)
+        if len(rows) >= batch:
+            inserted += database.add_posts(rows)
+            rows = []
+    inserted += database.add_posts(rows)
+    return inserted
@@ -2,7 +2,11 @@ import asyncio
 import argparse
 import pytz # Добавляем импорт pytz
 import os # Добавляем импорт os
+import sqlite3
+import time
+from datetime import datetime, timedelta
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
 from src import (
     config, # Импортируем модуль config
     database,
@@ -10,117 +14,622 @@ from src import (
     article_generator,
     telegraph_publisher,
     telegram_notifier,
-    postprocess
+    postprocess,
+    maintenance,
+    batching,
+    llm_cache,
+    metrics,
+    compaction,
+    openai_batch,
+    prefilter,
+    ranking
 )
 
-async def weekly_digest_job():
-    """Основная задача, выполняющая весь цикл создания дайджеста с пакетной обработкой."""
-    print("\n--- НАЧАЛО НОВОГО ЦИКЛА СОЗДАНИЯ ДАЙДЖЕСТА ---")
+BATCH_SIZE = 50  # Сколько постов читается из базы за один запрос. Размер пачек для OpenAI задаёт SUMMARY_BATCH_TOKENS.
 
-    # 1. Парсинг каналов
-    print("\n[Шаг 1/5] Запуск парсинга новых постов...")
-    await telegram_parser.parse_channels()
-    print("[Шаг 1/5] Парсинг завершен.")
-
-    # 2. Пакетная обработка постов и сборка общего саммари
-    print("\n[Шаг 2/5] Начало пакетной обработки постов для создания саммари...")
-    all_posts_ids = []
-    all_summaries_text = ""
-    batch_size = 50  # Размер одной пачки. Можно подобрать экспериментально.
-    offset = 0
-    batch_num = 1
-
-    while True:
-        print(f"  - Обработка пачки #{batch_num}, смещение: {offset}...")
-        posts_batch = database.get_unprocessed_posts(limit=batch_size, offset=offset)
-
-        if not posts_batch:
-            print("  - Все посты обработаны, пачек больше нет.")
-            break
-
-        print(f"  - В пачке #{batch_num} найдено {len(posts_batch)} постов.")
-        batch_ids = [p[0] for p in posts_batch]
-        all_posts_ids.extend(batch_ids)
-
-        # Генерируем КРАТКОЕ саммари для текущей пачки постов
-        print(f"  - Отправка пачки #{batch_num} в OpenAI для генерации краткого саммари...")
-        _, batch_summary = await article_generator.generate_article_and_summary(
-            posts_batch,
-            prompt_template=config.SUMMARY_PROMPT
-        )
+_TIMEZONE = pytz.timezone('Europe/Moscow')
 
-        if batch_summary:
-            all_summaries_text += batch_summary + "\n\n"
-            print(f"  - Саммари для пачки #{batch_num} успешно сгенерировано.")
-        else:
-            print(f"  - !!! Не удалось сгенерировать саммари для пачки #{batch_num}.")
+# Цикл дайджеста и задачи Batch API работают с одним журналом запуска — не даём им пересекаться
+_digest_lock = asyncio.Lock()
+
+async def _summarize_batch(posts_batch: list, batch_num: int, run_id: int) -> str:
+    """Генерирует краткое саммари одной пачки постов через SUMMARY_PROMPT
+    и сразу сохраняет его в журнал запуска run_id.
+    """
+    print(f"  - В пачке #{batch_num} найдено {len(posts_batch)} постов (~{batching.batch_tokens(posts_batch)} токенов).")
+    print(f"  - Отправка пачки #{batch_num} в OpenAI для генерации краткого саммари...")
+    _, batch_summary = await article_generator.generate_article_and_summary(
+        posts_batch,
+        prompt_template=config.SUMMARY_PROMPT
+    )
+
+    if batch_summary:
+        database.save_batch_summary(run_id, batch_num, [p[0] for p in posts_batch], batch_summary)
+        print(f"  - Саммари для пачки #{batch_num} успешно сгенерировано.")
+    else:
+        print(f"  - !!! Не удалось сгенерировать саммари для пачки #{batch_num}.")
 
-        offset += batch_size
-        batch_num += 1
-        print("  - Пауза 10 секунд перед следующей пачкой...")
-        await asyncio.sleep(10)
+    return batch_summary
 
-    if not all_summaries_text:
-        print("\n[ЗАВЕРШЕНИЕ] Не удалось сгенерировать ни одного саммари. Пропускаем этот цикл.")
+def _digest_since() -> int:
+    """Нижняя граница даты постов для дайджеста (unix time) по DIGEST_WINDOW_DAYS."""
+    if not config.DIGEST_WINDOW_DAYS:
+        return 0
+    return int(time.time()) - config.DIGEST_WINDOW_DAYS * 86400
+
+class _BatchDispatcher:
+    """Отправляет пачки в OpenAI параллельно, не больше SUMMARY_CONCURRENCY одновременно.
+
+    submit() ждёт свободный слот, поэтому набор новых пачек притормаживает,
+    пока модель занята. Номера пачкам выдаются по порядку отправки, а общий текст
+    собирается из журнала по номерам, так что порядок саммари не зависит от того,
+    какой ответ пришёл первым.
+    """
+
+    def __init__(self, run_id: int, batch_num: int):
+        self.run_id = run_id
+        self.batch_num = batch_num
+        self.post_ids = []
+        self._semaphore = asyncio.Semaphore(config.SUMMARY_CONCURRENCY)
+        self._tasks = []
+
+    async def submit(self, posts_batch: list):
+        await self._semaphore.acquire()
+        batch_num = self.batch_num
+        self.batch_num += 1
+        self.post_ids.extend(p[0] for p in posts_batch)
+        self._tasks.append(asyncio.create_task(self._run(posts_batch, batch_num)))
+
+    async def _run(self, posts_batch: list, batch_num: int) -> str:
+        try:
+            return await _summarize_batch(posts_batch, batch_num, self.run_id)
+        finally:
+            self._semaphore.release()
+
+    async def wait(self) -> list:
+        """Дожидается всех отправленных пачек. Возвращает их саммари в порядке номеров."""
+        return await asyncio.gather(*self._tasks)
+
+    async def cancel(self):
+        """Отменяет незавершённые пачки и дожидается их. После wait() ничего не делает."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+def _report_packing(packer: batching.BatchPacker, compactor: compaction.Compactor, post_filter: prefilter.Prefilter):
+    """Записывает в базу посты, отсеянные предфильтром, и печатает, сколько токенов
+    сэкономили предфильтр и сжатие постов и сколько постов пришлось обрезать.
+    """
+    post_filter.flush()
+    if post_filter.seen:
+        reasons = ", ".join(f"{reason}: {count}" for reason, count in post_filter.reasons.most_common())
+        print(f"  - Предфильтр: отсеяно {post_filter.dropped} из {post_filter.seen} постов ({post_filter.drop_rate * 100:.1f}%), "
+              f"не отправлено в OpenAI ~{post_filter.tokens_dropped} токенов" + (f" ({reasons})" if reasons else ""))
+    if compactor.tokens_before:
+        saved_share = compactor.saved_tokens / compactor.tokens_before * 100
+        print(f"  - Сжатие текста постов: ~{compactor.tokens_before} -> ~{compactor.tokens_after} токенов "
+              f"(сэкономлено ~{compactor.saved_tokens}, {saved_share:.1f}%)")
+    if packer.truncated:
+        print(f"  - Обрезано слишком длинных постов (больше {packer.max_post_tokens} токенов): {packer.truncated}")
+
+async def _summarize_unprocessed(run_id: int, batch_num: int, done_ids: set):
+    """Обрабатывает все необработанные посты пачками (до SUMMARY_CONCURRENCY запросов
+    одновременно), пропуская посты из done_ids (уже готовые пачки и отсеянные ранжированием).
+    Возвращает id постов, отправленных в OpenAI.
+    """
+    dispatcher = _BatchDispatcher(run_id, batch_num)
+    packer = batching.BatchPacker()
+    compactor = compaction.Compactor()
+    post_filter = prefilter.Prefilter()
+
+    async def submit(posts_batch):
+        if posts_batch:
+            print(f"  - Обработка пачки #{dispatcher.batch_num}...")
+            await dispatcher.submit(posts_batch)
+
+    try:
+        for posts_page in database.iter_unprocessed_posts(BATCH_SIZE, since=_digest_since()):
+            for post in posts_page:
+                if post[0] not in done_ids:
+                    # Предфильтр смотрит на сжатый текст: подпись канала и хэштеги не маскируют пустой пост
+                    post = compactor.compact(post)
+                    if post_filter.keep(post):
+                        await submit(packer.add(post))
+        await submit(packer.flush())
+        await dispatcher.wait()
+    finally:
+        # При ошибке не оставляем пачки работать без присмотра: weekly_digest_job закроет клиент OpenAI
+        await dispatcher.cancel()
+    _report_packing(packer, compactor, post_filter)
+
+    print("  - Все посты обработаны, пачек больше нет.")
+    return dispatcher.post_ids
+
+async def _parse_and_summarize_streaming(run_id: int, batch_num: int, done_ids: set):
+    """Потоковый режим: парсер (производитель) кладёт в очередь имена готовых каналов,
+    а обработчик (потребитель) набирает из их свежих постов пачки и сразу отправляет
+    их в OpenAI (до SUMMARY_CONCURRENCY одновременно), пока остальные каналы ещё
+    парсятся. Посты из уже готовых пачек (done_ids) пропускаются.
+    Возвращает id постов, отправленных в OpenAI.
+    """
+    queue = asyncio.Queue()
+
+    async def produce():
+        try:
+            await telegram_parser.parse_channels(on_channel_parsed=queue.put)
+        finally:
+            # None — признак окончания парсинга
+            await queue.put(None)
+
+    producer = asyncio.create_task(produce())
+
+    dispatcher = _BatchDispatcher(run_id, batch_num)
+    packer = batching.BatchPacker()
+    compactor = compaction.Compactor()
+    post_filter = prefilter.Prefilter()
+    seen_ids = set(done_ids)
+
+    async def collect(posts: list):
+        for post in posts:
+            if post[0] not in seen_ids:
+                seen_ids.add(post[0])
+                post = compactor.compact(post)
+                if not post_filter.keep(post):
+                    continue
+                posts_batch = packer.add(post)
+                if posts_batch:
+                    await dispatcher.submit(posts_batch)
+
+    since = _digest_since()
+    try:
+        while True:
+            channel = await queue.get()
+            if channel is None:
+                break
+            await collect(database.get_unprocessed_posts_for_channel(channel, since=since))
+
+        # Пробрасываем исключение парсера, если оно было
+        await producer
+        print("[Шаг 1/5] Парсинг завершен.")
+
+        # Добираем посты, оставшиеся с прошлых запусков или из каналов вне конфигурации
+        for posts_page in database.iter_unprocessed_posts(BATCH_SIZE, since=since):
+            await collect(posts_page)
+        posts_batch = packer.flush()
+        if posts_batch:
+            await dispatcher.submit(posts_batch)
+        await dispatcher.wait()
+    finally:
+        # При ошибке парсера или OpenAI не оставляем задачи работать без присмотра:
+        # weekly_digest_job закроет клиент OpenAI, которым они ещё пользуются
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+        await dispatcher.cancel()
+    _report_packing(packer, compactor, post_filter)
+    print("  - Все посты обработаны, пачек больше нет.")
+
+    return dispatcher.post_ids
+
+def _refresh_since():
+    """Для parse_channels(refresh_since=...): обновлять вовлечённость, только если она нужна ранжированию."""
+    return _digest_since() if ranking.enabled() and config.RANKING_REFRESH else None
+
+def _apply_ranking(run_id: int, sent_ids: set) -> set:
+    """При включённом ранжировании оставляет для OpenAI только самые значимые необработанные посты
+    (RANKING_TOP_K / RANKING_TOP_PERCENT / RANKING_TOKEN_BUDGET), остальные записываются в журнал
+    запуска с причиной low_rank. Обработанными они отмечаются вместе с постами пачек, когда запуск
+    завершится: если он упадёт или будет закрыт, они будут рассмотрены снова.
+    sent_ids — посты запуска, уже отправленные в OpenAI.
+    Возвращает id всех постов, отсеянных ранжированием в этом запуске.
+    """
+    skipped = {post_id for post_id, _ in database.get_run_skips(run_id)}
+    if not ranking.enabled():
+        return skipped
+    candidates = [
+        c for c in database.get_ranking_candidates(_digest_since())
+        if c[0] not in sent_ids and c[0] not in skipped
+    ]
+    selected, dropped = ranking.select(ranking.rank(candidates), already=len(sent_ids))
+    database.save_run_skips(run_id, [(post_id, "low_rank") for post_id in dropped])
+    print(f"  - Ранжирование по вовлечённости: отобрано {len(selected)} из {len(candidates)} постов, "
+          f"отсеяно {len(dropped)}.")
+    return skipped | set(dropped)
+
+def _report_llm_cache():
+    """Печатает счётчики кэша ответов OpenAI за время работы процесса."""
+    if not config.LLM_CACHE_ENABLED:
         return
-    
-    print("[Шаг 2/5] Пакетная обработка завершена. Общий текст саммари собран.")
-
-    # 3. Генерация финального лонгрида из общего саммари
-    print("\n[Шаг 3/5] Генерация финального лонгрида и саммари из общего текста...")
-    final_input_for_generator = [(0, all_summaries_text, "", False)]
-    
-    article_html, summary = await article_generator.generate_article_and_summary(
-        final_input_for_generator,
-        prompt_template=config.ARTICLE_PROMPT
+    stats = llm_cache.stats()
+    print(
+        f"Кэш OpenAI: попаданий {stats['hits']}, промахов {stats['misses']}, в обход {stats['bypassed']}; "
+        f"записей {stats['entries']} ({stats['size'] / 1024 / 1024:.1f} МБ)"
     )
 
-    if not article_html or not summary:
-        print("\n[ОШИБКА] Не удалось сгенестрировать финальную статью или саммари. Посты не будут отмечены как обработанные.")
-        return
+def _progress_printer(label: str, step: int = 5000):
+    """on_partial для длинной генерации: печатает, сколько текста уже получено, каждые step символов."""
+    next_report = step
 
-    print("[Шаг 3/5] Финальный лонгрид и саммари успешно сгенерированы.")
+    def report(text: str):
+        nonlocal next_report
+        if len(text) >= next_report:
+            print(f"  - {label}: получено {len(text)} символов...")
+            next_report = len(text) + step
 
-    # Заголовок фиксированный по тематике из .env
-    title = f"Еженедельный {config.DIGEST_NAME} дайджест"
+    return report
 
-    # 4. Публикация в Telegra.ph
-    print(f"\n[Шаг 4/5] Публикация статьи в Telegra.ph с заголовком: '{title}'...")
-    # 3.1 Постобработка: навигация и разбиение на разделы
-    article_html = postprocess.add_navigation_and_split(
-        article_html,
-        official_channels=config.OFFICIAL_CHANNELS or []
+def _schedule_period() -> float:
+    """Интервал между запусками weekly_digest_job по расписанию, в секундах."""
+    trigger = CronTrigger(
+        day_of_week=config.SCHEDULE_DAY_OF_WEEK,
+        hour=config.SCHEDULE_HOUR,
+        minute=config.SCHEDULE_MINUTE,
+        timezone=_TIMEZONE
     )
+    first = trigger.get_next_fire_time(None, datetime.now(_TIMEZONE))
+    second = trigger.get_next_fire_time(first, first + timedelta(seconds=1))
+    return (second - first).total_seconds()
+
+def _open_digest_run(resume_stale: bool = False):
+    """Продолжает незавершённый запуск (при DIGEST_RESUME) или начинает новый.
+    Возвращает (run_id, stage, article_html, summary, article_url).
+
+    Запуск старше одного периода расписания продолжается только при resume_stale (--run-now):
+    иначе задача по расписанию опубликовала бы саммари прошлой недели, а новые посты
+    отложились бы ещё на цикл. Такой запуск закрывается, его посты остаются необработанными
+    и попадают в новый запуск; если статья уже опубликована, запуск завершается
+    (см. database.close_stale_digest_runs).
+    """
+    resume = config.DIGEST_RESUME or config.OPENAI_BATCH_MODE
+    if resume and not resume_stale:
+        finalized, abandoned = database.close_stale_digest_runs(int(time.time() - _schedule_period()))
+        if finalized:
+            print(f"Запуски старше периода расписания с опубликованной статьёй завершены: "
+                  f"{', '.join(f'#{run_id}' for run_id in finalized)}.")
+        if abandoned:
+            print(f"Запуски старше периода расписания закрыты без публикации: "
+                  f"{', '.join(f'#{run_id}' for run_id in abandoned)}, их посты попадут в новый запуск.")
+    # Пачки из Batch API копятся в открытом запуске, поэтому в этом режиме он продолжается всегда
+    run = database.get_open_digest_run() if resume else None
+    if run:
+        print(f"Продолжаем незавершённый запуск #{run[0]} с этапа '{run[1]}'.")
+    else:
+        run = database.start_digest_run(), database.DIGEST_SUMMARIZING, None, None, None
+    if run[1] == database.DIGEST_SUMMARIZING:
+        # Задания Batch API закрытых запусков ещё идут и оплачены — их ответы достаются этому запуску
+        adopted = database.adopt_abandoned_openai_batches(run[0])
+        if adopted:
+            print(f"Незавершённые задания Batch API закрытых запусков переданы запуску #{run[0]}: {adopted}")
+    return run
+
+def _flush_metrics():
+    """Сохраняет метрики, накопленные задачей, в таблицу metrics."""
+    rows = metrics.drain()
+    if config.METRICS_ENABLED:
+        database.save_metrics(rows)
+    metrics.set_run(None)
+
+async def weekly_digest_job(resume_stale: bool = False):
+    """Задача планировщика: цикл дайджеста, после которого закрывается пул соединений OpenAI.
+    resume_stale — продолжать и незавершённый запуск старше периода расписания (--run-now).
+    """
+    async with _digest_lock:
+        try:
+            with metrics.span("digest"):
+                await _run_digest(resume_stale)
+        finally:
+            await article_generator.close_client()
+            _flush_metrics()
+
+async def batch_submit_job():
+    """Задача планировщика при OPENAI_BATCH_MODE: парсит каналы и отправляет накопившиеся пачки
+    одним заданием Batch API. Ответы забирает batch_poll_job, а цикл дайджеста берёт их
+    из журнала как готовые пачки и синхронно досчитывает только остаток.
+    """
+    async with _digest_lock:
+        try:
+            with metrics.span("batch_submit"):
+                await _submit_batches()
+        finally:
+            await article_generator.close_client()
+            _flush_metrics()
+
+async def batch_poll_job():
+    """Задача планировщика при OPENAI_BATCH_MODE: забирает ответы готовых заданий Batch API."""
+    if _digest_lock.locked():
+        return
+    async with _digest_lock:
+        try:
+            if database.get_open_openai_batches():
+                with metrics.span("batch_poll"):
+                    saved = await openai_batch.poll()
+                if saved:
+                    print(f"Batch API: в журнал сохранено {saved} саммари пачек.")
+        finally:
+            await article_generator.close_client()
+            _flush_metrics()
+
+async def maintenance_job():
+    """Задача планировщика: обслуживание базы. Архив, очистка журнала и VACUUM не должны идти
+    посреди цикла дайджеста или заданий Batch API, поэтому берём ту же блокировку.
+    """
+    async with _digest_lock:
+        await maintenance.maintenance_job()
 
-    article_url = await telegraph_publisher.publish_to_telegraph(title, article_html)
+async def _submit_batches():
+    """Пишет необработанные посты, ещё не попавшие ни в готовые пачки, ни в ждущие задания,
+    в JSONL-файл(ы) Batch API и отправляет их.
+    """
+    print("\n--- ОТПРАВКА ПАЧЕК В OPENAI BATCH API ---")
+    print("\n[Шаг 1/2] Запуск парсинга новых постов...")
+    await telegram_parser.parse_channels(refresh_since=_refresh_since())
 
-    if not article_url:
-        print("\n[ОШИБКА] Не удалось опубликовать статью в Telegra.ph.")
+    run_id, stage = _open_digest_run()[:2]
+    metrics.set_run(run_id)
+    if stage != database.DIGEST_SUMMARIZING:
+        print(f"Запуск #{run_id} уже на этапе '{stage}', новые посты дождутся следующего запуска.")
         return
-    
-    print(f"[Шаг 4/5] Статья успешно опубликована: {article_url}")
 
-    # 5. Отправка уведомления в Telegram
-    print("\n[Шаг 5/5] Отправка уведомления в Telegram...")
-    await telegram_notifier.send_notification(summary, article_url)
-    print("[Шаг 5/5] Уведомление успешно отправлено.")
+    print(f"\n[Шаг 2/2] Сборка пачек для Batch API (запуск #{run_id})...")
+    skip_ids = {post_id for _, post_ids, _ in database.get_batch_summaries(run_id) for post_id in post_ids}
+    skip_ids |= database.get_pending_batch_post_ids(run_id)
+    skip_ids |= _apply_ranking(run_id, skip_ids)
+    writer = openai_batch.BatchWriter(run_id)
+    packer = batching.BatchPacker()
+    compactor = compaction.Compactor()
+    post_filter = prefilter.Prefilter()
+    batch_num = database.next_batch_num(run_id)
+
+    def add(posts_batch):
+        nonlocal batch_num
+        if posts_batch:
+            writer.add(batch_num, posts_batch)
+            batch_num += 1
+
+    for posts_page in database.iter_unprocessed_posts(BATCH_SIZE, since=_digest_since()):
+        for post in posts_page:
+            if post[0] not in skip_ids:
+                post = compactor.compact(post)
+                if post_filter.keep(post):
+                    add(packer.add(post))
+    add(packer.flush())
+    _report_packing(packer, compactor, post_filter)
+    if writer.cached:
+        print(f"  - Пачек с готовым ответом в кэше OpenAI: {writer.cached}")
+
+    if not writer.requests:
+        writer.close()
+        print("  - Новых пачек для Batch API нет.")
+        return
+    batch_ids = await openai_batch.submit(writer)
+    print(f"--- ОТПРАВЛЕНО {writer.requests} ПАЧЕК В {len(batch_ids)} ЗАДАНИЯХ BATCH API ---")
+
+async def _run_digest(resume_stale: bool = False):
+    """Основная задача, выполняющая весь цикл создания дайджеста с пакетной обработкой.
+
+    Каждый этап отмечается в журнале digest_runs, а саммари пачек — в batch_summaries,
+    поэтому после сбоя следующий запуск продолжает с первого незавершённого этапа,
+    не оплачивая уже готовые саммари повторно.
+    """
+    print("\n--- НАЧАЛО НОВОГО ЦИКЛА СОЗДАНИЯ ДАЙДЖЕСТА ---")
+
+    run_id, stage, article_html, summary, article_url = _open_digest_run(resume_stale)
+    metrics.set_run(run_id)
+
+    if config.OPENAI_BATCH_MODE and stage == database.DIGEST_SUMMARIZING:
+        # Забираем готовые ответы Batch API; задания, которые не успели, отменяем —
+        # их пачки будут отправлены синхронно вместе с остальными необработанными постами
+        print("\n[Шаг 0/5] Проверка заданий Batch API...")
+        with metrics.span("batch_poll"):
+            saved = await openai_batch.poll(run_id, cancel_running=True)
+        print(f"  - Получено саммари пачек из Batch API: {saved}")
+
+    stages = [
+        database.DIGEST_SUMMARIZING,
+        database.DIGEST_SUMMARIZED,
+        database.DIGEST_ARTICLE,
+        database.DIGEST_PUBLISHED,
+        database.DIGEST_NOTIFIED,
+    ]
+    completed = stages.index(stage)
+
+    done_batches = database.get_batch_summaries(run_id)
+    done_ids = {post_id for _, post_ids, _ in done_batches for post_id in post_ids}
+    all_posts_ids = list(done_ids)
+    if done_batches:
+        print(f"  - Готовых пачек из журнала: {len(done_batches)} ({len(done_ids)} постов), повторно в OpenAI не отправляются.")
+
+    if completed < 1:
+        duplicates_before = database.get_duplicate_stats(_digest_since())[0]
+        batch_num = database.next_batch_num(run_id)
+
+        # Ранжированию нужны все посты недели сразу, поэтому с ним пачки набираются после парсинга
+        if config.DIGEST_STREAMING and not ranking.enabled():
+            # 1-2. Парсинг и пакетная обработка выполняются одновременно
+            print("\n[Шаг 1-2/5] Потоковый режим: парсинг и пакетная обработка постов идут параллельно...")
+            with metrics.span("parse_and_summarize"):
+                all_posts_ids += await _parse_and_summarize_streaming(run_id, batch_num, done_ids)
+        else:
+            # 1. Парсинг каналов
+            print("\n[Шаг 1/5] Запуск парсинга новых постов...")
+            with metrics.span("parse"):
+                await telegram_parser.parse_channels(refresh_since=_refresh_since())
+            print("[Шаг 1/5] Парсинг завершен.")
+
+            # 2. Пакетная обработка постов и сборка общего саммари
+            print("\n[Шаг 2/5] Начало пакетной обработки постов для создания саммари...")
+            with metrics.span("ranking"):
+                ranked_out = _apply_ranking(run_id, done_ids)
+            with metrics.span("summarize"):
+                all_posts_ids += await _summarize_unprocessed(run_id, batch_num, done_ids | ranked_out)
+
+        duplicates, duplicate_tokens = database.get_duplicate_stats(_digest_since())
+        if duplicates:
+            print(f"  - Дубликатов схлопнуто: {duplicates} (новых за этот запуск: {duplicates - duplicates_before}), "
+                  f"не отправлено в OpenAI ~{duplicate_tokens} токенов.")
+
+    # Общий текст собираем из журнала — в нём и пачки этого запуска, и пачки прерванного
+    batch_summaries = [s for _, _, s in database.get_batch_summaries(run_id)]
+
+    if not batch_summaries:
+        print("\n[ЗАВЕРШЕНИЕ] Не удалось сгенерировать ни одного саммари. Пропускаем этот цикл.")
+        return
+
+    if completed < 1:
+        database.update_digest_run(run_id, database.DIGEST_SUMMARIZED)
+        print("[Шаг 2/5] Пакетная обработка завершена. Общий текст саммари собран.")
+
+    if completed < 2:
+        # 3. Генерация финального лонгрида из общего саммари
+        print("\n[Шаг 3/5] Генерация финального лонгрида и саммари из общего текста...")
+        # Если саммари слишком много для одного запроса, сначала сворачиваем их по уровням
+        with metrics.span("reduce"):
+            all_summaries_text = await article_generator.reduce_summaries(batch_summaries)
+        final_input_for_generator = [(0, all_summaries_text, "", False)]
+
+        with metrics.span("article"):
+            article_html, summary = await article_generator.generate_article_and_summary(
+                final_input_for_generator,
+                prompt_template=config.ARTICLE_PROMPT,
+                on_partial=_progress_printer("Лонгрид")
+            )
+
+        if not article_html or not summary:
+            print("\n[ОШИБКА] Не удалось сгенестрировать финальную статью или саммари. Посты не будут отмечены как обработанные.")
+            return
+
+        database.update_digest_run(run_id, database.DIGEST_ARTICLE, article_html=article_html, summary=summary)
+        print("[Шаг 3/5] Финальный лонгрид и саммари успешно сгенерированы.")
+
+    if completed < 3:
+        # Заголовок фиксированный по тематике из .env
+        title = f"Еженедельный {config.DIGEST_NAME} дайджест"
+
+        # 4. Публикация в Telegra.ph
+        print(f"\n[Шаг 4/5] Публикация статьи в Telegra.ph с заголовком: '{title}'...")
+        # 3.1 Постобработка: навигация и разбиение на разделы
+        with metrics.span("postprocess"):
+            article_html = postprocess.add_navigation_and_split(
+                article_html,
+                official_channels=config.OFFICIAL_CHANNELS or []
+            )
+
+        with metrics.span("publish"):
+            article_url = await telegraph_publisher.publish_to_telegraph(title, article_html)
+
+        if not article_url:
+            print("\n[ОШИБКА] Не удалось опубликовать статью в Telegra.ph.")
+            return
+
+        database.update_digest_run(run_id, database.DIGEST_PUBLISHED, article_url=article_url)
+        print(f"[Шаг 4/5] Статья успешно опубликована: {article_url}")
+
+    if completed < 4:
+        # 5. Отправка уведомления в Telegram
+        print("\n[Шаг 5/5] Отправка уведомления в Telegram...")
+        with metrics.span("notify"):
+            await telegram_notifier.send_notification(summary, article_url)
+        database.update_digest_run(run_id, database.DIGEST_NOTIFIED)
+        print("[Шаг 5/5] Уведомление успешно отправлено.")
 
     # 6. Отметка ВСЕХ обработанных постов как завершенных
-    database.mark_posts_as_processed(all_posts_ids)
+    with metrics.span("finalize"):
+        database.mark_posts_as_processed(all_posts_ids)
+        # Отсеянные ранжированием посты закрываются только вместе с запуском
+        database.mark_posts_skipped(database.get_run_skips(run_id))
+    database.update_digest_run(run_id, database.DIGEST_DONE)
     print(f"\n[УСПЕХ] Дайджест успешно создан и отправлен! Всего обработано {len(all_posts_ids)} постов.")
+    _report_llm_cache()
     print("--- ЦИКЛ СОЗДАНИЯ ДАЙДЖЕСТА ЗАВЕРШЕН ---")
 
-async def main_async(config_file: str, init_session: bool):
-    # Загружаем конфигурацию
+def openai_batch_command(config_file: str, action: str):
+    """Подкоманда openai-batch: вручную отправить пачки в Batch API (submit) или забрать ответы (poll)."""
     config.load_config(config_file)
+    config.SESSION_NAME = _session_name(config_file)
+    database.init_db()
+    try:
+        asyncio.run(batch_submit_job() if action == "submit" else batch_poll_job())
+    finally:
+        database.close_db()
+        llm_cache.close()
 
-    # Устанавливаем имя сессии на основе имени файла конфигурации
+def prefilter_train_command(config_file: str, runs: int):
+    """Подкоманда prefilter-train: обучает классификатор предфильтра на решениях SUMMARY_PROMPT
+    из последних runs запусков (пост оставлен, если ссылка на него попала в саммари пачки).
+    """
+    config.load_config(config_file)
+    database.init_db()
+    examples = list(database.iter_labeled_posts(runs))
+    database.close_db()
+    if len(examples) < 200:
+        print(f"Размеченных постов слишком мало для обучения: {len(examples)} (нужно хотя бы 200).")
+        return
+    # Каждый десятый пример откладываем для проверки
+    train = [example for i, example in enumerate(examples) if i % 10]
+    holdout = examples[::10]
+    model = prefilter.train_classifier(train)
+    kept_share = sum(1 for _, _, kept in holdout if kept) / len(holdout)
+    print(f"Обучено на {len(train)} постах. Точность на отложенных {len(holdout)}: "
+          f"{prefilter.classifier_accuracy(model, holdout) * 100:.1f}% "
+          f"(всегда угадывать самый частый ответ: {max(kept_share, 1 - kept_share) * 100:.1f}%)")
+    prefilter.save_classifier(model)
+    print(f"Классификатор сохранён в {config.PREFILTER_MODEL_PATH}")
+
+def maintenance_command(config_file: str):
+    """Подкоманда maintenance: однократное обслуживание базы (архив, VACUUM)."""
+    config.load_config(config_file)
+    database.init_db()
+    maintenance.run_maintenance()
+    database.close_db()
+    llm_cache.close()
+
+def dedupe_report_command(config_file: str, days: int, backfill: bool):
+    """Подкоманда dedupe-report: сколько дубликатов схлопнуто и сколько токенов это экономит."""
+    config.load_config(config_file)
+    database.init_db()
+    since = int(time.time()) - days * 86400 if days else 0
+    if backfill:
+        print(f"Отпечатки посчитаны для {database.backfill_fingerprints(since)} старых постов.")
+    duplicates, duplicate_tokens = database.get_duplicate_stats(since)
+    total = sum(len(batch) for batch in database.iter_unprocessed_posts(1000, since=since))
+    print(f"Необработанных уникальных постов: {total}, схлопнуто дубликатов: {duplicates}")
+    print(f"Экономия на входе SUMMARY_PROMPT: ~{duplicate_tokens} токенов")
+    database.close_db()
+
+def search_command(config_file: str, query: str, limit: int, channel: str, days: int, raw: bool, by_rank: bool):
+    """Подкоманда search: полнотекстовый поиск по постам в базе бота."""
+    config.load_config(config_file)
+    database.init_db()
+    since = int(time.time()) - days * 86400 if days else 0
+    try:
+        results = database.search_posts(query, limit=limit, channel=channel, since=since, raw=raw, by_rank=by_rank)
+    except sqlite3.OperationalError as e:
+        # С --raw запрос уходит в FTS5 как есть, и ошибка синтаксиса — это ошибка ввода
+        print(f"Неверный синтаксис запроса: {e}")
+        return
+    finally:
+        database.close_db()
+    if not results:
+        print("Ничего не найдено.")
+    for post_id, post_channel, date, source_link, snippet in results:
+        posted_at = time.strftime("%Y-%m-%d %H:%M", time.localtime(date))
+        print(f"#{post_id} [{post_channel}] {posted_at} {source_link or ''}")
+        print(f"    {' '.join(snippet.split())}")
+
+def _session_name(config_file: str) -> str:
+    """Имя сессии Telethon по имени файла конфигурации: .env.ai -> ai."""
     file_base_name = os.path.basename(config_file)
     if file_base_name.startswith('.env.'):
-        session_name = file_base_name[len('.env.'):]
-    else:
-        session_name = os.path.splitext(file_base_name)[0]
-    config.SESSION_NAME = session_name
+        return file_base_name[len('.env.'):]
+    return os.path.splitext(file_base_name)[0]
+
+async def main_async(config_file: str, init_session: bool, run_now: bool = False, no_llm_cache: bool = False):
+    # Загружаем конфигурацию
+    config.load_config(config_file)
+    if no_llm_cache:
+        config.LLM_CACHE_BYPASS = True
+
+    # Устанавливаем имя сессии на основе имени файла конфигурации
+    config.SESSION_NAME = _session_name(config_file)
 
     # Инициализация базы данных при первом запуске
     database.init_db()
@@ -130,11 +639,21 @@ async def main_async(config_file: str, init_session: bool):
         print("Запуск в режиме инициализации сессии...")
         await telegram_parser.parse_channels()
         print("Инициализация сессии завершена.")
+        database.close_db()
+        return
+
+    # Если указан флаг --run-now, один раз выполняем цикл дайджеста (или продолжаем прерванный) и выходим
+    if run_now:
+        try:
+            await weekly_digest_job(resume_stale=True)
+        finally:
+            database.close_db()
+            llm_cache.close()
         return
 
     # database.reset_processed_posts()
     # Настройка планировщика
-    scheduler = AsyncIOScheduler(timezone=pytz.timezone('Europe/Moscow'))
+    scheduler = AsyncIOScheduler(timezone=_TIMEZONE)
     # Запуск задачи каждую неделю, в пятницу в 20:40
     scheduler.add_job(
         weekly_digest_job, 
@@ -144,9 +663,35 @@ async def main_async(config_file: str, init_session: bool):
         minute=config.SCHEDULE_MINUTE
     )
 
+    # Еженедельное обслуживание базы: архив старых постов и VACUUM
+    scheduler.add_job(
+        maintenance_job,
+        'cron',
+        day_of_week=config.MAINTENANCE_DAY_OF_WEEK,
+        hour=config.MAINTENANCE_HOUR,
+        minute=config.MAINTENANCE_MINUTE
+    )
+
+    if config.OPENAI_BATCH_MODE:
+        # Пачки уходят в Batch API заранее, а их ответы забираются по мере готовности
+        scheduler.add_job(
+            batch_submit_job,
+            'cron',
+            day_of_week=config.OPENAI_BATCH_DAY_OF_WEEK,
+            hour=config.OPENAI_BATCH_HOUR,
+            minute=config.OPENAI_BATCH_MINUTE
+        )
+        scheduler.add_job(batch_poll_job, 'interval', minutes=config.OPENAI_BATCH_POLL_MINUTES)
+        print(f"Batch API включён: пачки отправляются в {config.OPENAI_BATCH_HOUR:02d}:{config.OPENAI_BATCH_MINUTE:02d} "
+              f"({config.OPENAI_BATCH_DAY_OF_WEEK}), готовность проверяется раз в {config.OPENAI_BATCH_POLL_MINUTES} мин.")
+
     print(f"Планировщик для {config_file} запущен. Следующий запуск в {config.SCHEDULE_DAY_OF_WEEK} в {config.SCHEDULE_HOUR:02d}:{config.SCHEDULE_MINUTE:02d}.")
     print("Нажмите Ctrl+C для выхода.")
 
+    if config.METRICS_PORT:
+        # Эндпоинт для Prometheus живёт, пока работает планировщик
+        metrics.start_server(config.METRICS_HOST, config.METRICS_PORT)
+
     scheduler.start()
 
     # Поддерживаем работу скрипта, чтобы цикл событий не завершался
@@ -155,6 +700,9 @@ async def main_async(config_file: str, init_session: bool):
         await asyncio.Future()
     except (KeyboardInterrupt, SystemExit):
         pass
+    finally:
+        database.close_db()
+        llm_cache.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Запуск бота для создания дайджестов.")
@@ -168,6 +716,51 @@ if __name__ == "__main__":
         action="store_true", # Этот флаг не требует значения, он просто есть или его нет
         help="Запустить парсер один раз для создания сессии Telegram и выйти."
     )
+    parser.add_argument(
+        "--run-now",
+        action="store_true",
+        help="Один раз выполнить цикл дайджеста (или продолжить прерванный) и выйти."
+    )
+    parser.add_argument(
+        "--no-llm-cache",
+        action="store_true",
+        help="Не брать ответы OpenAI из кэша (свежие ответы всё равно сохраняются)."
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    search_parser = subparsers.add_parser("search", help="Полнотекстовый поиск по сохранённым постам.")
+    search_parser.add_argument("query", help="Слова для поиска (все должны встретиться в посте)")
+    search_parser.add_argument("--limit", type=int, default=20, help="Сколько результатов показать")
+    search_parser.add_argument("--channel", default=None, help="Искать только в этом канале")
+    search_parser.add_argument("--days", type=int, default=0, help="Искать только за последние N дней")
+    search_parser.add_argument(
+        "--raw",
+        action="store_true",
+        help="Передать запрос в FTS5 как есть (OR, NEAR, \"фраза\", префикс*)"
+    )
+    search_parser.add_argument("--rank", action="store_true", help="Сортировать по релевантности, а не по дате")
+    dedupe_parser = subparsers.add_parser("dedupe-report", help="Отчёт о схлопнутых дубликатах и сэкономленных токенах.")
+    dedupe_parser.add_argument("--days", type=int, default=7, help="За сколько последних дней считать")
+    dedupe_parser.add_argument(
+        "--backfill",
+        action="store_true",
+        help="Сначала посчитать отпечатки для постов, сохранённых до появления дедупликации"
+    )
+    subparsers.add_parser("maintenance", help="Архивировать старые посты и сжать базу, затем выйти.")
+    train_parser = subparsers.add_parser("prefilter-train", help="Обучить классификатор предфильтра на решениях SUMMARY_PROMPT.")
+    train_parser.add_argument("--runs", type=int, default=8, help="Сколько последних запусков дайджеста использовать")
+    batch_parser = subparsers.add_parser("openai-batch", help="Отправить пачки в OpenAI Batch API или забрать готовые ответы.")
+    batch_parser.add_argument("action", choices=["submit", "poll"], help="submit — отправить пачки, poll — забрать ответы")
     args = parser.parse_args()
 
-    asyncio.run(main_async(args.config, args.init_session))
\ No newline at end of file
+    if args.command == "search":
+        search_command(args.config, args.query, args.limit, args.channel, args.days, args.raw, args.rank)
+    elif args.command == "dedupe-report":
+        dedupe_report_command(args.config, args.days, args.backfill)
+    elif args.command == "maintenance":
+        maintenance_command(args.config)
+    elif args.command == "prefilter-train":
+        prefilter_train_command(args.config, args.runs)
+    elif args.command == "openai-batch":
+        openai_batch_command(args.config, args.action)
+    else:
+        asyncio.run(main_async(args.config, args.init_session, args.run_now, args.no_llm_cache))
\ No newline at end of file
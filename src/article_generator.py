@@ -1,162 +1,383 @@
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, RateLimitError
 import asyncio
-import random
 import html
-from . import config
+import time
+from . import config, llm_cache, metrics, rate_limiter
+from .tokens import estimate_tokens
+
+try:
+    import httpx2 as httpx  # новые версии openai построены на httpx2
+except ImportError:
+    import httpx
+
+# Один клиент (и один пул HTTP-соединений) на процесс: создаётся при первом запросе,
+# закрывается close_client() по окончании задачи. Клиент привязан к циклу событий,
+# в котором создан, поэтому в новом цикле создаётся заново.
+_client = None
+_client_loop = None
 
 def _xml(text: str) -> str:
     # Экранируем спецсимволы, чтобы не порвать XML
     return html.escape(text or "", quote=True)
 
 
-async def generate_article_and_summary(posts: list, prompt_template: str = None) -> tuple[str, str]:
-    """Генерирует лонг-рид в HTML и краткое содержание на основе постов."""
-    print(f"Начинаем генерацию. Количество постов: {len(posts)}")
+def get_client() -> AsyncOpenAI:
+    """Возвращает общий клиент OpenAI, создавая его при первом вызове."""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is not None and _client_loop is loop:
+        return _client
+    http_client = DefaultAsyncHttpxClient(
+        # Соединений не меньше, чем одновременных пачек; держим их открытыми между запросами,
+        # чтобы не платить за TCP и TLS на каждую пачку
+        limits=httpx.Limits(
+            max_connections=config.SUMMARY_CONCURRENCY + 2,
+            max_keepalive_connections=config.SUMMARY_CONCURRENCY + 2,
+            keepalive_expiry=config.OPENAI_KEEPALIVE_SECONDS,
+        ),
+        # Ответ reasoning-модели может идти минутами, а соединение должно устанавливаться быстро
+        timeout=httpx.Timeout(config.OPENAI_TIMEOUT_SECONDS, connect=config.OPENAI_CONNECT_TIMEOUT_SECONDS),
+    )
+    _client = AsyncOpenAI(api_key=config.OPENAI_API_KEY, http_client=http_client)
+    _client_loop = loop
+    return _client
 
-    if prompt_template is None:
-        prompt_template = config.ARTICLE_PROMPT
 
-    client = AsyncOpenAI(api_key=config.OPENAI_API_KEY)
+async def close_client():
+    """Закрывает общий клиент OpenAI и его пул соединений."""
+    global _client, _client_loop
+    if _client is not None:
+        await _client.close()
+    _client, _client_loop = None, None
 
-    if not posts:
-        print("Нет постов для обработки")
-        return "", ""
 
+def format_post(post) -> str:
+    """XML-представление одного поста в том виде, в каком он уходит в модель."""
+    # ожидаем структуру: (id, text, source_link, has_media_bool, channel, date, duplicate_links)
+    text = post[1]
+    source_link = post[2]
+    has_media = "true" if post[3] else "false"
+    # Копии поста из других каналов схлопнуты в него — передаём и их ссылки
+    duplicate_links = post[6].split() if len(post) > 6 and post[6] else []
+    sources = "".join(f"<source>{_xml(link)}</source>\n" for link in [source_link, *duplicate_links])
+    return (
+        "<post>\n"
+        f"<content>{_xml(text)}</content>\n"
+        f"{sources}"
+        f"<has_media>{has_media}</has_media>\n"
+        "</post>\n"
+    )
+
+
+def build_input_text(system_prompt: str, formatted_posts: str) -> str:
+    """Единый input-текст запроса к Responses API."""
+    return (
+        "### System Instructions\n"
+        f"{system_prompt}\n\n"
+        "### User Content\n"
+        "Вот подборка новостей за неделю:\n\n"
+        f"{formatted_posts}"
+    )
+
+
+def _is_summary_prompt(prompt_template: str) -> bool:
+    """Промпты промежуточных этапов (саммари пачек и свёртка): ответ — текст без ---SUMMARY---."""
+    return prompt_template in (config.SUMMARY_PROMPT, config.REDUCE_PROMPT)
+
+
+def _prompt_kind(prompt_template: str) -> str:
+    """Этап, к которому относится запрос (метка метрик OpenAI)."""
+    if prompt_template == config.SUMMARY_PROMPT:
+        return "summary"
+    if prompt_template == config.REDUCE_PROMPT:
+        return "reduce"
+    return "article"
+
+
+def _field(obj, name: str):
+    # usage приходит объектом SDK, а в выходном файле Batch API — словарём
+    return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+
+def usage_tokens(usage) -> tuple[int, int, int]:
+    """Токены из usage ответа (Responses API или chat.completions): (входные, выходные, из них на рассуждение)."""
+    if usage is None:
+        return 0, 0, 0
+    input_tokens = _field(usage, "input_tokens") or _field(usage, "prompt_tokens") or 0
+    output_tokens = _field(usage, "output_tokens") or _field(usage, "completion_tokens") or 0
+    details = _field(usage, "output_tokens_details") or _field(usage, "completion_tokens_details")
+    return input_tokens, output_tokens, (_field(details, "reasoning_tokens") if details else None) or 0
+
+
+def record_usage(prompt: str, usage) -> tuple[int, int, int]:
+    """Добавляет токены ответа в счётчик openai_tokens_total."""
+    input_tokens, output_tokens, reasoning_tokens = usage_tokens(usage)
+    metrics.inc("openai_tokens_total", input_tokens, prompt=prompt, type="input")
+    metrics.inc("openai_tokens_total", output_tokens, prompt=prompt, type="output")
+    metrics.inc("openai_tokens_total", reasoning_tokens, prompt=prompt, type="reasoning")
+    return input_tokens, output_tokens, reasoning_tokens
+
+
+def _format_posts(posts: list) -> str:
     # Форматируем посты для подачи в модель (XML), экранируем содержимое
     if len(posts) == 1 and isinstance(posts[0][1], str) and "<post>" in posts[0][1]:
-        formatted_posts = posts[0][1]
-    else:
-        chunks = []
-        for post in posts:
-            # ожидаем структуру: (id, text, source_link, has_media_bool, ...)
-            text = post[1]
-            source_link = post[2]
-            has_media = "true" if post[3] else "false"
-            chunks.append(
-                "<post>\n"
-                f"<content>{_xml(text)}</content>\n"
-                f"<source>{_xml(source_link)}</source>\n"
-                f"<has_media>{has_media}</has_media>\n"
-                "</post>\n"
-            )
-        formatted_posts = "\n".join(chunks)
+        return posts[0][1]
+    return "\n".join(format_post(post) for post in posts)
 
-    system_prompt = prompt_template
 
+def _request_params(prompt_template: str) -> dict:
     # --- Параметры модели GPT-5 (reasoning) ---
     base_params = {
         "model": "gpt-5",
         "seed": 42,
         "response_format": {"type": "text"},  # можно переключить на {"type": "json"} при необходимости
     }
-
-    if prompt_template == config.SUMMARY_PROMPT:
-        request_params = {
+    if _is_summary_prompt(prompt_template):
+        return {
             **base_params,
             "max_output_tokens": 15000,
             "reasoning": {"effort": "low"},
             # ВАЖНО: НЕ передаем temperature/top_p/penalties для gpt-5
         }
-        fallback_temperature = 0.25  # только для chat.completions
-    else:
-        request_params = {
-            **base_params,
-            "max_output_tokens": 16000,
-            "reasoning": {"effort": "medium"},
-        }
-        fallback_temperature = 0.55
+    return {
+        **base_params,
+        "max_output_tokens": 16000,
+        "reasoning": {"effort": "medium"},
+    }
+
+
+def build_request(posts: list, prompt_template: str) -> tuple[dict, str]:
+    """Параметры модели и input-текст запроса к Responses API — те же, что у generate_article_and_summary
+    (по ним же считается ключ кэша). Нужны для отложенной отправки через Batch API.
+    """
+    return _request_params(prompt_template), build_input_text(prompt_template, _format_posts(posts))
+
+
+def _stream_usage(event):
+    """usage из события потока: у Responses API — в response.completed, у chat.completions — в последнем чанке."""
+    if getattr(event, "type", "") == "response.completed":
+        return getattr(event.response, "usage", None)
+    return getattr(event, "usage", None)
+
+
+def _responses_delta(event) -> str:
+    """Текст из события потока Responses API; ошибки потока пробрасываются исключением."""
+    event_type = getattr(event, "type", "")
+    if event_type == "response.output_text.delta":
+        return event.delta
+    if event_type in ("error", "response.failed"):
+        raise RuntimeError(f"Поток Responses API прерван: {event}")
+    return ""
+
+
+def _chat_delta(chunk) -> str:
+    """Текст из чанка потока chat.completions."""
+    if not chunk.choices:
+        return ""
+    return chunk.choices[0].delta.content or ""
+
+
+async def _read_stream(stream, delta_of, on_partial=None, usage: dict = None) -> str:
+    """Собирает текст ответа из потока по мере поступления.
+
+    До первого фрагмента текста ждём OPENAI_TIMEOUT_SECONDS (reasoning-модель сначала думает),
+    дальше между фрагментами — не больше OPENAI_IDLE_TIMEOUT_SECONDS: зависшая генерация
+    прерывается сразу, а не по общему таймауту HTTP. on_partial(text) получает накопленный текст.
+    Если задан OPENAI_END_MARKER, чтение прекращается, как только маркер пришёл.
+    usage["usage"] получает расход токенов, если поток его прислал.
+    """
+    marker = config.OPENAI_END_MARKER
+    text = ""
+    iterator = stream.__aiter__()
+    try:
+        while True:
+            timeout = config.OPENAI_IDLE_TIMEOUT_SECONDS if text else config.OPENAI_TIMEOUT_SECONDS
+            try:
+                event = await asyncio.wait_for(iterator.__anext__(), timeout)
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"OpenAI не присылал данные {timeout:.0f} с") from None
+            if usage is not None and _stream_usage(event) is not None:
+                usage["usage"] = _stream_usage(event)
+            delta = delta_of(event)
+            if not delta:
+                continue
+            text += delta
+            if on_partial:
+                on_partial(text)
+            # Маркер может прийти разбитым на несколько фрагментов — проверяем только хвост
+            if marker and marker in text[-(len(delta) + len(marker)):]:
+                text = text.split(marker, 1)[0]
+                print("Получен маркер конца ответа, остаток потока не ждём.")
+                break
+    finally:
+        await stream.close()
+    if not text:
+        raise RuntimeError("Поток ответа OpenAI не содержит текста")
+    return text
+
+
+async def generate_article_and_summary(posts: list, prompt_template: str = None, on_partial=None) -> tuple[str, str]:
+    """Генерирует лонг-рид в HTML и краткое содержание на основе постов.
+
+    При OPENAI_STREAMING ответ читается потоком, и on_partial(text) вызывается с уже полученным текстом.
+    """
+    print(f"Начинаем генерацию. Количество постов: {len(posts)}")
+
+    if prompt_template is None:
+        prompt_template = config.ARTICLE_PROMPT
+
+    if not posts:
+        print("Нет постов для обработки")
+        return "", ""
+
+    system_prompt = prompt_template
+    formatted_posts = _format_posts(posts)
+    request_params = _request_params(prompt_template)
+    fallback_temperature = 0.25 if _is_summary_prompt(prompt_template) else 0.55  # только для chat.completions
 
     # Собираем вход под Responses API.
     # В responses лучше отправить единый input-текст, чтобы не нарваться на несовместимость "messages" в SDK.
-    input_text = (
-        "### System Instructions\n"
-        f"{system_prompt}\n\n"
-        "### User Content\n"
-        "Вот подборка новостей за неделю:\n\n"
-        f"{formatted_posts}"
-    )
+    input_text = build_input_text(system_prompt, formatted_posts)
+
+    limiter = rate_limiter.get(rate_limiter.OPENAI)
+    prompt_kind = _prompt_kind(prompt_template)
 
     try:
-        attempt = 0
-        last_error = None
-        response = None
+        # Одинаковый запрос (модель, параметры, промпт и посты) уже оплачивали — берём ответ из кэша
+        cache_key = llm_cache.make_key(request_params, input_text)
+        content = llm_cache.get(cache_key)
+        if content is not None:
+            print("Ответ взят из кэша OpenAI.")
+            metrics.inc("openai_cache_hits_total", prompt=prompt_kind)
+        else:
+            client = get_client()
+            started = time.perf_counter()
+            attempt = 0
+            last_error = None
+            response = None
+            model = request_params["model"]
+            stream_usage = {}
 
-        while attempt < 2 and response is None:
-            try:
-                # Путь 1: Responses API — корректный путь для gpt-5
-                # НЕ передаём temperature/top_p/penalties (они либо игнорируются, либо дают 400)
-                response = await client.responses.create(
-                    model=request_params["model"],
-                    input=input_text,
-                    max_output_tokens=request_params.get("max_output_tokens"),
-                    reasoning=request_params.get("reasoning"),
+            while attempt < 2 and response is None and content is None:
+                try:
+                    # Путь 1: Responses API — корректный путь для gpt-5
+                    # НЕ передаём temperature/top_p/penalties (они либо игнорируются, либо дают 400)
+                    await limiter.acquire()
+                    if config.OPENAI_STREAMING:
+                        stream = await client.responses.create(
+                            model=request_params["model"],
+                            input=input_text,
+                            max_output_tokens=request_params.get("max_output_tokens"),
+                            reasoning=request_params.get("reasoning"),
+                            stream=True,
+                        )
+                        content = await _read_stream(stream, _responses_delta, on_partial, stream_usage)
+                    else:
+                        response = await client.responses.create(
+                            model=request_params["model"],
+                            input=input_text,
+                            max_output_tokens=request_params.get("max_output_tokens"),
+                            reasoning=request_params.get("reasoning"),
+                        )
+                except RateLimitError as e_inner:
+                    # 429: ждём столько, сколько просит OpenAI, и притормаживаем все запросы
+                    last_error = e_inner
+                    attempt += 1
+                    print(f"[Attempt {attempt}] Responses API rate limit: {e_inner}")
+                    limiter.backoff(rate_limiter.retry_after_seconds(getattr(e_inner.response, "headers", None)))
+                except Exception as e_inner:
+                    last_error = e_inner
+                    attempt += 1
+                    print(f"[Attempt {attempt}] Responses API error: {e_inner}")
+                    await asyncio.sleep(1.0 * attempt)
+
+            # Если не вышло — fallback на chat.completions с совместимыми параметрами и моделью
+            if response is None and content is None:
+                print("Переходим на fallback: chat.completions + gpt-4o")
+                model = "gpt-4o"
+
+                # Конвертация max_output_tokens -> max_tokens c безопасной отсечкой
+                # (чтобы не прыгать за лимиты fallback-модели)
+                mot = request_params.get("max_output_tokens", 16000)
+                fallback_max_tokens = min(mot, 8000)
+
+                await limiter.acquire()
+                response = await client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": f"Вот подборка новостей за неделю:\n\n{formatted_posts}"},
+                    ],
+                    max_tokens=fallback_max_tokens,
+                    temperature=fallback_temperature,
+                    top_p=1,
+                    frequency_penalty=0.0 if _is_summary_prompt(prompt_template) else 0.1,
+                    presence_penalty=0.0,
+                    stream=config.OPENAI_STREAMING,
+                    # В потоке chat.completions расход токенов приходит только по запросу
+                    **({"stream_options": {"include_usage": True}} if config.OPENAI_STREAMING else {}),
                 )
-            except Exception as e_inner:
-                last_error = e_inner
-                attempt += 1
-                print(f"[Attempt {attempt}] Responses API error: {e_inner}")
-                await asyncio.sleep(1.0 * attempt)
-
-        # Если не вышло — fallback на chat.completions с совместимыми параметрами и моделью
-        if response is None:
-            print("Переходим на fallback: chat.completions + gpt-4o")
-
-            # Конвертация max_output_tokens -> max_tokens c безопасной отсечкой
-            # (чтобы не прыгать за лимиты fallback-модели)
-            mot = request_params.get("max_output_tokens", 16000)
-            fallback_max_tokens = min(mot, 8000)
-
-            response = await client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"Вот подборка новостей за неделю:\n\n{formatted_posts}"},
-                ],
-                max_tokens=fallback_max_tokens,
-                temperature=fallback_temperature,
-                top_p=1,
-                frequency_penalty=0.1 if prompt_template != config.SUMMARY_PROMPT else 0.0,
-                presence_penalty=0.0,
-            )
+                if config.OPENAI_STREAMING:
+                    content = await _read_stream(response, _chat_delta, on_partial, stream_usage)
 
-        await asyncio.sleep(random.uniform(0.5, 1.5))
+            limiter.success()
 
-        # Унифицированное извлечение текста
-        content = None
+            # Унифицированное извлечение текста
+            # 0) Потоковый режим: текст уже собран
+            # 1) Responses API (новые модели): у многих SDK есть .output_text
+            if content is None:
+                content = getattr(response, "output_text", None)
 
-        # 1) Responses API (новые модели): у многих SDK есть .output_text
-        content = getattr(response, "output_text", None)
+            # 2) Доп. попытка — некоторые SDK возвращают "output" массив
+            if not content and hasattr(response, "output"):
+                try:
+                    # Пытаемся собрать текст из структурированного вывода
+                    parts = []
+                    for block in getattr(response, "output", []):
+                        for item in block.get("content", []):
+                            if isinstance(item, dict) and "text" in item:
+                                parts.append(item["text"])
+                    if parts:
+                        content = "\n".join(parts)
+                except Exception:
+                    pass
 
-        # 2) Доп. попытка — некоторые SDK возвращают "output" массив
-        if not content and hasattr(response, "output"):
-            try:
-                # Пытаемся собрать текст из структурированного вывода
-                parts = []
-                for block in getattr(response, "output", []):
-                    for item in block.get("content", []):
-                        if isinstance(item, dict) and "text" in item:
-                            parts.append(item["text"])
-                if parts:
-                    content = "\n".join(parts)
-            except Exception:
-                pass
-
-        # 3) Chat Completions
-        if not content:
-            try:
-                content = response.choices[0].message.content
-            except Exception:
-                pass
+            # 3) Chat Completions
+            if not content:
+                try:
+                    content = response.choices[0].message.content
+                except Exception:
+                    pass
 
-        if not content:
-            raise RuntimeError("Не удалось извлечь текст ответа из OpenAI API")
+            if not content:
+                raise RuntimeError("Не удалось извлечь текст ответа из OpenAI API")
+
+            elapsed = time.perf_counter() - started
+            print(f"Запрос к OpenAI занял {elapsed:.1f} с")
+            input_tokens, output_tokens, reasoning_tokens = record_usage(
+                prompt_kind, stream_usage.get("usage") or getattr(response, "usage", None)
+            )
+            metrics.inc("openai_retries_total", attempt, prompt=prompt_kind)
+            if model != request_params["model"]:
+                metrics.inc("openai_fallbacks_total", prompt=prompt_kind)
+            metrics.call(
+                "openai_request_seconds", elapsed, {"prompt": prompt_kind, "model": model},
+                input_tokens=input_tokens, output_tokens=output_tokens, reasoning_tokens=reasoning_tokens,
+                retries=attempt, fallback=model != request_params["model"],
+            )
+            # Ответ запасной модели (gpt-4o) под ключом запроса к gpt-5 не кэшируем:
+            # иначе он подменял бы ответ gpt-5 во всех повторах до истечения LLM_CACHE_MAX_AGE_DAYS
+            if model == request_params["model"]:
+                llm_cache.put(cache_key, model, content)
 
         print(f"Получен ответ от OpenAI, длина: {len(content)} символов")
 
         article_html = ""
         summary = ""
 
-        if prompt_template == config.SUMMARY_PROMPT:
+        if _is_summary_prompt(prompt_template):
             print("Обработка ответа от SUMMARY_PROMPT.")
             summary = content.strip()
         else:
@@ -173,7 +394,62 @@ async def generate_article_and_summary(posts: list, prompt_template: str = None)
         return article_html, summary
 
     except Exception as e:
+        metrics.inc("openai_errors_total", prompt=prompt_kind)
         print(f"Ошибка при обращении к OpenAI: {e}")
         print(f"Тип ошибки: {type(e).__name__}")
         print(f"Детали ошибки: {str(e)}")
         return "", ""
+
+
+def _join_summaries(summaries: list) -> str:
+    return "".join(summary + "\n\n" for summary in summaries)
+
+
+def _group_summaries(summaries: list, budget: int) -> list:
+    """Делит саммари на группы по бюджету токенов, не меньше двух в группе (иначе свёртка не сокращает число частей)."""
+    groups, group, group_tokens = [], [], 0
+    for summary in summaries:
+        tokens = estimate_tokens(summary)
+        if len(group) >= 2 and group_tokens + tokens > budget:
+            groups.append(group)
+            group, group_tokens = [], 0
+        group.append(summary)
+        group_tokens += tokens
+    if group:
+        groups.append(group)
+    return groups
+
+
+async def reduce_summaries(summaries: list, budget: int = None) -> str:
+    """Иерархическая свёртка саммари пачек перед генерацией статьи.
+
+    Пока общий текст больше budget (ARTICLE_INPUT_TOKENS) токенов, саммари делятся на группы
+    по SUMMARY_BATCH_TOKENS, каждая группа параллельно (до SUMMARY_CONCURRENCY запросов)
+    сворачивается через REDUCE_PROMPT в промежуточный дайджест, и так уровень за уровнем.
+    Возвращает текст для ARTICLE_PROMPT; при budget=0 саммари просто склеиваются.
+    """
+    budget = config.ARTICLE_INPUT_TOKENS if budget is None else budget
+    summaries = [summary for summary in summaries if summary]
+    semaphore = asyncio.Semaphore(config.SUMMARY_CONCURRENCY)
+
+    async def reduce_group(group: list) -> list:
+        async with semaphore:
+            _, reduced = await generate_article_and_summary(
+                [(0, _join_summaries(group), "", False)],
+                prompt_template=config.REDUCE_PROMPT
+            )
+        # Если свёртка группы не удалась, оставляем её части как есть — ничего не теряем
+        return [reduced] if reduced else group
+
+    level = 0
+    while budget and len(summaries) > 1 and estimate_tokens(_join_summaries(summaries)) > budget:
+        level += 1
+        groups = _group_summaries(summaries, config.SUMMARY_BATCH_TOKENS)
+        print(f"  - Свёртка, уровень {level}: {len(summaries)} саммари -> {len(groups)} групп...")
+        reduced = [part for parts in await asyncio.gather(*(reduce_group(group) for group in groups)) for part in parts]
+        if len(reduced) >= len(summaries):
+            print("  - Свёртка не сократила текст, останавливаемся.")
+            break
+        summaries = reduced
+
+    return _join_summaries(summaries)
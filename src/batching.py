@@ -0,0 +1,72 @@
+from . import config
+from .article_generator import build_input_text, format_post
+from .tokens import estimate_tokens
+
+# Пометка в конце обрезанного поста, чтобы модель понимала, что текст неполный
+_TRUNCATION_MARK = " […]"
+
+
+def post_tokens(post) -> int:
+    """Сколько токенов пост займёт во входе модели, вместе с XML-обёрткой и разделителем."""
+    return estimate_tokens(format_post(post)) + 1
+
+
+def truncate_post(post, max_tokens: int):
+    """Обрезает текст поста по границе слова так, чтобы он занимал не больше max_tokens.
+
+    Возвращает исходный кортеж, если пост и так помещается, иначе копию с укороченным текстом.
+    """
+    tokens = post_tokens(post)
+    if tokens <= max_tokens:
+        return post
+    text = post[1] or ""
+    while tokens > max_tokens and text:
+        # Оценка почти линейна по длине текста: режем пропорционально и чуть с запасом
+        keep = int(len(text) * max_tokens / tokens * 0.95)
+        text = text[:keep].rsplit(None, 1)[0] if " " in text[:keep] else text[:keep]
+        post = (post[0], text + _TRUNCATION_MARK, *post[2:])
+        tokens = post_tokens(post)
+    return post
+
+
+class BatchPacker:
+    """Набирает пачки постов по бюджету токенов вместо фиксированного числа постов.
+
+    Бюджет — SUMMARY_BATCH_TOKENS на весь вход запроса, включая SUMMARY_PROMPT;
+    пост длиннее POST_MAX_TOKENS обрезается. Посты идут в пачки в порядке добавления.
+    """
+
+    def __init__(self, budget: int = None, max_post_tokens: int = None):
+        budget = budget or config.SUMMARY_BATCH_TOKENS
+        # Сколько бюджета остаётся на посты после инструкций и заголовка запроса
+        overhead = estimate_tokens(build_input_text(config.SUMMARY_PROMPT or "", ""))
+        self.budget = max(1, budget - overhead)
+        self.max_post_tokens = min(max_post_tokens or config.POST_MAX_TOKENS, self.budget)
+        self.truncated = 0
+        self._batch = []
+        self._tokens = 0
+
+    def add(self, post):
+        """Добавляет пост. Возвращает готовую пачку, если пост в текущую уже не поместился, иначе None."""
+        fitted = truncate_post(post, self.max_post_tokens)
+        if fitted is not post:
+            self.truncated += 1
+        tokens = post_tokens(fitted)
+        ready = None
+        if self._batch and self._tokens + tokens > self.budget:
+            ready = self.flush()
+        self._batch.append(fitted)
+        self._tokens += tokens
+        return ready
+
+    def flush(self):
+        """Возвращает неполную текущую пачку (или None, если она пуста)."""
+        if not self._batch:
+            return None
+        batch, self._batch, self._tokens = self._batch, [], 0
+        return batch
+
+
+def batch_tokens(posts: list) -> int:
+    """Оценка токенов пачки постов во входе модели (без инструкций)."""
+    return sum(post_tokens(post) for post in posts)
@@ -0,0 +1,119 @@
+import re
+from collections import Counter
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from . import config, database
+from .tokens import estimate_tokens
+
+# Сколько последних постов канала смотрим, чтобы найти его постоянную подпись
+_FOOTER_SAMPLE = 50
+# Минимум постов в выборке и доля постов, заканчивающихся одной и той же строкой
+_FOOTER_MIN_POSTS = 5
+_FOOTER_MIN_SHARE = 0.3
+# Сколько последних непустых строк поста считаются кандидатами в подпись
+_FOOTER_LINES = 3
+
+_MARKDOWN_LINK = re.compile(r"\[([^\]]*)\]\((\S+?)\)")
+_URL = re.compile(r"https?://[^\s)\]>]+", re.IGNORECASE)
+# Параметры ссылок, которые нужны только для аналитики
+_TRACKING_PARAMS = re.compile(r"^(utm_\w+|fbclid|gclid|yclid|ref|ref_src|si|igshid)$", re.IGNORECASE)
+_EMOJI = "[\U0001F000-\U0001FAFF\u2600-\u27BF\u2B00-\u2BFF]"
+# Эмодзи может состоять из нескольких символов: вариационный селектор и ZWJ-склейка
+_EMOJI_RUN = re.compile(f"({_EMOJI}[\ufe0f\u200d]*)(?:\\s*{_EMOJI}[\ufe0f\u200d]*)+")
+_HASHTAG_LINE = re.compile(r"^(?:\s*#[\w-]+)+\s*$", re.UNICODE)
+_HASHTAG_RUN = re.compile(r"(?:#[\w-]+\s+){2,}#[\w-]+", re.UNICODE)
+_SPACES = re.compile(r"[ \t\u00a0]+")
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+
+def _clean_url(url: str) -> str:
+    """Убирает из ссылки трекинговые параметры (utm_*, fbclid и т. п.); остальное не трогает."""
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url
+    params = parse_qsl(parts.query, keep_blank_values=True)
+    query = [(k, v) for k, v in params if not _TRACKING_PARAMS.match(k)]
+    if len(query) == len(params):
+        return url
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), parts.fragment))
+
+
+def _markdown_link(match: re.Match) -> str:
+    text, url = match.group(1).strip(), match.group(2)
+    # Ссылку оставляем: модель переносит её в статью; убираем только разметку
+    return url if not text or text == url else f"{text} ({url})"
+
+
+def _line_key(line: str) -> str:
+    return " ".join(line.split())
+
+
+def _last_lines(text: str) -> list:
+    lines = [_line_key(line) for line in (text or "").splitlines()]
+    return [line for line in lines if line][-_FOOTER_LINES:]
+
+
+def learn_footers(texts: list) -> set:
+    """Строки, которыми заканчивается заметная доля постов канала (подпись, призыв подписаться)."""
+    if len(texts) < _FOOTER_MIN_POSTS:
+        return set()
+    # Сравниваем строки уже сжатых текстов: подпись снимается с результата compact_text
+    counts = Counter(line for text in texts for line in set(_last_lines(compact_text(text))))
+    threshold = max(_FOOTER_MIN_POSTS, _FOOTER_MIN_SHARE * len(texts))
+    return {line for line, count in counts.items() if count >= threshold}
+
+
+def compact_text(text: str, footers: set = frozenset()) -> str:
+    """Детерминированно сжимает текст поста без потери содержания:
+    markdown-ссылки → «текст (url)», ссылки без трекинговых параметров, серии эмодзи → одно эмодзи,
+    без блоков хэштегов и подписей канала в конце, без лишних пробелов и пустых строк.
+    """
+    if not text:
+        return text
+    text = _MARKDOWN_LINK.sub(_markdown_link, text)
+    text = _URL.sub(lambda m: _clean_url(m.group(0)), text)
+    text = _EMOJI_RUN.sub(r"\1", text)
+    text = _HASHTAG_RUN.sub("", text)
+
+    lines = [_SPACES.sub(" ", line).strip() for line in text.splitlines()]
+    # Снимаем с конца подписи канала, строки из одних хэштегов и пустые строки
+    while lines and (not lines[-1] or _HASHTAG_LINE.match(lines[-1]) or _line_key(lines[-1]) in footers):
+        lines.pop()
+    compacted = _BLANK_LINES.sub("\n\n", "\n".join(lines)).strip()
+    # Пост из одной подписи или хэштегов оставляем как есть — пусть его оценивает модель
+    return compacted or text.strip()
+
+
+class Compactor:
+    """Сжатие постов перед упаковкой в пачки. Подписи каналов выучиваются по их
+    последним постам в базе (один раз на канал), счётчики токенов копятся за весь запуск.
+    """
+
+    def __init__(self):
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self._footers = {}
+
+    def _channel_footers(self, channel: str) -> set:
+        if not channel:
+            return set()
+        if channel not in self._footers:
+            self._footers[channel] = learn_footers(database.get_recent_channel_texts(channel, _FOOTER_SAMPLE))
+        return self._footers[channel]
+
+    def compact(self, post):
+        """Возвращает пост (кортеж полей _POST_FIELDS) со сжатым текстом."""
+        if not config.COMPACTION_ENABLED:
+            return post
+        text = post[1]
+        channel = post[4] if len(post) > 4 else None
+        compacted = compact_text(text, self._channel_footers(channel))
+        self.tokens_before += estimate_tokens(text)
+        self.tokens_after += estimate_tokens(compacted)
+        if compacted == text:
+            return post
+        return (post[0], compacted, *post[2:])
+
+    @property
+    def saved_tokens(self) -> int:
+        return self.tokens_before - self.tokens_after
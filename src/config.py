@@ -11,11 +11,71 @@ OPENAI_API_KEY = None
 TELEGRAM_CHANNELS = []
 ARTICLE_PROMPT = ""
 SUMMARY_PROMPT = ""  # Промпт для коротких саммари
+REDUCE_PROMPT = ""  # Промпт свёртки саммари пачек в промежуточный дайджест
 DB_NAME = None
 SCHEDULE_DAY_OF_WEEK = None
 SCHEDULE_HOUR = None
 SCHEDULE_MINUTE = None
 TELEGRAM_PARSE_LIMIT = None  # Новая переменная
+TELEGRAM_PARSE_CONCURRENCY = 4  # Сколько каналов парсим одновременно
+TELEGRAM_FLOOD_RETRIES = 3  # Сколько раз повторяем канал после FloodWait
+TELEGRAM_INCREMENTAL_MAX = 1000  # Потолок новых постов на канал за один инкрементальный проход
+TELEGRAM_ENTITY_CACHE_TTL_HOURS = 168  # Сколько часов доверяем кэшу разрешённых каналов
+DIGEST_STREAMING = True  # Суммаризация пачек параллельно с парсингом
+DIGEST_RESUME = True  # Продолжать прерванный запуск дайджеста с незавершённого этапа
+SUMMARY_CONCURRENCY = 4  # Сколько пачек суммаризуется в OpenAI одновременно
+SUMMARY_BATCH_TOKENS = 12000  # Бюджет входных токенов одного запроса с SUMMARY_PROMPT
+POST_MAX_TOKENS = 1500  # Посты длиннее обрезаются
+COMPACTION_ENABLED = True  # Сжимать текст постов перед отправкой в OpenAI
+PREFILTER_ENABLED = False  # Отсеивать явный шум (рекламу, розыгрыши, пустые посты) до OpenAI
+PREFILTER_THRESHOLD = 0.0  # Посты с оценкой ниже порога пропускаются
+PREFILTER_MIN_WORDS = 5  # Пост короче считается пустым (картинка, стикер, пара эмодзи)
+PREFILTER_MODEL_PATH = None  # Файл локального классификатора (см. prefilter-train)
+RANKING_ENABLED = False  # Отправлять в OpenAI только самые значимые посты по вовлечённости
+RANKING_TOP_K = 0  # Не больше K постов за запуск (0 = без ограничения)
+RANKING_TOP_PERCENT = 0.0  # Не больше этой доли постов, % (0 = без ограничения)
+RANKING_TOKEN_BUDGET = 0  # Не больше стольких токенов текста постов (0 = без ограничения)
+RANKING_REFRESH = True  # Перед ранжированием обновлять просмотры и реакции из Telegram
+METRICS_ENABLED = True  # Сохранять метрики запусков в таблицу metrics
+METRICS_PORT = 0  # Порт HTTP-эндпоинта /metrics в формате Prometheus (0 = выключен)
+METRICS_HOST = "127.0.0.1"
+ARTICLE_INPUT_TOKENS = 30000  # Больше этого саммари пачек сворачиваются перед ARTICLE_PROMPT (0 = не сворачивать)
+OPENAI_TIMEOUT_SECONDS = 600  # Таймаут запроса к OpenAI
+OPENAI_CONNECT_TIMEOUT_SECONDS = 10  # Таймаут установки соединения
+OPENAI_KEEPALIVE_SECONDS = 120  # Сколько держать простаивающее соединение в пуле
+OPENAI_STREAMING = True  # Читать ответы OpenAI потоком
+OPENAI_IDLE_TIMEOUT_SECONDS = 90  # Сколько ждать следующего фрагмента потока
+OPENAI_END_MARKER = ""  # Строка, после которой ответ считается законченным (пусто — ждём конца потока)
+OPENAI_BATCH_MODE = False  # Отправлять пачки SUMMARY_PROMPT заранее через Batch API
+OPENAI_BATCH_DAY_OF_WEEK = "*"  # Когда отправлять накопившиеся пачки (по умолчанию каждый день)
+OPENAI_BATCH_HOUR = 3
+OPENAI_BATCH_MINUTE = 0
+OPENAI_BATCH_POLL_MINUTES = 15  # Как часто проверять готовность заданий
+OPENAI_BATCH_DIR = "openai_batches"  # Куда складывать JSONL-файлы заданий
+# Лимиты запросов в минуту для внешних сервисов (см. rate_limiter.py)
+RATE_LIMIT_TELEGRAM_RPM = 120
+RATE_LIMIT_BOT_API_RPM = 60
+RATE_LIMIT_OPENAI_RPM = 60
+RATE_LIMIT_TELEGRAPH_RPM = 30
+RATE_LIMIT_BURST = 5
+SQLITE_CACHE_MB = 64  # Размер страничного кэша SQLite
+SQLITE_MMAP_MB = 256  # Сколько файла базы отображать в память
+SQLITE_BUSY_TIMEOUT_MS = 5000  # Сколько ждать освобождения блокировки записи
+DIGEST_WINDOW_DAYS = 0  # Окно дайджеста в днях (0 = все необработанные посты)
+RETENTION_DAYS = 0  # Через сколько дней обработанные посты уходят в архив (0 = хранить вечно)
+ARCHIVE_DB_NAME = None  # Файл архива; пусто — архив не ведётся, старые посты удаляются
+MAINTENANCE_DAY_OF_WEEK = "sun"
+MAINTENANCE_HOUR = 4
+MAINTENANCE_MINUTE = 0
+DEDUP_ENABLED = True  # Схлопывать копии и почти-дубликаты постов при сохранении
+DEDUP_WINDOW_DAYS = 7  # С постами какой давности сравниваем
+DEDUP_MAX_DISTANCE = 5  # Порог расстояния Хэмминга между SimHash
+DEDUP_MIN_WORDS = 8  # Посты короче этого (без учёта ссылок) не схлопываем
+LLM_CACHE_ENABLED = True  # Кэшировать ответы OpenAI по содержимому запроса
+LLM_CACHE_BYPASS = False  # Не читать кэш (ответы всё равно сохраняются)
+LLM_CACHE_PATH = "llm_cache.db"  # Общий для всех ботов файл кэша
+LLM_CACHE_MAX_MB = 200
+LLM_CACHE_MAX_AGE_DAYS = 30
 OFFICIAL_CHANNELS = []  # Имена телеграм-каналов (username) официальных источников
 ENABLE_TOC = True
 NAVIGATION_TITLE = "🧭 Навигация"
@@ -38,6 +98,18 @@ def load_config(config_path: str):
 
     # Используем global, чтобы изменить переменные на уровне модуля
     global API_ID, API_HASH, BOT_TOKEN, TELEGRAM_RECIPIENTS, OPENAI_API_KEY, TELEGRAM_CHANNELS, ARTICLE_PROMPT, SUMMARY_PROMPT, DB_NAME, SCHEDULE_DAY_OF_WEEK, SCHEDULE_HOUR, SCHEDULE_MINUTE, TELEGRAM_PARSE_LIMIT, OFFICIAL_CHANNELS, ENABLE_TOC, NAVIGATION_TITLE, NAVIGATION_STYLE, ENABLE_SECTION_SPLIT, OFFICIAL_SECTION_TITLE, OTHER_SECTION_TITLE, TELEGRAPH_ACCESS_TOKEN, TELEGRAPH_AUTHOR_NAME, TELEGRAPH_AUTHOR_URL, DIGEST_NAME
+    global TELEGRAM_PARSE_CONCURRENCY, TELEGRAM_FLOOD_RETRIES, TELEGRAM_INCREMENTAL_MAX, TELEGRAM_ENTITY_CACHE_TTL_HOURS, DIGEST_STREAMING, DIGEST_RESUME, SUMMARY_CONCURRENCY
+    global PREFILTER_ENABLED, PREFILTER_THRESHOLD, PREFILTER_MIN_WORDS, PREFILTER_MODEL_PATH
+    global RANKING_ENABLED, RANKING_TOP_K, RANKING_TOP_PERCENT, RANKING_TOKEN_BUDGET, RANKING_REFRESH
+    global METRICS_ENABLED, METRICS_PORT, METRICS_HOST
+    global SUMMARY_BATCH_TOKENS, POST_MAX_TOKENS, COMPACTION_ENABLED, REDUCE_PROMPT, ARTICLE_INPUT_TOKENS, OPENAI_TIMEOUT_SECONDS, OPENAI_CONNECT_TIMEOUT_SECONDS, OPENAI_KEEPALIVE_SECONDS
+    global OPENAI_STREAMING, OPENAI_IDLE_TIMEOUT_SECONDS, OPENAI_END_MARKER
+    global OPENAI_BATCH_MODE, OPENAI_BATCH_DAY_OF_WEEK, OPENAI_BATCH_HOUR, OPENAI_BATCH_MINUTE, OPENAI_BATCH_POLL_MINUTES, OPENAI_BATCH_DIR
+    global RATE_LIMIT_TELEGRAM_RPM, RATE_LIMIT_BOT_API_RPM, RATE_LIMIT_OPENAI_RPM, RATE_LIMIT_TELEGRAPH_RPM, RATE_LIMIT_BURST
+    global SQLITE_CACHE_MB, SQLITE_MMAP_MB, SQLITE_BUSY_TIMEOUT_MS, DIGEST_WINDOW_DAYS
+    global RETENTION_DAYS, ARCHIVE_DB_NAME, MAINTENANCE_DAY_OF_WEEK, MAINTENANCE_HOUR, MAINTENANCE_MINUTE
+    global DEDUP_ENABLED, DEDUP_WINDOW_DAYS, DEDUP_MAX_DISTANCE, DEDUP_MIN_WORDS
+    global LLM_CACHE_ENABLED, LLM_CACHE_BYPASS, LLM_CACHE_PATH, LLM_CACHE_MAX_MB, LLM_CACHE_MAX_AGE_DAYS
 
     # Telegram User API
     API_ID = int(os.getenv("API_ID"))
@@ -63,6 +135,8 @@ def load_config(config_path: str):
     # Промпты
     ARTICLE_PROMPT = os.getenv("ARTICLE_PROMPT")
     SUMMARY_PROMPT = os.getenv("SUMMARY_PROMPT")
+    # По умолчанию свёртка использует SUMMARY_PROMPT: он и так отбирает главное из набора постов
+    REDUCE_PROMPT = os.getenv("REDUCE_PROMPT") or SUMMARY_PROMPT
 
     # Имя файла базы данных
     DB_NAME = os.getenv("DB_NAME", "news.db")
@@ -75,6 +149,101 @@ def load_config(config_path: str):
     # Лимит парсинга Telegram
     TELEGRAM_PARSE_LIMIT = int(os.getenv("TELEGRAM_PARSE_LIMIT", 30))  # По умолчанию 30
 
+    # Параллельный парсинг: число одновременно обрабатываемых каналов (1 = последовательно)
+    TELEGRAM_PARSE_CONCURRENCY = max(1, int(os.getenv("TELEGRAM_PARSE_CONCURRENCY", 4)))
+    # Повторы канала после FloodWait (ожидание берётся из ответа Telegram)
+    TELEGRAM_FLOOD_RETRIES = max(0, int(os.getenv("TELEGRAM_FLOOD_RETRIES", 3)))
+    # Инкрементальный парсинг: сколько максимум новых постов забирать с канала (0 = без ограничения)
+    TELEGRAM_INCREMENTAL_MAX = max(0, int(os.getenv("TELEGRAM_INCREMENTAL_MAX", 1000)))
+    # Время жизни кэша каналов (id, access_hash) в часах (0 = всегда вызывать get_entity)
+    TELEGRAM_ENTITY_CACHE_TTL_HOURS = max(0, int(os.getenv("TELEGRAM_ENTITY_CACHE_TTL_HOURS", 168)))
+
+    # Потоковый режим: пачки отправляются в OpenAI, пока остальные каналы ещё парсятся
+    DIGEST_STREAMING = os.getenv("DIGEST_STREAMING", "true").strip().lower() in ("1", "true", "yes")
+    # Продолжать незавершённый запуск дайджеста (готовые саммари пачек берутся из журнала)
+    DIGEST_RESUME = os.getenv("DIGEST_RESUME", "true").strip().lower() in ("1", "true", "yes")
+    # Сколько пачек одновременно отправляется в OpenAI (частоту запросов ограничивает RATE_LIMIT_OPENAI_RPM)
+    SUMMARY_CONCURRENCY = max(1, int(os.getenv("SUMMARY_CONCURRENCY", 4)))
+    # Пачки набираются по оценке токенов (вместе с XML-обёрткой и промптом), а не по числу постов
+    SUMMARY_BATCH_TOKENS = max(1000, int(os.getenv("SUMMARY_BATCH_TOKENS", 12000)))
+    POST_MAX_TOKENS = max(100, int(os.getenv("POST_MAX_TOKENS", 1500)))
+    # Сжатие текста постов (разметка ссылок, трекинговые параметры, эмодзи, хэштеги, подписи каналов)
+    COMPACTION_ENABLED = os.getenv("COMPACTION_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+    # Локальный предфильтр: правила, выученные шаблоны каналов и (если обучен) линейный классификатор
+    PREFILTER_ENABLED = os.getenv("PREFILTER_ENABLED", "false").strip().lower() in ("1", "true", "yes")
+    PREFILTER_THRESHOLD = float(os.getenv("PREFILTER_THRESHOLD", 0))
+    PREFILTER_MIN_WORDS = max(0, int(os.getenv("PREFILTER_MIN_WORDS", 5)))
+    # Ранжирование по вовлечённости: жёсткий потолок числа постов (и токенов) на запуск дайджеста
+    RANKING_ENABLED = os.getenv("RANKING_ENABLED", "false").strip().lower() in ("1", "true", "yes")
+    RANKING_TOP_K = max(0, int(os.getenv("RANKING_TOP_K", 0)))
+    RANKING_TOP_PERCENT = min(100.0, max(0.0, float(os.getenv("RANKING_TOP_PERCENT", 0))))
+    RANKING_TOKEN_BUDGET = max(0, int(os.getenv("RANKING_TOKEN_BUDGET", 0)))
+    RANKING_REFRESH = os.getenv("RANKING_REFRESH", "true").strip().lower() in ("1", "true", "yes")
+    # Метрики: таблица metrics в базе бота и (по желанию) локальный эндпоинт для Prometheus
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+    METRICS_PORT = max(0, int(os.getenv("METRICS_PORT", 0)))
+    METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1").strip() or "127.0.0.1"
+    # Бюджет входа финального запроса: если саммари пачек больше, они сворачиваются по уровням
+    ARTICLE_INPUT_TOKENS = max(0, int(os.getenv("ARTICLE_INPUT_TOKENS", 30000)))
+    # Общий HTTP-пул клиента OpenAI: таймауты запроса и соединения, время жизни простаивающих соединений
+    OPENAI_TIMEOUT_SECONDS = max(1.0, float(os.getenv("OPENAI_TIMEOUT_SECONDS", 600)))
+    OPENAI_CONNECT_TIMEOUT_SECONDS = max(1.0, float(os.getenv("OPENAI_CONNECT_TIMEOUT_SECONDS", 10)))
+    OPENAI_KEEPALIVE_SECONDS = max(0.0, float(os.getenv("OPENAI_KEEPALIVE_SECONDS", 120)))
+    # Потоковые ответы: таймаут простоя между фрагментами вместо одного общего таймаута
+    OPENAI_STREAMING = os.getenv("OPENAI_STREAMING", "true").strip().lower() in ("1", "true", "yes")
+    OPENAI_IDLE_TIMEOUT_SECONDS = max(1.0, float(os.getenv("OPENAI_IDLE_TIMEOUT_SECONDS", 90)))
+    OPENAI_END_MARKER = os.getenv("OPENAI_END_MARKER", "").strip()
+    # Batch API: пачки SUMMARY_PROMPT уходят одним заданием по расписанию (дешевле и без лимита запросов в минуту),
+    # а готовые саммари забираются опросом; к запуску дайджеста синхронно досчитывается только остаток
+    OPENAI_BATCH_MODE = os.getenv("OPENAI_BATCH_MODE", "false").strip().lower() in ("1", "true", "yes")
+    OPENAI_BATCH_DAY_OF_WEEK = os.getenv("OPENAI_BATCH_DAY_OF_WEEK", "*").strip() or "*"
+    OPENAI_BATCH_HOUR = int(os.getenv("OPENAI_BATCH_HOUR", 3))
+    OPENAI_BATCH_MINUTE = int(os.getenv("OPENAI_BATCH_MINUTE", 0))
+    OPENAI_BATCH_POLL_MINUTES = max(1, int(os.getenv("OPENAI_BATCH_POLL_MINUTES", 15)))
+    OPENAI_BATCH_DIR = os.getenv("OPENAI_BATCH_DIR", "openai_batches").strip() or "openai_batches"
+
+    # Ограничение частоты запросов (запросов в минуту) для каждого внешнего сервиса
+    RATE_LIMIT_TELEGRAM_RPM = max(1, int(os.getenv("RATE_LIMIT_TELEGRAM_RPM", 120)))
+    RATE_LIMIT_BOT_API_RPM = max(1, int(os.getenv("RATE_LIMIT_BOT_API_RPM", 60)))
+    RATE_LIMIT_OPENAI_RPM = max(1, int(os.getenv("RATE_LIMIT_OPENAI_RPM", 60)))
+    RATE_LIMIT_TELEGRAPH_RPM = max(1, int(os.getenv("RATE_LIMIT_TELEGRAPH_RPM", 30)))
+    # Сколько запросов можно сделать подряд без ожидания
+    RATE_LIMIT_BURST = max(1, int(os.getenv("RATE_LIMIT_BURST", 5)))
+
+    # Настройки SQLite: страничный кэш и mmap в мегабайтах, ожидание блокировки в мс
+    SQLITE_CACHE_MB = max(1, int(os.getenv("SQLITE_CACHE_MB", 64)))
+    SQLITE_MMAP_MB = max(0, int(os.getenv("SQLITE_MMAP_MB", 256)))
+    SQLITE_BUSY_TIMEOUT_MS = max(0, int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000)))
+
+    # В дайджест попадают только посты за последние N дней (0 = без ограничения)
+    DIGEST_WINDOW_DAYS = max(0, int(os.getenv("DIGEST_WINDOW_DAYS", 0)))
+
+    # Хранение: обработанные посты старше RETENTION_DAYS переносятся в архив (или удаляются)
+    RETENTION_DAYS = max(0, int(os.getenv("RETENTION_DAYS", 0)))
+    # По умолчанию архив лежит рядом с базой: news.db -> news_archive.db
+    default_archive = f"{os.path.splitext(DB_NAME)[0]}_archive.db"
+    ARCHIVE_DB_NAME = os.getenv("ARCHIVE_DB_NAME", default_archive).strip() or None
+    # Классификатор предфильтра тоже лежит рядом с базой: news.db -> news_prefilter.json
+    PREFILTER_MODEL_PATH = os.getenv("PREFILTER_MODEL_PATH", "").strip() or f"{os.path.splitext(DB_NAME)[0]}_prefilter.json"
+    # Расписание обслуживания базы (архив, VACUUM)
+    MAINTENANCE_DAY_OF_WEEK = os.getenv("MAINTENANCE_DAY_OF_WEEK", "sun")
+    MAINTENANCE_HOUR = int(os.getenv("MAINTENANCE_HOUR", 4))
+    MAINTENANCE_MINUTE = int(os.getenv("MAINTENANCE_MINUTE", 0))
+
+    # Поиск дубликатов при сохранении постов: точные копии по хэшу, почти-дубликаты по SimHash
+    DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+    DEDUP_WINDOW_DAYS = max(0, int(os.getenv("DEDUP_WINDOW_DAYS", 7)))
+    # Больше 5 не рекомендуется: поиск по 6 полосам SimHash гарантированно находит только расстояния до 5
+    DEDUP_MAX_DISTANCE = max(0, int(os.getenv("DEDUP_MAX_DISTANCE", 5)))
+    DEDUP_MIN_WORDS = max(1, int(os.getenv("DEDUP_MIN_WORDS", 8)))
+
+    # Кэш ответов OpenAI: одинаковые запросы (повторные запуски, общие каналы у разных ботов) не оплачиваются заново
+    LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+    LLM_CACHE_BYPASS = os.getenv("LLM_CACHE_BYPASS", "false").strip().lower() in ("1", "true", "yes")
+    LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.db").strip() or "llm_cache.db"
+    LLM_CACHE_MAX_MB = max(1, int(os.getenv("LLM_CACHE_MAX_MB", 200)))
+    LLM_CACHE_MAX_AGE_DAYS = max(1, int(os.getenv("LLM_CACHE_MAX_AGE_DAYS", 30)))
+
     # Список официальных каналов (через запятую), например: "ozon,ozonnews,wildberries_official"
     OFFICIAL_CHANNELS = [c.strip() for c in os.getenv("OFFICIAL_CHANNELS", "").split(',') if c.strip()]
 
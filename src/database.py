@@ -1,9 +1,54 @@
+import json
+import os
 import sqlite3
-from . import config
+import zlib
+from . import config, dedupe, metrics, tokens
 
+# Одно соединение на процесс: открывается при первом обращении и живёт до close_db().
+# Все вызовы идут из одного цикла событий asyncio, поэтому блокировка не нужна.
+_conn = None
+_conn_path = None
+
+def _get_connection() -> sqlite3.Connection:
+    """Возвращает общее соединение с базой, открывая его и настраивая при первом вызове."""
+    global _conn, _conn_path
+    if _conn is not None and _conn_path == config.DB_NAME:
+        return _conn
+    close_db()
+    # cached_statements: sqlite3 держит скомпилированные запросы в кэше соединения,
+    # поэтому повторные вызовы функций модуля не разбирают SQL заново
+    conn = sqlite3.connect(config.DB_NAME, cached_statements=256, check_same_thread=False)
+    # Для новой базы включаем инкрементальный VACUUM; должно идти до переключения в WAL.
+    # Существующая база переводится в этот режим в maintenance.run_maintenance()
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    # WAL: парсер может писать, пока задача дайджеста читает, без "database is locked"
+    conn.execute("PRAGMA journal_mode=WAL")
+    # В режиме WAL NORMAL безопасен и не делает fsync на каждый коммит
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA cache_size={-config.SQLITE_CACHE_MB * 1024}")  # отрицательное значение — в КиБ
+    conn.execute(f"PRAGMA mmap_size={config.SQLITE_MMAP_MB * 1024 * 1024}")
+    conn.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}")
+    _conn, _conn_path = conn, config.DB_NAME
+    return conn
+
+def close_db():
+    """Закрывает общее соединение (например, при завершении процесса)."""
+    global _conn, _conn_path
+    if _conn is not None:
+        _conn.close()
+    _conn, _conn_path = None, None
+
+def _ensure_column(cursor: sqlite3.Cursor, table: str, column: str, declaration: str):
+    """Добавляет колонку в существующую таблицу, если её ещё нет (простая миграция)."""
+    columns = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+@metrics.timed("sqlite_query_seconds")
 def init_db():
     """Инициализирует базу данных и создает таблицу для постов."""
-    conn = sqlite3.connect(config.DB_NAME)
+    conn = _get_connection()
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS posts (
@@ -23,44 +68,902 @@ def init_db():
         CREATE INDEX IF NOT EXISTS idx_posts_processed_date
         ON posts(is_processed, date DESC)
     ''')
+    # Состояние инкрементального парсинга: последний увиденный пост в каждом канале
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS channel_state (
+            channel TEXT PRIMARY KEY,
+            last_message_id INTEGER NOT NULL,
+            last_date INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    ''')
+    # Кэш разрешённых каналов, чтобы не вызывать get_entity на каждом запуске
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS channel_entities (
+            channel TEXT PRIMARY KEY,
+            peer_id INTEGER NOT NULL,
+            access_hash INTEGER NOT NULL,
+            username TEXT,
+            title TEXT,
+            resolved_at INTEGER NOT NULL
+        )
+    ''')
+    # Поля для поиска дубликатов: хэш нормализованного текста, SimHash и ссылка на канонический пост
+    _ensure_column(cursor, "posts", "content_hash", "TEXT")
+    _ensure_column(cursor, "posts", "simhash", "INTEGER")
+    _ensure_column(cursor, "posts", "canonical_id", "INTEGER")
+    # Причина, по которой предфильтр не пустил пост в OpenAI (пост при этом отмечается обработанным)
+    _ensure_column(cursor, "posts", "skip_reason", "TEXT")
+    # Вовлечённость из Telegram (просмотры, репосты, реакции) для ранжирования постов; NULL — неизвестно
+    _ensure_column(cursor, "posts", "views", "INTEGER")
+    _ensure_column(cursor, "posts", "forwards", "INTEGER")
+    _ensure_column(cursor, "posts", "reactions", "INTEGER")
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_posts_content_hash
+        ON posts(content_hash) WHERE content_hash IS NOT NULL
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_posts_canonical
+        ON posts(canonical_id) WHERE canonical_id IS NOT NULL
+    ''')
+    # Полосы SimHash канонических постов: по ним ищутся кандидаты в почти-дубликаты
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS post_fingerprints (
+            band INTEGER NOT NULL,
+            value INTEGER NOT NULL,
+            post_id INTEGER NOT NULL,
+            PRIMARY KEY (band, value, post_id)
+        ) WITHOUT ROWID
+    ''')
+    # Журнал запусков дайджеста: до какого этапа дошёл запуск и его промежуточные результаты
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS digest_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            stage TEXT NOT NULL,
+            started_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL,
+            article_html TEXT,
+            summary TEXT,
+            article_url TEXT
+        )
+    ''')
+    # Саммари пачек: записываются сразу после ответа OpenAI, чтобы не платить за них повторно
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS batch_summaries (
+            run_id INTEGER NOT NULL,
+            batch_num INTEGER NOT NULL,
+            post_ids TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            PRIMARY KEY (run_id, batch_num)
+        )
+    ''')
+    # Посты, отсеянные ранжированием: отмечаются обработанными, только когда запуск завершён
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS run_skipped_posts (
+            run_id INTEGER NOT NULL,
+            post_id INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            PRIMARY KEY (run_id, post_id)
+        ) WITHOUT ROWID
+    ''')
+    # Задания Batch API и пачки в них: саммари пачки попадает в batch_summaries, когда задание готово
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS openai_batches (
+            id TEXT PRIMARY KEY,
+            run_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            input_path TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS openai_batch_requests (
+            batch_id TEXT NOT NULL,
+            custom_id TEXT NOT NULL,
+            run_id INTEGER NOT NULL,
+            batch_num INTEGER NOT NULL,
+            post_ids TEXT NOT NULL,
+            cache_key TEXT NOT NULL,
+            PRIMARY KEY (batch_id, custom_id)
+        )
+    ''')
+    # Метрики запусков (см. metrics.drain): kind='call' — отдельный вызов внешнего API,
+    # kind='total' — прирост сводки или счётчика за время между сбросами
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS metrics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at INTEGER NOT NULL,
+            run_id INTEGER,
+            kind TEXT NOT NULL,
+            name TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            value REAL NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_metrics_run ON metrics(run_id, name)")
+    # Полнотекстовый индекс по тексту постов (FTS5, внешний контент — таблица posts)
+    fts_exists = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'posts_fts'"
+    ).fetchone()
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+            text,
+            content='posts',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    # Триггеры держат индекс в синхронизации с posts.text
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN
+            INSERT INTO posts_fts(rowid, text) VALUES (new.id, new.text);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN
+            INSERT INTO posts_fts(posts_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF text ON posts BEGIN
+            INSERT INTO posts_fts(posts_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            INSERT INTO posts_fts(rowid, text) VALUES (new.id, new.text);
+        END
+    ''')
+    if not fts_exists:
+        # Индекс появился в уже существующей базе — проиндексируем накопленные посты
+        cursor.execute("INSERT INTO posts_fts(posts_fts) VALUES ('rebuild')")
     conn.commit()
-    conn.close()
 
 def add_post(channel: str, message_id: int, text: str, date: int, source_link: str, has_media: bool = False):
     """Добавляет новый пост в базу данных, избегая дубликатов."""
-    conn = sqlite3.connect(config.DB_NAME)
+    add_posts([(channel, message_id, text, date, source_link, has_media)])
+
+@metrics.timed("sqlite_query_seconds")
+def add_posts(rows: list) -> int:
+    """Добавляет пачку постов одной транзакцией, дубликаты пропускаются.
+
+    Каждая строка: (channel, message_id, text, date, source_link, has_media)
+    и, если известны, ещё (views, forwards, reactions).
+    Для новых постов сразу ищутся копии и почти-дубликаты (см. _link_duplicates).
+    Возвращает количество реально вставленных постов.
+    """
+    if not rows:
+        return 0
+    prepared = []
+    for channel, message_id, text, date, source_link, has_media, *engagement in rows:
+        fingerprint = _fingerprint(text)
+        views, forwards, reactions = (*engagement, None, None, None)[:3]
+        prepared.append((channel, message_id, text, date, source_link, has_media, *fingerprint, views, forwards, reactions))
+    conn = _get_connection()
+    with conn:
+        # id растут монотонно (AUTOINCREMENT), поэтому новые посты — это id больше текущего максимума
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM posts").fetchone()[0]
+        # rowcount не учитывает изменения, сделанные триггерами (индекс FTS)
+        cursor = conn.executemany(
+            "INSERT OR IGNORE INTO posts (channel, message_id, text, date, source_link, has_media, content_hash, simhash, "
+            "views, forwards, reactions) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            prepared
+        )
+        inserted = cursor.rowcount
+        if config.DEDUP_ENABLED and inserted:
+            new_posts = conn.execute(
+                "SELECT id, channel, date, content_hash, simhash FROM posts WHERE id > ? AND content_hash IS NOT NULL ORDER BY id",
+                (last_id,)
+            ).fetchall()
+            _link_duplicates(conn, new_posts)
+    return inserted
+
+def _fingerprint(text: str):
+    """(content_hash, simhash) текста поста; (None, None), если слов без учёта ссылок меньше DEDUP_MIN_WORDS.
+
+    У короткого поста («Вышел GPT-5», «Новая статья: <ссылка>») совпадение текста ещё не значит,
+    что это копия одной новости, поэтому такие посты не схлопываются совсем.
+    """
+    if len(dedupe.normalize(text, links=False).split()) < config.DEDUP_MIN_WORDS:
+        return None, None
+    normalized = dedupe.normalize(text)
+    return dedupe.content_hash(normalized), dedupe.simhash(normalized)
+
+def _link_duplicates(conn: sqlite3.Connection, new_posts: list):
+    """Связывает посты [(id, channel, date, content_hash, simhash), ...] с их каноническими копиями.
+
+    Точная копия ищется по content_hash, почти-дубликат — по совпадению хотя бы
+    одной полосы SimHash и расстоянию Хэмминга не больше DEDUP_MAX_DISTANCE.
+    Сравниваем только с постами других каналов не старше DEDUP_WINDOW_DAYS: похожие
+    посты одного канала — это разные новости (серия анонсов, дайджесты по шаблону). Дубликат получает
+    canonical_id и статус обработки канонического поста; канонический пост
+    записывает свои полосы, чтобы следующие копии могли его найти.
+    """
+    window = config.DEDUP_WINDOW_DAYS * 86400
+    for post_id, channel, date, text_hash, near in new_posts:
+        since = date - window
+        # Канонический пост тоже должен быть из другого канала, а не только найденная копия
+        canonical = conn.execute(
+            "SELECT c.id FROM posts p JOIN posts c ON c.id = COALESCE(p.canonical_id, p.id) "
+            "WHERE p.content_hash = ? AND p.id < ? AND p.date >= ? AND c.channel != ? ORDER BY p.id LIMIT 1",
+            (text_hash, post_id, since, channel)
+        ).fetchone()
+        if canonical is None and near is not None:
+            post_bands = dedupe.bands(near)
+            where = " OR ".join("(f.band = ? AND f.value = ?)" for _ in post_bands)
+            candidates = conn.execute(
+                f"SELECT DISTINCT p.id, p.simhash FROM post_fingerprints f JOIN posts p ON p.id = f.post_id "
+                f"WHERE ({where}) AND p.id < ? AND p.date >= ? AND p.channel != ? ORDER BY p.id",
+                (*[v for pair in post_bands for v in pair], post_id, since, channel)
+            ).fetchall()
+            for candidate_id, candidate_hash in candidates:
+                if dedupe.hamming(near, candidate_hash) <= config.DEDUP_MAX_DISTANCE:
+                    canonical = (candidate_id,)
+                    break
+        if canonical is not None:
+            conn.execute(
+                "UPDATE posts SET canonical_id = ?, is_processed = (SELECT is_processed FROM posts WHERE id = ?) WHERE id = ?",
+                (canonical[0], canonical[0], post_id)
+            )
+        elif near is not None:
+            conn.executemany(
+                "INSERT OR IGNORE INTO post_fingerprints (band, value, post_id) VALUES (?, ?, ?)",
+                [(band, value, post_id) for band, value in dedupe.bands(near)]
+            )
+
+@metrics.timed("sqlite_query_seconds")
+def backfill_fingerprints(since: int = 0) -> int:
+    """Считает отпечатки для старых постов (сохранённых до появления дедупликации) и связывает дубликаты."""
+    conn = _get_connection()
+    rows = conn.execute(
+        "SELECT id, channel, date, text FROM posts WHERE content_hash IS NULL AND date >= ? ORDER BY id",
+        (since,)
+    ).fetchall()
+    posts = []
+    with conn:
+        for post_id, channel, date, text in rows:
+            text_hash, near = _fingerprint(text)
+            if text_hash is None:
+                continue
+            conn.execute("UPDATE posts SET content_hash = ?, simhash = ? WHERE id = ?", (text_hash, near, post_id))
+            posts.append((post_id, channel, date, text_hash, near))
+        _link_duplicates(conn, posts)
+    return len(posts)
+
+@metrics.timed("sqlite_query_seconds")
+def get_duplicate_stats(since: int = 0):
+    """Сколько необработанных дубликатов схлопнуто и сколько токенов они заняли бы в запросах.
+
+    Возвращает (количество, оценка токенов).
+    """
+    conn = _get_connection()
+    cursor = conn.execute(
+        "SELECT text FROM posts WHERE is_processed = 0 AND canonical_id IS NOT NULL AND date >= ?",
+        (since,)
+    )
+    count, total = 0, 0
+    for (text,) in cursor:
+        count += 1
+        total += tokens.estimate_tokens(text)
+    return count, total
+
+@metrics.timed("sqlite_query_seconds")
+def get_channel_state(channel: str):
+    """Возвращает (last_message_id, last_date) для канала или None, если канал ещё не парсился."""
+    conn = _get_connection()
     cursor = conn.cursor()
-    try:
-        cursor.execute("INSERT INTO posts (channel, message_id, text, date, source_link, has_media) VALUES (?, ?, ?, ?, ?, ?)",
-                       (channel, message_id, text, date, source_link, has_media))
-        conn.commit()
-    except sqlite3.IntegrityError:
-        # Пост уже существует
-        pass
-    finally:
-        conn.close()
+    cursor.execute("SELECT last_message_id, last_date FROM channel_state WHERE channel = ?", (channel,))
+    return cursor.fetchone()
+
+@metrics.timed("sqlite_query_seconds")
+def update_channel_state(channel: str, last_message_id: int, last_date: int):
+    """Сохраняет последний увиденный пост канала. Отметка никогда не сдвигается назад."""
+    conn = _get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        INSERT INTO channel_state (channel, last_message_id, last_date, updated_at)
+        VALUES (?, ?, ?, strftime('%s', 'now'))
+        ON CONFLICT(channel) DO UPDATE SET
+            last_message_id = MAX(last_message_id, excluded.last_message_id),
+            last_date = MAX(last_date, excluded.last_date),
+            updated_at = excluded.updated_at
+        """,
+        (channel, last_message_id, last_date)
+    )
+    conn.commit()
+
+@metrics.timed("sqlite_query_seconds")
+def get_channel_entity(channel: str, max_age: int):
+    """Возвращает (peer_id, access_hash, username, title) из кэша, если запись моложе max_age секунд."""
+    conn = _get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT peer_id, access_hash, username, title FROM channel_entities WHERE channel = ? AND resolved_at >= strftime('%s', 'now') - ?",
+        (channel, max_age)
+    )
+    return cursor.fetchone()
+
+@metrics.timed("sqlite_query_seconds")
+def save_channel_entity(channel: str, peer_id: int, access_hash: int, username: str, title: str):
+    """Сохраняет разрешённый канал в кэш."""
+    conn = _get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT OR REPLACE INTO channel_entities (channel, peer_id, access_hash, username, title, resolved_at) VALUES (?, ?, ?, ?, ?, strftime('%s', 'now'))",
+        (channel, peer_id, access_hash, username, title)
+    )
+    conn.commit()
+
+@metrics.timed("sqlite_query_seconds")
+def invalidate_channel_entity(channel: str):
+    """Удаляет канал из кэша, чтобы на следующем запуске он был разрешён заново."""
+    conn = _get_connection()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM channel_entities WHERE channel = ?", (channel,))
+    conn.commit()
 
+# Поля поста для генерации: id, text, source_link, has_media, channel, date, duplicate_links.
+# duplicate_links — ссылки на копии этого поста в других каналах через пробел (или None).
+# Возвращаются только канонические посты: дубликаты схлопнуты в них.
+_POST_FIELDS = (
+    "id, text, source_link, has_media, channel, date, "
+    "(SELECT group_concat(d.source_link, ' ') FROM posts d WHERE d.canonical_id = posts.id)"
+)
+
+@metrics.timed("sqlite_query_seconds")
 def get_unprocessed_posts(limit: int, offset: int):
     """Возвращает пачку необработанных постов с использованием лимита и смещения.
-    Поля: id, text, source_link, has_media, channel
+    Поля: см. _POST_FIELDS
     """
-    conn = sqlite3.connect(config.DB_NAME)
+    conn = _get_connection()
     cursor = conn.cursor()
     cursor.execute(
-        "SELECT id, text, source_link, has_media, channel FROM posts WHERE is_processed = 0 ORDER BY date DESC LIMIT ? OFFSET ?",
+        f"SELECT {_POST_FIELDS} FROM posts WHERE is_processed = 0 AND canonical_id IS NULL ORDER BY date DESC LIMIT ? OFFSET ?",
         (limit, offset)
     )
+    return cursor.fetchall()
+
+@metrics.timed("sqlite_query_seconds")
+def iter_unprocessed_posts(batch_size: int, since: int = 0):
+    """Отдаёт необработанные посты пачками по batch_size, от новых к старым.
+
+    Вместо LIMIT/OFFSET используется курсор по (date, id): каждая следующая
+    пачка начинается сразу после последнего поста предыдущей, и запрос целиком
+    обслуживается индексом idx_posts_processed_date (порядок date DESC, rowid ASC).
+    since — нижняя граница даты (unix time), чтобы старый хвост не раздувал запуск.
+    Поля: см. _POST_FIELDS
+    """
+    conn = _get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        f"SELECT {_POST_FIELDS} FROM posts WHERE is_processed = 0 AND canonical_id IS NULL AND date >= ? "
+        "ORDER BY date DESC, id ASC LIMIT ?",
+        (since, batch_size)
+    )
     posts = cursor.fetchall()
-    conn.close()
-    return posts
+    while posts:
+        yield posts
+        last_id, last_date = posts[-1][0], posts[-1][5]
+        cursor.execute(
+            f"SELECT {_POST_FIELDS} FROM posts WHERE is_processed = 0 AND canonical_id IS NULL AND date >= ? "
+            "AND date <= ? AND NOT (date = ? AND id <= ?) ORDER BY date DESC, id ASC LIMIT ?",
+            (since, last_date, last_date, last_id, batch_size)
+        )
+        posts = cursor.fetchall()
+
+@metrics.timed("sqlite_query_seconds")
+def get_unprocessed_posts_for_channel(channel: str, since: int = 0):
+    """Возвращает все необработанные посты канала не старше since (поля см. _POST_FIELDS)."""
+    conn = _get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        f"SELECT {_POST_FIELDS} FROM posts WHERE is_processed = 0 AND canonical_id IS NULL AND channel = ? AND date >= ? ORDER BY date DESC",
+        (channel, since)
+    )
+    return cursor.fetchall()
+
+@metrics.timed("sqlite_query_seconds")
+def get_recent_channel_texts(channel: str, limit: int = 50, skipped: bool = None) -> list:
+    """Тексты последних limit постов канала (по индексу UNIQUE(channel, message_id)).
+    skipped=True — только отсеянные предфильтром, False — только не отсеянные.
+    """
+    conn = _get_connection()
+    condition = "" if skipped is None else f" AND skip_reason IS {'NOT ' if skipped else ''}NULL"
+    rows = conn.execute(
+        f"SELECT text FROM posts WHERE channel = ?{condition} ORDER BY message_id DESC LIMIT ?",
+        (channel, limit)
+    ).fetchall()
+    return [row[0] for row in rows]
+
+def _fts_query(text: str) -> str:
+    """Превращает обычную строку в запрос FTS5: каждое слово в кавычках, все слова обязательны."""
+    words = [w.replace('"', '') for w in text.split()]
+    return " ".join(f'"{w}"' for w in words if w)
+
+@metrics.timed("sqlite_query_seconds")
+def search_posts(query: str, limit: int = 20, channel: str = None, since: int = 0, raw: bool = False,
+                 by_rank: bool = False):
+    """Ищет посты по тексту через FTS5.
+
+    По умолчанию query — набор слов, все должны встретиться в посте. При raw=True
+    query передаётся как есть и может использовать синтаксис FTS5 (OR, NEAR, "фраза", префикс*).
+    Результаты идут от новых постов к старым: FTS5 читает индекс в обратном порядке
+    и останавливается после limit совпадений. by_rank=True сортирует по релевантности
+    (bm25), но тогда ранжируются все совпадения, что дороже для частых слов.
+    Поля: id, channel, date, source_link, snippet
+    """
+    match = query if raw else _fts_query(query)
+    if not match:
+        return []
+    order = "bm25(posts_fts)" if by_rank else "posts_fts.rowid DESC"
+    conn = _get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        f"""
+        SELECT p.id, p.channel, p.date, p.source_link,
+               snippet(posts_fts, 0, '[', ']', '…', 12)
+        FROM posts_fts
+        JOIN posts p ON p.id = posts_fts.rowid
+        WHERE posts_fts MATCH ? AND p.date >= ? AND (? IS NULL OR p.channel = ?)
+        ORDER BY {order}
+        LIMIT ?
+        """,
+        (match, since, channel, channel, limit)
+    )
+    return cursor.fetchall()
 
+@metrics.timed("sqlite_query_seconds")
 def mark_posts_as_processed(post_ids: list):
-    """Отмечает посты как обработанные."""
-    conn = sqlite3.connect(config.DB_NAME)
+    """Отмечает посты как обработанные вместе с их дубликатами."""
+    conn = _get_connection()
     cursor = conn.cursor()
-    cursor.executemany("UPDATE posts SET is_processed = 1 WHERE id = ?", [(pid,) for pid in post_ids])
+    cursor.executemany("UPDATE posts SET is_processed = 1 WHERE id = ? OR canonical_id = ?", [(pid, pid) for pid in post_ids])
     conn.commit()
-    conn.close()
+
+@metrics.timed("sqlite_query_seconds")
+def get_unprocessed_message_ids(channel: str, since: int = 0) -> list:
+    """message_id необработанных канонических постов канала не старше since — для обновления вовлечённости."""
+    conn = _get_connection()
+    rows = conn.execute(
+        "SELECT message_id FROM posts WHERE channel = ? AND is_processed = 0 AND canonical_id IS NULL AND date >= ? "
+        "ORDER BY message_id",
+        (channel, since)
+    ).fetchall()
+    return [row[0] for row in rows]
+
+@metrics.timed("sqlite_query_seconds")
+def update_engagement(rows: list):
+    """Обновляет вовлечённость постов: rows — [(channel, message_id, views, forwards, reactions), ...]."""
+    conn = _get_connection()
+    with conn:
+        conn.executemany(
+            "UPDATE posts SET views = ?, forwards = ?, reactions = ? WHERE channel = ? AND message_id = ?",
+            [(views, forwards, reactions, channel, message_id) for channel, message_id, views, forwards, reactions in rows]
+        )
+
+@metrics.timed("sqlite_query_seconds")
+def get_ranking_candidates(since: int = 0) -> list:
+    """Необработанные канонические посты для ранжирования:
+    [(id, channel, views, forwards, reactions, copies, text_length), ...], copies — число схлопнутых в пост копий.
+    """
+    conn = _get_connection()
+    return conn.execute(
+        """
+        SELECT id, channel, views, forwards, reactions,
+               (SELECT COUNT(*) FROM posts d WHERE d.canonical_id = posts.id),
+               length(text)
+        FROM posts WHERE is_processed = 0 AND canonical_id IS NULL AND date >= ?
+        """,
+        (since,)
+    ).fetchall()
+
+@metrics.timed("sqlite_query_seconds")
+def mark_posts_skipped(rows: list):
+    """Отмечает посты (и их дубликаты) отсеянными предфильтром: rows — [(post_id, reason), ...]."""
+    conn = _get_connection()
+    with conn:
+        conn.executemany(
+            "UPDATE posts SET is_processed = 1, skip_reason = ? WHERE id = ? OR canonical_id = ?",
+            [(reason, post_id, post_id) for post_id, reason in rows]
+        )
+
+@metrics.timed("sqlite_query_seconds")
+def iter_labeled_posts(runs: int = 8, chunk_size: int = 500):
+    """Посты из пачек последних runs запусков с оценкой модели: (text, has_media, kept).
+
+    kept — ссылка на пост попала в саммари пачки, то есть SUMMARY_PROMPT его оставил.
+    Это разметка для обучения локального классификатора предфильтра.
+    """
+    conn = _get_connection()
+    batches = conn.execute(
+        """
+        SELECT post_ids, summary FROM batch_summaries
+        WHERE run_id IN (SELECT id FROM digest_runs ORDER BY id DESC LIMIT ?)
+        ORDER BY run_id, batch_num
+        """,
+        (runs,)
+    ).fetchall()
+    for post_ids, summary in batches:
+        post_ids = json.loads(post_ids)
+        for start in range(0, len(post_ids), chunk_size):
+            chunk = post_ids[start:start + chunk_size]
+            placeholders = ", ".join("?" for _ in chunk)
+            for text, has_media, source_link in conn.execute(
+                f"SELECT text, has_media, source_link FROM posts WHERE id IN ({placeholders})", chunk
+            ):
+                yield text, bool(has_media), bool(source_link) and source_link in summary
+
+# Этапы запуска дайджеста по порядку; запуск в этапе DIGEST_DONE завершён,
+# в DIGEST_ABANDONED — закрыт как устаревший (его посты остались необработанными)
+DIGEST_SUMMARIZING = "summarizing"  # идёт пакетная обработка
+DIGEST_SUMMARIZED = "summarized"    # все саммари пачек готовы
+DIGEST_ARTICLE = "article"          # статья и анонс сгенерированы
+DIGEST_PUBLISHED = "published"      # статья опубликована в Telegra.ph
+DIGEST_NOTIFIED = "notified"        # уведомления отправлены
+DIGEST_DONE = "done"                # посты отмечены как обработанные
+DIGEST_ABANDONED = "abandoned"      # запуск устарел и не будет продолжен
+
+@metrics.timed("sqlite_query_seconds")
+def start_digest_run() -> int:
+    """Создаёт запись о новом запуске дайджеста и возвращает его id."""
+    conn = _get_connection()
+    with conn:
+        cursor = conn.execute(
+            "INSERT INTO digest_runs (stage, started_at, updated_at) VALUES (?, strftime('%s', 'now'), strftime('%s', 'now'))",
+            (DIGEST_SUMMARIZING,)
+        )
+    return cursor.lastrowid
+
+@metrics.timed("sqlite_query_seconds")
+def get_open_digest_run():
+    """Возвращает последний незавершённый запуск: (id, stage, article_html, summary, article_url) или None."""
+    conn = _get_connection()
+    return conn.execute(
+        "SELECT id, stage, article_html, summary, article_url FROM digest_runs WHERE stage NOT IN (?, ?) "
+        "ORDER BY id DESC LIMIT 1",
+        (DIGEST_DONE, DIGEST_ABANDONED)
+    ).fetchone()
+
+@metrics.timed("sqlite_query_seconds")
+def close_stale_digest_runs(started_before: int):
+    """Закрывает незавершённые запуски, начатые раньше started_before (unix time).
+
+    Запуск, который уже опубликовал статью (DIGEST_PUBLISHED, DIGEST_NOTIFIED), завершается:
+    посты из его пачек и отсеянные ранжированием отмечаются обработанными, иначе следующий запуск опубликовал бы те же
+    новости снова. Остальные переводятся в DIGEST_ABANDONED, их посты остаются необработанными.
+    Возвращает (id завершённых, id закрытых).
+    """
+    conn = _get_connection()
+    rows = conn.execute(
+        "SELECT id, stage FROM digest_runs WHERE stage NOT IN (?, ?) AND started_at < ? ORDER BY id",
+        (DIGEST_DONE, DIGEST_ABANDONED, started_before)
+    ).fetchall()
+    finalized = [run_id for run_id, stage in rows if stage in (DIGEST_PUBLISHED, DIGEST_NOTIFIED)]
+    abandoned = [run_id for run_id, stage in rows if run_id not in finalized]
+    for run_id in finalized:
+        mark_posts_as_processed([post_id for _, post_ids, _ in get_batch_summaries(run_id) for post_id in post_ids])
+        mark_posts_skipped(get_run_skips(run_id))
+        update_digest_run(run_id, DIGEST_DONE)
+    for run_id in abandoned:
+        update_digest_run(run_id, DIGEST_ABANDONED)
+    return finalized, abandoned
+
+@metrics.timed("sqlite_query_seconds")
+def update_digest_run(run_id: int, stage: str, article_html: str = None, summary: str = None, article_url: str = None):
+    """Переводит запуск на этап stage, сохраняя переданные результаты (None — оставить как есть)."""
+    conn = _get_connection()
+    with conn:
+        conn.execute(
+            """
+            UPDATE digest_runs SET
+                stage = ?,
+                updated_at = strftime('%s', 'now'),
+                article_html = COALESCE(?, article_html),
+                summary = COALESCE(?, summary),
+                article_url = COALESCE(?, article_url)
+            WHERE id = ?
+            """,
+            (stage, article_html, summary, article_url, run_id)
+        )
+
+@metrics.timed("sqlite_query_seconds")
+def save_batch_summary(run_id: int, batch_num: int, post_ids: list, summary: str):
+    """Сохраняет готовое саммари пачки вместе с id её постов."""
+    conn = _get_connection()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO batch_summaries (run_id, batch_num, post_ids, summary, created_at) "
+            "VALUES (?, ?, ?, ?, strftime('%s', 'now'))",
+            (run_id, batch_num, json.dumps(post_ids), summary)
+        )
+
+@metrics.timed("sqlite_query_seconds")
+def get_batch_summaries(run_id: int):
+    """Готовые пачки запуска по порядку: [(batch_num, post_ids, summary), ...]."""
+    conn = _get_connection()
+    rows = conn.execute(
+        "SELECT batch_num, post_ids, summary FROM batch_summaries WHERE run_id = ? ORDER BY batch_num",
+        (run_id,)
+    ).fetchall()
+    return [(batch_num, json.loads(post_ids), summary) for batch_num, post_ids, summary in rows]
+
+@metrics.timed("sqlite_query_seconds")
+def save_run_skips(run_id: int, rows: list):
+    """Записывает в журнал запуска посты, не допущенные в OpenAI: rows — [(post_id, reason), ...]."""
+    conn = _get_connection()
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO run_skipped_posts (run_id, post_id, reason) VALUES (?, ?, ?)",
+            [(run_id, post_id, reason) for post_id, reason in rows]
+        )
+
+@metrics.timed("sqlite_query_seconds")
+def get_run_skips(run_id: int) -> list:
+    """Посты, не допущенные в OpenAI в запуске run_id: [(post_id, reason), ...]."""
+    conn = _get_connection()
+    return conn.execute("SELECT post_id, reason FROM run_skipped_posts WHERE run_id = ?", (run_id,)).fetchall()
+
+# Статусы заданий Batch API, после которых задание больше не опрашивается
+OPENAI_BATCH_FINAL = ("completed", "failed", "expired", "cancelled")
+
+@metrics.timed("sqlite_query_seconds")
+def save_openai_batch(batch_id: str, run_id: int, status: str, input_path: str, requests: list):
+    """Сохраняет отправленное задание Batch API и его пачки: requests — [(custom_id, batch_num, post_ids, cache_key)]."""
+    conn = _get_connection()
+    with conn:
+        conn.execute(
+            "INSERT INTO openai_batches (id, run_id, status, input_path, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, strftime('%s', 'now'), strftime('%s', 'now'))",
+            (batch_id, run_id, status, input_path)
+        )
+        conn.executemany(
+            "INSERT INTO openai_batch_requests (batch_id, custom_id, run_id, batch_num, post_ids, cache_key) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(batch_id, custom_id, run_id, batch_num, json.dumps(post_ids), cache_key)
+             for custom_id, batch_num, post_ids, cache_key in requests]
+        )
+
+@metrics.timed("sqlite_query_seconds")
+def update_openai_batch(batch_id: str, status: str):
+    """Записывает новый статус задания Batch API."""
+    conn = _get_connection()
+    with conn:
+        conn.execute(
+            "UPDATE openai_batches SET status = ?, updated_at = strftime('%s', 'now') WHERE id = ?",
+            (status, batch_id)
+        )
+
+@metrics.timed("sqlite_query_seconds")
+def get_open_openai_batches(run_id: int = None):
+    """Задания Batch API, результат которых ещё не забран: [(id, run_id), ...]."""
+    conn = _get_connection()
+    placeholders = ", ".join("?" for _ in OPENAI_BATCH_FINAL)
+    query = f"SELECT id, run_id FROM openai_batches WHERE status NOT IN ({placeholders})"
+    params = list(OPENAI_BATCH_FINAL)
+    if run_id is not None:
+        query += " AND run_id = ?"
+        params.append(run_id)
+    return conn.execute(query + " ORDER BY created_at", params).fetchall()
+
+@metrics.timed("sqlite_query_seconds")
+def get_openai_batch_requests(batch_id: str) -> dict:
+    """Пачки задания по custom_id: {custom_id: (run_id, batch_num, post_ids, cache_key)}."""
+    conn = _get_connection()
+    rows = conn.execute(
+        "SELECT custom_id, run_id, batch_num, post_ids, cache_key FROM openai_batch_requests WHERE batch_id = ?",
+        (batch_id,)
+    ).fetchall()
+    return {custom_id: (run_id, batch_num, json.loads(post_ids), cache_key)
+            for custom_id, run_id, batch_num, post_ids, cache_key in rows}
+
+@metrics.timed("sqlite_query_seconds")
+def get_pending_batch_post_ids(run_id: int) -> set:
+    """id постов из пачек запуска, которые ещё ждут ответа в незавершённых заданиях Batch API."""
+    conn = _get_connection()
+    placeholders = ", ".join("?" for _ in OPENAI_BATCH_FINAL)
+    rows = conn.execute(
+        f"""
+        SELECT r.post_ids FROM openai_batch_requests r
+        JOIN openai_batches b ON b.id = r.batch_id
+        WHERE r.run_id = ? AND b.status NOT IN ({placeholders})
+        """,
+        (run_id, *OPENAI_BATCH_FINAL)
+    ).fetchall()
+    return {post_id for (post_ids,) in rows for post_id in json.loads(post_ids)}
+
+@metrics.timed("sqlite_query_seconds")
+def adopt_abandoned_openai_batches(run_id: int) -> int:
+    """Переносит незавершённые задания Batch API закрытых запусков (DIGEST_ABANDONED) в запуск run_id.
+
+    Их пачки получают следующие свободные номера run_id: ответы попадут в его журнал,
+    а посты не будут отправлены в OpenAI второй раз, пока задания ещё идут.
+    Возвращает число перенесённых заданий.
+    """
+    conn = _get_connection()
+    placeholders = ", ".join("?" for _ in OPENAI_BATCH_FINAL)
+    batch_ids = [row[0] for row in conn.execute(
+        f"""
+        SELECT b.id FROM openai_batches b
+        JOIN digest_runs r ON r.id = b.run_id
+        WHERE r.stage = ? AND b.status NOT IN ({placeholders})
+        ORDER BY b.created_at
+        """,
+        (DIGEST_ABANDONED, *OPENAI_BATCH_FINAL)
+    )]
+    if not batch_ids:
+        return 0
+    batch_placeholders = ", ".join("?" for _ in batch_ids)
+    requests = conn.execute(
+        f"SELECT batch_id, custom_id FROM openai_batch_requests WHERE batch_id IN ({batch_placeholders}) "
+        "ORDER BY run_id, batch_num",
+        batch_ids
+    ).fetchall()
+    first = next_batch_num(run_id)
+    with conn:
+        conn.executemany(
+            "UPDATE openai_batch_requests SET run_id = ?, batch_num = ? WHERE batch_id = ? AND custom_id = ?",
+            [(run_id, first + i, batch_id, custom_id) for i, (batch_id, custom_id) in enumerate(requests)]
+        )
+        conn.executemany(
+            "UPDATE openai_batches SET run_id = ?, updated_at = strftime('%s', 'now') WHERE id = ?",
+            [(run_id, batch_id) for batch_id in batch_ids]
+        )
+    return len(batch_ids)
+
+@metrics.timed("sqlite_query_seconds")
+def next_batch_num(run_id: int) -> int:
+    """Следующий свободный номер пачки запуска — с учётом пачек, отправленных в Batch API."""
+    conn = _get_connection()
+    row = conn.execute(
+        """
+        SELECT MAX(n) FROM (
+            SELECT MAX(batch_num) AS n FROM batch_summaries WHERE run_id = ?
+            UNION ALL
+            SELECT MAX(batch_num) FROM openai_batch_requests WHERE run_id = ?
+        )
+        """,
+        (run_id, run_id)
+    ).fetchone()
+    return (row[0] or 0) + 1
+
+@metrics.timed("sqlite_query_seconds")
+def save_metrics(rows: list):
+    """Сохраняет строки metrics.drain(): [(created_at, run_id, kind, name, labels, count, value), ...]."""
+    if not rows:
+        return
+    conn = _get_connection()
+    with conn:
+        conn.executemany(
+            "INSERT INTO metrics (created_at, run_id, kind, name, labels, count, value) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+
+@metrics.timed("sqlite_query_seconds")
+def delete_old_runs(older_than: int):
+    """Удаляет журнал запусков, завершённых или закрытых раньше older_than (unix time):
+    digest_runs, batch_summaries, run_skipped_posts и задания Batch API, а также строки metrics старше older_than.
+    Запуск, у которого ещё есть незавершённые задания Batch API, не трогается.
+    Возвращает (удалено запусков, удалено строк метрик).
+    """
+    conn = _get_connection()
+    placeholders = ", ".join("?" for _ in OPENAI_BATCH_FINAL)
+    run_ids = [(row[0],) for row in conn.execute(
+        f"""
+        SELECT id FROM digest_runs
+        WHERE stage IN (?, ?) AND updated_at < ?
+          AND id NOT IN (SELECT run_id FROM openai_batches WHERE status NOT IN ({placeholders}))
+        """,
+        (DIGEST_DONE, DIGEST_ABANDONED, older_than, *OPENAI_BATCH_FINAL)
+    )]
+    with conn:
+        conn.executemany("DELETE FROM batch_summaries WHERE run_id = ?", run_ids)
+        conn.executemany("DELETE FROM run_skipped_posts WHERE run_id = ?", run_ids)
+        conn.executemany("DELETE FROM openai_batch_requests WHERE run_id = ?", run_ids)
+        conn.executemany("DELETE FROM openai_batches WHERE run_id = ?", run_ids)
+        conn.executemany("DELETE FROM digest_runs WHERE id = ?", run_ids)
+        metrics_deleted = conn.execute("DELETE FROM metrics WHERE created_at < ?", (older_than,)).rowcount
+    return len(run_ids), metrics_deleted
+
+@metrics.timed("sqlite_query_seconds")
+def archive_processed_posts(older_than: int, archive_path: str = None, chunk_size: int = 5000) -> int:
+    """Переносит обработанные посты старше older_than (unix time) из posts в архив.
+
+    Если archive_path задан, посты пишутся в отдельный файл SQLite (таблица
+    posts_archive, текст сжат zlib), иначе просто удаляются. Работает порциями
+    по chunk_size; запись в архив идемпотентна, поэтому прерванный перенос
+    безопасно повторить. Возвращает количество убранных из posts постов.
+    """
+    conn = _get_connection()
+    if archive_path:
+        conn.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS archive.posts_archive (
+                id INTEGER PRIMARY KEY,
+                channel TEXT NOT NULL,
+                message_id INTEGER NOT NULL,
+                date INTEGER NOT NULL,
+                source_link TEXT,
+                has_media BOOLEAN DEFAULT 0,
+                text_zlib BLOB NOT NULL,
+                archived_at INTEGER NOT NULL
+            )
+        ''')
+    moved = 0
+    try:
+        while True:
+            rows = conn.execute(
+                "SELECT id, channel, message_id, date, source_link, has_media, text FROM posts "
+                "WHERE is_processed = 1 AND date < ? LIMIT ?",
+                (older_than, chunk_size)
+            ).fetchall()
+            if not rows:
+                break
+            if archive_path:
+                with conn:
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO archive.posts_archive "
+                        "(id, channel, message_id, date, source_link, has_media, text_zlib, archived_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, strftime('%s', 'now'))",
+                        [(*row[:6], zlib.compress(row[6].encode("utf-8"), 9)) for row in rows]
+                    )
+            with conn:
+                conn.executemany("DELETE FROM posts WHERE id = ?", [(row[0],) for row in rows])
+                conn.executemany("DELETE FROM post_fingerprints WHERE post_id = ?", [(row[0],) for row in rows])
+            moved += len(rows)
+    finally:
+        if archive_path:
+            conn.execute("DETACH DATABASE archive")
+    return moved
+
+@metrics.timed("sqlite_query_seconds")
+def get_archived_posts(archive_path: str, channel: str = None, since: int = 0, limit: int = 100):
+    """Читает посты из архива с распакованным текстом. Поля: id, channel, date, source_link, text"""
+    if not os.path.exists(archive_path):
+        return []
+    archive = sqlite3.connect(archive_path)
+    try:
+        rows = archive.execute(
+            "SELECT id, channel, date, source_link, text_zlib FROM posts_archive "
+            "WHERE date >= ? AND (? IS NULL OR channel = ?) ORDER BY date DESC LIMIT ?",
+            (since, channel, channel, limit)
+        ).fetchall()
+    finally:
+        archive.close()
+    return [(*row[:4], zlib.decompress(row[4]).decode("utf-8")) for row in rows]
+
+def get_db_size() -> int:
+    """Размер базы на диске в байтах вместе с WAL-файлом."""
+    return sum(
+        os.path.getsize(path)
+        for path in (config.DB_NAME, config.DB_NAME + "-wal")
+        if os.path.exists(path)
+    )
+
+@metrics.timed("sqlite_query_seconds")
+def compact_db(max_pages: int = 0) -> bool:
+    """Возвращает свободные страницы файлу системы и оптимизирует индексы.
+
+    Если база ещё не в режиме auto_vacuum=INCREMENTAL, один раз выполняется
+    полный VACUUM для переключения. max_pages ограничивает инкрементальный
+    VACUUM (0 — все свободные страницы). Возвращает True, если понадобился полный VACUUM.
+    """
+    conn = _get_connection()
+    # Сначала сливаем сегменты FTS5 (после удалений в них остаются пометки), затем VACUUM
+    with conn:
+        conn.execute("INSERT INTO posts_fts(posts_fts) VALUES ('optimize')")
+    full_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2
+    if full_vacuum:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    else:
+        # Прагма освобождает по странице за шаг; executescript выполняет её до конца,
+        # а обычный execute сделал бы только первый шаг
+        conn.executescript(f"PRAGMA incremental_vacuum({int(max_pages)});" if max_pages else "PRAGMA incremental_vacuum;")
+    # Обновляем статистику планировщика
+    conn.execute("PRAGMA optimize")
+    # Переносим WAL в основной файл и обрезаем его
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return full_vacuum
 
 # def reset_processed_posts():
 #     """Сбрасывает флаг is_processed для всех постов на 0 (необработанные)."""
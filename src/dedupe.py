@@ -0,0 +1,78 @@
+import hashlib
+import re
+
+# Сколько бит в отпечатке SimHash и на сколько полос его режем для поиска кандидатов.
+# При 6 полосах (по 11 или 10 бит) два отпечатка с расстоянием Хэмминга до 5
+# обязательно совпадут хотя бы в одной полосе, поэтому поиск по полосам ничего не теряет.
+SIMHASH_BITS = 64
+BANDS = 6
+_BAND_WIDTHS = [SIMHASH_BITS // BANDS + (1 if i < SIMHASH_BITS % BANDS else 0) for i in range(BANDS)]
+
+# Сколько слов подряд образуют один признак SimHash
+_SHINGLE_SIZE = 3
+
+_URL = re.compile(r"https?://\S+|t\.me/\S+|www\.\S+", re.IGNORECASE)
+_MARKDOWN_LINK = re.compile(r"\[([^\]]*)\]\(([^)]*)\)")
+_URL_PREFIX = re.compile(r"^(?:https?://)?(?:www\.)?", re.IGNORECASE)
+_URL_TAIL = re.compile(r"[?#].*$|[/.,;:!)»\"']+$")
+_NON_WORD = re.compile(r"[^\w]+", re.UNICODE)
+
+
+def _link_key(url: str) -> str:
+    """Хост и путь ссылки: схема, www, параметры и якорь не отличают одну статью от другой."""
+    return _URL_TAIL.sub("", _URL_PREFIX.sub("", url))
+
+
+def normalize(text: str, links: bool = True) -> str:
+    """Приводит текст поста к каноническому виду: без разметки, эмодзи и регистра.
+
+    От ссылок остаются хост и путь — посты, которые отличаются только ссылкой (разные статьи
+    одного сайта), считаются разными. links=False убирает ссылки совсем (для подсчёта слов).
+    """
+    if not text:
+        return ""
+    text = _MARKDOWN_LINK.sub(lambda m: f"{m.group(1)} {_link_key(m.group(2))}" if links else m.group(1), text)
+    text = _URL.sub(lambda m: f" {_link_key(m.group())} " if links else " ", text)
+    text = _NON_WORD.sub(" ", text.lower())
+    return " ".join(text.replace("_", " ").split())
+
+
+def content_hash(normalized: str) -> str:
+    """Хэш нормализованного текста для поиска точных копий."""
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+def _feature_hash(feature: str) -> int:
+    return int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def simhash(normalized: str) -> int:
+    """64-битный SimHash по шинглам из слов. Возвращает знаковое число (как INTEGER в SQLite)."""
+    words = normalized.split()
+    if len(words) >= _SHINGLE_SIZE:
+        features = [" ".join(words[i:i + _SHINGLE_SIZE]) for i in range(len(words) - _SHINGLE_SIZE + 1)]
+    else:
+        features = words
+    # Бит отпечатка равен 1, если он установлен больше чем у половины признаков.
+    # Считаем по столбцам двоичных строк: так быстрее, чем сдвигами по каждому биту
+    rows = [format(_feature_hash(feature), f"0{SIMHASH_BITS}b") for feature in features]
+    half = len(rows) / 2
+    value = 0
+    for column in zip(*rows):
+        value = value << 1 | (column.count("1") > half)
+    return value - (1 << SIMHASH_BITS) if value >= 1 << (SIMHASH_BITS - 1) else value
+
+
+def hamming(a: int, b: int) -> int:
+    """Расстояние Хэмминга между двумя отпечатками."""
+    return bin((a ^ b) & ((1 << SIMHASH_BITS) - 1)).count("1")
+
+
+def bands(value: int) -> list:
+    """Режет отпечаток на BANDS полос: [(номер полосы, значение), ...]."""
+    value &= (1 << SIMHASH_BITS) - 1
+    result = []
+    for band, width in enumerate(_BAND_WIDTHS):
+        result.append((band, value & ((1 << width) - 1)))
+        value >>= width
+    return result
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import sqlite3
+import time
+import zlib
+from . import config
+
+# Кэш ответов OpenAI по содержимому запроса. Хранится в отдельном файле (LLM_CACHE_PATH),
+# который могут делить несколько ботов: одинаковые пачки из общих каналов оплачиваются один раз.
+_conn = None
+_conn_path = None
+
+# Счётчики текущего процесса
+_stats = {"hits": 0, "misses": 0, "bypassed": 0, "stored": 0}
+
+# Как часто (в записях) проверять размер кэша
+_EVICT_EVERY = 50
+_puts_since_evict = 0
+
+
+def _get_connection() -> sqlite3.Connection:
+    global _conn, _conn_path
+    if _conn is not None and _conn_path == config.LLM_CACHE_PATH:
+        return _conn
+    close()
+    conn = sqlite3.connect(config.LLM_CACHE_PATH, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            content BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            accessed_at INTEGER NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses(accessed_at)")
+    _conn, _conn_path = conn, config.LLM_CACHE_PATH
+    return conn
+
+
+def close():
+    """Закрывает соединение с кэшем."""
+    global _conn, _conn_path
+    if _conn is not None:
+        _conn.close()
+    _conn, _conn_path = None, None
+
+
+def make_key(request_params: dict, input_text: str) -> str:
+    """Ключ кэша: хэш модели, параметров рассуждения и полного входа (промпт + посты)."""
+    payload = json.dumps(
+        {
+            "model": request_params.get("model"),
+            "reasoning": request_params.get("reasoning"),
+            "max_output_tokens": request_params.get("max_output_tokens"),
+            "input": input_text,
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def get(key: str):
+    """Возвращает сохранённый ответ или None. При LLM_CACHE_BYPASS кэш не читается."""
+    if not config.LLM_CACHE_ENABLED:
+        return None
+    if config.LLM_CACHE_BYPASS:
+        _stats["bypassed"] += 1
+        return None
+    conn = _get_connection()
+    now = int(time.time())
+    row = conn.execute(
+        "SELECT content FROM responses WHERE key = ? AND created_at >= ?",
+        (key, now - config.LLM_CACHE_MAX_AGE_DAYS * 86400)
+    ).fetchone()
+    if row is None:
+        _stats["misses"] += 1
+        return None
+    with conn:
+        conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+    _stats["hits"] += 1
+    return zlib.decompress(row[0]).decode("utf-8")
+
+
+def put(key: str, model: str, content: str):
+    """Сохраняет ответ модели (и при обходе кэша — тоже, чтобы обновить запись)."""
+    global _puts_since_evict
+    if not config.LLM_CACHE_ENABLED or not content:
+        return
+    conn = _get_connection()
+    blob = zlib.compress(content.encode("utf-8"))
+    now = int(time.time())
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, model, content, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model, blob, len(blob), now, now)
+        )
+    _stats["stored"] += 1
+    _puts_since_evict += 1
+    if _puts_since_evict >= _EVICT_EVERY:
+        evict()
+
+
+def evict() -> int:
+    """Удаляет записи старше LLM_CACHE_MAX_AGE_DAYS, затем самые давно использованные,
+    пока кэш больше LLM_CACHE_MAX_MB. Возвращает число удалённых записей.
+    """
+    global _puts_since_evict
+    _puts_since_evict = 0
+    if not config.LLM_CACHE_ENABLED:
+        return 0
+    conn = _get_connection()
+    cutoff = int(time.time()) - config.LLM_CACHE_MAX_AGE_DAYS * 86400
+    limit = config.LLM_CACHE_MAX_MB * 1024 * 1024
+    with conn:
+        removed = conn.execute("DELETE FROM responses WHERE created_at < ?", (cutoff,)).rowcount
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total > limit:
+            # Оставляем самые свежие по использованию записи, суммарно не больше лимита
+            removed += conn.execute(
+                """
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC, key) AS running
+                        FROM responses
+                    ) WHERE running > ?
+                )
+                """,
+                (limit,)
+            ).rowcount
+    return removed
+
+
+def stats() -> dict:
+    """Счётчики процесса (hits, misses, bypassed, stored) и размер кэша на диске."""
+    result = dict(_stats)
+    if config.LLM_CACHE_ENABLED:
+        entries, size = _get_connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        result.update(entries=entries, size=size)
+    return result
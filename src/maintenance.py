@@ -0,0 +1,72 @@
+import time
+from . import config, database, llm_cache
+
+# Сколько раз повторяем «горячий» запрос для замера задержки
+_LATENCY_SAMPLES = 20
+
+
+def _hot_query_latency() -> float:
+    """Средняя задержка первой пачки необработанных постов (мс) — главного запроса дайджеста."""
+    start = time.perf_counter()
+    for _ in range(_LATENCY_SAMPLES):
+        next(database.iter_unprocessed_posts(50), None)
+    return (time.perf_counter() - start) / _LATENCY_SAMPLES * 1000
+
+
+def run_maintenance() -> dict:
+    """Обслуживание базы: архив старых обработанных постов, очистка журнала запусков и метрик,
+    VACUUM, оптимизация индексов.
+
+    Возвращает отчёт: сколько постов перенесено, сколько места освобождено
+    и как изменилась задержка выборки необработанных постов.
+    """
+    print("\n--- ОБСЛУЖИВАНИЕ БАЗЫ ДАННЫХ ---")
+    size_before = database.get_db_size()
+    latency_before = _hot_query_latency()
+
+    archived = runs_deleted = metrics_deleted = 0
+    if config.RETENTION_DAYS:
+        cutoff = int(time.time()) - config.RETENTION_DAYS * 86400
+        target = f"в архив {config.ARCHIVE_DB_NAME}" if config.ARCHIVE_DB_NAME else "на удаление"
+        print(f"Перенос обработанных постов старше {config.RETENTION_DAYS} дн. {target}...")
+        archived = database.archive_processed_posts(cutoff, config.ARCHIVE_DB_NAME)
+        print(f"Перенесено постов: {archived}")
+        runs_deleted, metrics_deleted = database.delete_old_runs(cutoff)
+        print(f"Удалено из журнала завершённых запусков: {runs_deleted}, строк метрик: {metrics_deleted}")
+
+    evicted = llm_cache.evict()
+    if evicted:
+        print(f"Из кэша ответов OpenAI удалено устаревших записей: {evicted}")
+
+    full_vacuum = database.compact_db()
+    if full_vacuum:
+        print("База переведена в режим инкрементального VACUUM (выполнен полный VACUUM).")
+
+    size_after = database.get_db_size()
+    latency_after = _hot_query_latency()
+    report = {
+        "archived": archived,
+        "runs_deleted": runs_deleted,
+        "metrics_deleted": metrics_deleted,
+        "llm_cache_evicted": evicted,
+        "size_before": size_before,
+        "size_after": size_after,
+        "reclaimed": size_before - size_after,
+        "latency_before_ms": latency_before,
+        "latency_after_ms": latency_after,
+    }
+    print(
+        f"Размер базы: {size_before / 1024 / 1024:.1f} МБ -> {size_after / 1024 / 1024:.1f} МБ "
+        f"(освобождено {report['reclaimed'] / 1024 / 1024:.1f} МБ)"
+    )
+    print(f"Выборка необработанных постов: {latency_before:.2f} мс -> {latency_after:.2f} мс")
+    print("--- ОБСЛУЖИВАНИЕ ЗАВЕРШЕНО ---")
+    return report
+
+
+async def maintenance_job():
+    """Задача планировщика для run_maintenance() (main.py вызывает её под блокировкой цикла дайджеста)."""
+    try:
+        run_maintenance()
+    except Exception as e:
+        print(f"Ошибка при обслуживании базы: {e}")
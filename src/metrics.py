@@ -0,0 +1,192 @@
+import functools
+import inspect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Метрики процесса: длительности (сумма и число наблюдений) и счётчики с метками.
+# drain() отдаёт накопленное с прошлого вызова для таблицы metrics (см. database.save_metrics),
+# render() — всё с начала работы процесса в текстовом формате Prometheus для /metrics.
+# Обновляются из цикла событий, а читаются ещё и из потока HTTP-сервера, поэтому под блокировкой.
+
+_lock = threading.Lock()
+_summaries = {}  # (name, labels) -> [count, sum]
+_counters = {}   # (name, labels) -> [count, value]
+_drained = {}    # ключ -> (count, value) на момент прошлого drain()
+_calls = []      # отдельные вызовы внешних API: (created_at, name, labels, seconds)
+_run_id = None
+_server = None
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def observe(name: str, seconds: float, **labels):
+    """Добавляет наблюдение длительности (в секундах)."""
+    key = _key(name, labels)
+    with _lock:
+        summary = _summaries.setdefault(key, [0, 0.0])
+        summary[0] += 1
+        summary[1] += seconds
+
+
+def inc(name: str, value: float = 1, **labels):
+    """Увеличивает счётчик."""
+    if not value:
+        return
+    key = _key(name, labels)
+    with _lock:
+        counter = _counters.setdefault(key, [0, 0.0])
+        counter[0] += 1
+        counter[1] += value
+
+
+def call(name: str, seconds: float, labels: dict, **details):
+    """Один вызов внешнего API: длительность идёт в сводку name с метками labels,
+    а сам вызов вместе с details (токены, попытки и т. п.) — отдельной строкой в таблицу metrics.
+    """
+    observe(name, seconds, **labels)
+    with _lock:
+        _calls.append((int(time.time()), name, {**labels, **details}, seconds))
+
+
+def set_run(run_id):
+    """Запуск дайджеста, к которому относятся следующие метрики (пишется в таблицу metrics)."""
+    global _run_id
+    _run_id = run_id
+
+
+class span:
+    """Замер этапа: with metrics.span("article"): ... — длительность идёт в digest_stage_seconds{stage=...}."""
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe("digest_stage_seconds", time.perf_counter() - self.started, stage=self.stage)
+        return False
+
+
+def timed(name: str):
+    """Декоратор: время каждого вызова функции идёт в сводку name{function=...}.
+    У генераторов считается время внутри генератора, без времени потребителя между элементами.
+    """
+    def decorator(fn):
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def generator_wrapper(*args, **kwargs):
+                generator = fn(*args, **kwargs)
+                while True:
+                    started = time.perf_counter()
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        return
+                    finally:
+                        observe(name, time.perf_counter() - started, function=fn.__name__)
+                    yield item
+            return generator_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - started, function=fn.__name__)
+        return wrapper
+    return decorator
+
+
+def drain() -> list:
+    """Строки для таблицы metrics, накопленные с прошлого вызова:
+    [(created_at, run_id, kind, name, labels_json, count, value), ...].
+    kind='call' — отдельный вызов (value — секунды), kind='total' — прирост сводки или счётчика.
+    """
+    global _calls
+    now = int(time.time())
+    with _lock:
+        rows = [
+            (created_at, _run_id, "call", name, json.dumps(labels, ensure_ascii=False), 1, seconds)
+            for created_at, name, labels, seconds in _calls
+        ]
+        _calls = []
+        for key, (count, value) in [*_summaries.items(), *_counters.items()]:
+            previous_count, previous_value = _drained.get(key, (0, 0.0))
+            if count == previous_count:
+                continue
+            name, labels = key
+            rows.append((now, _run_id, "total", name, json.dumps(dict(labels), ensure_ascii=False),
+                         count - previous_count, value - previous_value))
+            _drained[key] = (count, value)
+    return rows
+
+
+def _labels_text(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (k + '="' + v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for k, v in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def render() -> str:
+    """Все метрики процесса в текстовом формате Prometheus."""
+    lines = []
+    with _lock:
+        summaries = sorted(_summaries.items())
+        counters = sorted(_counters.items())
+    typed = set()
+    for (name, labels), (count, total) in summaries:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} summary")
+        lines.append(f"{name}_count{_labels_text(labels)} {count}")
+        lines.append(f"{name}_sum{_labels_text(labels)} {total:.6f}")
+    for (name, labels), (_, value) in counters:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_labels_text(labels)} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(host: str, port: int):
+    """Запускает HTTP-эндпоинт /metrics в фоновом потоке (один на процесс)."""
+    global _server
+    if _server is not None:
+        return
+    _server = ThreadingHTTPServer((host, port), _Handler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    print(f"Метрики доступны на http://{host}:{port}/metrics")
+
+
+def stop_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+    _server = None
@@ -0,0 +1,199 @@
+import asyncio
+import json
+import os
+import time
+from . import article_generator, config, database, llm_cache, metrics, rate_limiter
+
+# Отложенная суммаризация через OpenAI Batch API: пачки SUMMARY_PROMPT пишутся в JSONL-файл,
+# файл отправляется одним заданием, а готовые ответы по опросу попадают в журнал batch_summaries.
+# Запуск дайджеста берёт их оттуда как уже готовые пачки и синхронно досчитывает только остаток.
+
+_ENDPOINT = "/v1/responses"
+_COMPLETION_WINDOW = "24h"
+# Ограничения Batch API на один входной файл (с запасом по размеру)
+_MAX_REQUESTS = 50_000
+_MAX_BYTES = 190 * 1024 * 1024
+# Отмена задания занимает до 10 минут: всё это время оно в статусе cancelling, а в выходной
+# файл попадают уже готовые ответы. Ждём финального статуса не дольше _CANCEL_WAIT_SECONDS
+_CANCEL_POLL_SECONDS = 5
+_CANCEL_WAIT_SECONDS = 15 * 60
+
+
+class BatchWriter:
+    """Пишет пачки запуска run_id в JSONL-файлы для Batch API, начиная новый файл
+    при достижении ограничений на число запросов или размер. Пачки, ответ на которые
+    уже есть в кэше OpenAI, сразу сохраняются в журнал и в файл не попадают.
+    """
+
+    def __init__(self, run_id: int):
+        self.run_id = run_id
+        self.files = []  # [(путь, [(custom_id, batch_num, post_ids, cache_key), ...]), ...]
+        self.cached = 0
+        self._file = None
+        self._size = 0
+
+    def add(self, batch_num: int, posts_batch: list):
+        request_params, input_text = article_generator.build_request(posts_batch, config.SUMMARY_PROMPT)
+        cache_key = llm_cache.make_key(request_params, input_text)
+        post_ids = [p[0] for p in posts_batch]
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            database.save_batch_summary(self.run_id, batch_num, post_ids, cached.strip())
+            self.cached += 1
+            return
+
+        custom_id = f"run{self.run_id}-batch{batch_num}"
+        line = json.dumps(
+            {
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": _ENDPOINT,
+                "body": {
+                    "model": request_params["model"],
+                    "input": input_text,
+                    "max_output_tokens": request_params.get("max_output_tokens"),
+                    "reasoning": request_params.get("reasoning"),
+                },
+            },
+            ensure_ascii=False,
+        ).encode("utf-8") + b"\n"
+        if self._file is None or len(self.files[-1][1]) >= _MAX_REQUESTS or self._size + len(line) > _MAX_BYTES:
+            self._open()
+        self._file.write(line)
+        self._size += len(line)
+        self.files[-1][1].append((custom_id, batch_num, post_ids, cache_key))
+
+    def _open(self):
+        self.close()
+        os.makedirs(config.OPENAI_BATCH_DIR, exist_ok=True)
+        path = os.path.join(config.OPENAI_BATCH_DIR, f"run{self.run_id}_{int(time.time())}_{len(self.files) + 1}.jsonl")
+        self._file = open(path, "wb")
+        self._size = 0
+        self.files.append((path, []))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @property
+    def requests(self) -> int:
+        return sum(len(requests) for _, requests in self.files)
+
+
+async def submit(writer: BatchWriter) -> list:
+    """Загружает файлы writer в OpenAI и создаёт по заданию Batch API на файл. Возвращает id заданий."""
+    writer.close()
+    client = article_generator.get_client()
+    limiter = rate_limiter.get(rate_limiter.OPENAI)
+    batch_ids = []
+    for path, requests in writer.files:
+        await limiter.acquire()
+        with open(path, "rb") as input_file:
+            uploaded = await client.files.create(file=input_file, purpose="batch")
+        await limiter.acquire()
+        batch = await client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint=_ENDPOINT,
+            completion_window=_COMPLETION_WINDOW,
+        )
+        limiter.success()
+        database.save_openai_batch(batch.id, writer.run_id, batch.status, path, requests)
+        batch_ids.append(batch.id)
+        print(f"  - Задание Batch API {batch.id}: {len(requests)} пачек из {path}")
+    return batch_ids
+
+
+def _output_text(body: dict) -> str:
+    """Текст ответа Responses API из строки выходного файла задания."""
+    if body.get("output_text"):
+        return body["output_text"]
+    return "".join(
+        item.get("text", "")
+        for block in body.get("output", [])
+        if block.get("type") == "message"
+        for item in block.get("content", [])
+        if item.get("type") == "output_text"
+    )
+
+
+async def _collect(client, batch_id: str, output_file_id: str) -> int:
+    """Сохраняет ответы из выходного файла задания в журнал и кэш. Возвращает число готовых пачек."""
+    requests = database.get_openai_batch_requests(batch_id)
+    content = await client.files.content(output_file_id)
+    saved = failed = 0
+    for line in content.text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        request = requests.get(item.get("custom_id"))
+        response = item.get("response") or {}
+        summary = _output_text(response.get("body") or {}).strip() if response.get("status_code") == 200 else ""
+        metrics.inc("openai_batch_requests_total", status=response.get("status_code") or "none")
+        if request is None or not summary:
+            failed += 1
+            continue
+        article_generator.record_usage("batch_summary", response["body"].get("usage"))
+        run_id, batch_num, post_ids, cache_key = request
+        database.save_batch_summary(run_id, batch_num, post_ids, summary)
+        llm_cache.put(cache_key, response["body"].get("model") or "gpt-5", summary)
+        saved += 1
+    if failed:
+        # Посты из этих пачек остаются несуммаризованными и уйдут в OpenAI при запуске дайджеста
+        print(f"  - Задание {batch_id}: {failed} пачек без ответа, они будут обработаны синхронно.")
+    return saved
+
+
+async def _wait_cancelled(client, batch_id: str, limiter):
+    """Опрашивает отменяемое задание, пока оно не перейдёт в финальный статус (или не выйдет время)."""
+    deadline = time.monotonic() + _CANCEL_WAIT_SECONDS
+    while True:
+        await limiter.acquire()
+        batch = await client.batches.retrieve(batch_id)
+        if batch.status in database.OPENAI_BATCH_FINAL or time.monotonic() >= deadline:
+            return batch
+        await asyncio.sleep(_CANCEL_POLL_SECONDS)
+
+
+async def poll(run_id: int = None, cancel_running: bool = False) -> int:
+    """Проверяет незавершённые задания (все или только запуска run_id) и забирает готовые ответы.
+
+    При cancel_running задания, которые ещё выполняются, отменяются. Дождавшись конца отмены,
+    забираем уже готовые ответы, а остальные пачки запуск дайджеста отправит синхронно.
+    Возвращает число пачек, сохранённых в журнал.
+    """
+    client = article_generator.get_client()
+    limiter = rate_limiter.get(rate_limiter.OPENAI)
+    saved = 0
+    for batch_id, _ in database.get_open_openai_batches(run_id):
+        await limiter.acquire()
+        batch = await client.batches.retrieve(batch_id)
+        status = batch.status
+        if status not in database.OPENAI_BATCH_FINAL and cancel_running:
+            if status != "cancelling":
+                await limiter.acquire()
+                await client.batches.cancel(batch_id)
+                counts = getattr(batch, "request_counts", None)
+                done = f" (готово {counts.completed} из {counts.total})" if counts else ""
+                print(f"  - Задание Batch API {batch_id} не успело{done}, отменяем.")
+            # Пока отмена идёт, задание остаётся открытым: после сбоя его опросят снова
+            database.update_openai_batch(batch_id, "cancelling")
+            batch = await _wait_cancelled(client, batch_id, limiter)
+            status = batch.status
+            if status not in database.OPENAI_BATCH_FINAL:
+                # Пачки уходят в синхронную обработку, поэтому задание закрываем: его поздние ответы
+                # легли бы в журнал второй раз, и посты попали бы в статью дважды
+                print(f"  - Задание Batch API {batch_id} не отменилось за {_CANCEL_WAIT_SECONDS // 60} мин, "
+                      f"его пачки будут обработаны синхронно, а ответы задания не забираются.")
+                database.update_openai_batch(batch_id, "expired")
+                continue
+        if batch.output_file_id and status in ("completed", "expired", "cancelled"):
+            # У просроченного или отменённого задания часть ответов тоже может быть готова
+            batch_saved = await _collect(client, batch_id, batch.output_file_id)
+            saved += batch_saved
+            print(f"  - Задание Batch API {batch_id} ({status}): получено {batch_saved} саммари пачек.")
+        elif status in database.OPENAI_BATCH_FINAL:
+            print(f"  - Задание Batch API {batch_id} завершилось без ответов ({status}).")
+        database.update_openai_batch(batch_id, status)
+    limiter.success()
+    return saved
@@ -12,77 +12,85 @@ def _slugify_telegraph(text: str) -> str:
     """
     return text.replace(' ', '-')
 
+# Заголовок новости — открывающий <h4> (с атрибутами или без) и первый </h4> после него
+_H4_OPEN = re.compile(r"<h4[^>]*>", re.IGNORECASE)
+_H4_CLOSE = re.compile(r"</h4>", re.IGNORECASE)
+_H4_PLAIN = re.compile(r"<h4>", re.IGNORECASE)
+_H3_OPEN = re.compile(r"<h3[^>]*>", re.IGNORECASE)
+_HREF = re.compile(r"<a\s+href=\"([^\"]+)\"", re.IGNORECASE)
+_CATEGORY = re.compile(r"data-category=\"([^\"]+)\"", re.IGNORECASE)
+_TAG = re.compile(r"<[^>]+>")
+_TME_USERNAME = re.compile(r"https?://t\.me/([^/]+)/")
+
+
 def _extract_username_from_tme(url: str) -> str:
     """Возвращает username телеграм-канала из ссылки t.me, иначе пустую строку."""
-    m = re.search(r"https?://t\.me/([^/]+)/", url)
+    m = _TME_USERNAME.search(url)
     return m.group(1).lower() if m else ""
 
 
-def _split_news_blocks(html: str) -> Tuple[str, List[dict]]:
-    """Разбивает HTML статьи на префикс (до первой новости) и список блоков новостей."""
-    blocks = []
-    # Паттерн для поиска h4 тегов, включая те, что с атрибутами
-    h4_pattern = re.compile(r"(<h4[^>]*>.*?</h4>)", re.DOTALL | re.IGNORECASE)
-    # Паттерн для извлечения содержимого и атрибутов из h4 тега
-    h4_content_pattern = re.compile(r"<h4[^>]*>(.*?)</h4>", re.DOTALL | re.IGNORECASE)
-    
-    # Находим все полные блоки h4
-    all_h4_tags = [m.group(1) for m in h4_pattern.finditer(html)]
-    if not all_h4_tags:
-        return html, []
+def _iter_headers(html: str):
+    """Заголовки новостей по порядку за один проход: (открывающий тег, закрывающий тег) как match-объекты.
 
-    # Находим позиции, чтобы отделить префикс
-    first_h4_match = h4_pattern.search(html)
-    prefix = html[:first_h4_match.start()] if first_h4_match else html
-    
-    # Разделяем основной контент по h4 тегам
-    # В `split` первый элемент будет пустой строкой, если html начинается с h4, отбрасываем его
-    content_after_prefix = html[first_h4_match.start():]
-    split_content = h4_pattern.split(content_after_prefix)[1:]
-    
-    # Собираем блоки: тег h4 + следующий за ним контент
-    news_html_blocks = [tag + content for tag, content in zip(split_content[::2], split_content[1::2])]
+    Открывающий тег без </h4> после него заголовком не считается и остаётся текстом блока.
+    """
+    pos = 0
+    while True:
+        opening = _H4_OPEN.search(html, pos)
+        if opening is None:
+            return
+        closing = _H4_CLOSE.search(html, opening.end())
+        if closing is None:
+            return
+        yield opening, closing
+        pos = closing.end()
 
-    for block_html in news_html_blocks:
-        h4_tag_match = h4_pattern.search(block_html)
-        if not h4_tag_match:
-            continue
-        
-        h4_full_tag = h4_tag_match.group(1)
-        h4_inner_match = h4_content_pattern.search(h4_full_tag)
-        h4_inner = h4_inner_match.group(1) if h4_inner_match else ""
 
-        href_match = re.search(r"<a\s+href=\"([^\"]+)\"", h4_inner, re.IGNORECASE)
-        href = href_match.group(1) if href_match else ""
-        
-        title_text = unescape(re.sub(r"<[^>]+>", "", h4_inner).strip())
-        
-        category_match = re.search(r"data-category=\"([^\"]+)\"", h4_full_tag, re.IGNORECASE)
-        category = category_match.group(1) if category_match else "Без категории"
+def _split_news_blocks(html: str) -> Tuple[str, List[dict]]:
+    """Разбивает HTML статьи на префикс (до первой новости) и список блоков новостей.
+
+    Блок — заголовок <h4> и всё до следующего заголовка. Заголовок, ссылка, категория и якорь
+    берутся из самого <h4>, а весь документ просматривается один раз. Якорь (id, как у Telegra.ph)
+    ставится в первый <h4> без атрибутов внутри блока: у заголовка с атрибутами его нет.
+    """
+    headers = _iter_headers(html)
+    current = next(headers, None)
+    if current is None:
+        return html, []
+    prefix = html[:current[0].start()]
+
+    blocks = []
+    while current is not None:
+        opening, closing = current
+        following = next(headers, None)
+        start = opening.start()
+        end = following[0].start() if following else len(html)
+
+        h4_inner = html[opening.end():closing.start()]
+        href_match = _HREF.search(h4_inner)
+        title = unescape(_TAG.sub("", h4_inner).strip())
+        category_match = _CATEGORY.search(html, start, closing.end())
+        anchor_id = _slugify_telegraph(title)
+
+        block_html = html[start:end].strip()
+        plain = opening if opening.group().lower() == "<h4>" else _H4_PLAIN.search(html, start, end)
+        if plain is not None:
+            at = plain.start() - start
+            block_html = f"{block_html[:at]}<h4 id=\"{anchor_id}\">{block_html[at + 4:]}"
 
         blocks.append({
             "h4_inner": h4_inner,
-            "href": href,
-            "title": title_text,
-            "html": block_html.strip(),
-            "category": category,
+            "href": href_match.group(1) if href_match else "",
+            "title": title,
+            "html": block_html,
+            "category": category_match.group(1) if category_match else "Без категории",
+            "anchor_id": anchor_id,
         })
+        current = following
 
     return prefix, blocks
 
 
-def _prepare_anchors(blocks: List[dict]) -> List[dict]:
-    """Добавляет id к тегу <h4> каждого блока, имитируя логику Telegra.ph."""
-    updated = []
-    for block in blocks:
-        # Создаем якорь на основе текста заголовка
-        anchor_id = _slugify_telegraph(block["title"])
-        # Заменяем первый тег <h4> на <h4 id=\"...\">
-        new_html = re.sub(r"<h4>", f"<h4 id=\"{anchor_id}\">", block["html"], count=1, flags=re.IGNORECASE)
-        updated.append({**block, "anchor_id": anchor_id, "html": new_html})
-    return updated
-
-
 def _build_toc(blocks: List[dict]) -> str:
     """Строит HTML-навигацию по заголовкам в разрешённом формате с категориями."""
     if not blocks:
@@ -142,27 +150,21 @@ def add_navigation_and_split(html: str, official_channels: List[str]) -> str:
     if not blocks:
         return html
 
-    # Готовим якоря, совместимые с Telegra.ph
-    blocks = _prepare_anchors(blocks)
-
     # TOC
     toc_html = _build_toc(blocks) if config.ENABLE_TOC else ""
 
-    # Разделение на группы
-    official_blocks = []
-    other_blocks = []
-    for b in blocks:
-        username = _extract_username_from_tme(b["href"]) if b["href"] else ""
-        if username in official_set:
-            official_blocks.append(b["html"])
-        else:
-            other_blocks.append(b["html"])
-
-    
-
     # Собираем контент без навигации
-    body_parts: List[str] = [prefix]
+    body_parts: List[str] = []
     if config.ENABLE_SECTION_SPLIT:
+        # Разделение на группы
+        official_blocks = []
+        other_blocks = []
+        for b in blocks:
+            username = _extract_username_from_tme(b["href"]) if b["href"] else ""
+            if username in official_set:
+                official_blocks.append(b["html"])
+            else:
+                other_blocks.append(b["html"])
         if official_blocks:
             body_parts.append(f"<h3>{config.OFFICIAL_SECTION_TITLE}</h3>")
             body_parts.extend(official_blocks)
@@ -172,25 +174,16 @@ def add_navigation_and_split(html: str, official_channels: List[str]) -> str:
     else:
         body_parts.extend([b["html"] for b in blocks])
 
-    body_html = "".join(body_parts)
-
     # Вставляем навигацию
     if toc_html:
-        # Если разделение на секции включено, ищем <h3> для вставки навигации.
-        # Иначе, ищем первую новость (<h4>), чтобы вставить навигацию перед ней.
+        # Если разделение на секции включено, навигация идёт перед первым <h3>: он может быть
+        # в префиксе, иначе это заголовок первой секции. Без разделения — перед первой новостью,
+        # то есть сразу после префикса (в префиксе <h4> нет: с него начался бы первый блок).
+        insert_at = len(prefix)
         if config.ENABLE_SECTION_SPLIT:
-            insertion_marker = re.search(r"<h3[^>]*>", body_html, re.IGNORECASE)
-        else:
-            insertion_marker = re.search(r"<h4[^>]*>", body_html, re.IGNORECASE)
-
-        if insertion_marker:
-            insert_at = insertion_marker.start()
-            return body_html[:insert_at] + toc_html + body_html[insert_at:]
-        else:
-            # Если маркер не найден (например, нет новостей), добавляем TOC в конец.
-            return body_html + toc_html
-
-    return body_html
-
-
+            # Тег, начатый в конце префикса, может закрываться уже в заголовке секции
+            insertion_marker = _H3_OPEN.search(prefix + body_parts[0][:4])
+            insert_at = min(insert_at, insertion_marker.start())
+        return "".join([prefix[:insert_at], toc_html, prefix[insert_at:], *body_parts])
 
+    return prefix + "".join(body_parts)
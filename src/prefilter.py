@@ -0,0 +1,215 @@
+import json
+import math
+import os
+import random
+import re
+import zlib
+from collections import Counter
+from . import config, database
+from .tokens import estimate_tokens
+
+# Локальный предфильтр перед пачками для SUMMARY_PROMPT: явный шум (реклама, розыгрыши,
+# посты из одной картинки) отсеивается здесь, а не оплачивается запросом к модели.
+# Оценка поста — сумма вкладов правил, выученных шаблонов канала и (если обучен)
+# линейного классификатора; пост с оценкой ниже PREFILTER_THRESHOLD пропускается.
+
+_BASE_SCORE = 1.0
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+_LINK = re.compile(r"https?://\S+|(?<![/\w])t\.me/\S+|@\w{4,}", re.IGNORECASE)
+# Только служебные пометки рекламы: слово «реклама» само по себе встречается и в новостях о ней
+_AD_MARKER = re.compile(r"#реклама|\berid\b|на правах рекламы", re.IGNORECASE)
+# Розыгрыш считается, только если участие — подписка или репост
+_GIVEAWAY = re.compile(r"розыгрыш|разыгрыва|giveaway", re.IGNORECASE)
+_GIVEAWAY_TERMS = re.compile(r"подпи[сш]\w* на|подпишись|подписаться|репост", re.IGNORECASE)
+_PROMO = re.compile(r"промокод|скидк\w*\s*(?:до\s*)?\d+\s*%|купить со скидкой|ссылк[аеу] в (?:био|профиле)", re.IGNORECASE)
+
+# Вклад правил в оценку: (причина, вес). Каждый вес по модулю меньше _BASE_SCORE, поэтому
+# одно сработавшее правило (как и шаблон канала ниже) не опускает пост ниже порога
+# по умолчанию: для отсева нужны хотя бы два сигнала или уверенный классификатор
+_RULES = {
+    "ad_marker": -0.9,
+    "giveaway": -0.9,
+    "promo": -0.6,
+    "no_text": -0.9,
+    "too_short": -0.6,
+    "link_heavy": -0.4,
+}
+_CHANNEL_PATTERN_WEIGHT = -0.9
+
+# Выученные шаблоны канала: строки, которые повторяются в отсеянных постах канала
+# и почти не встречаются в остальных
+_PATTERN_SAMPLE = 50
+_PATTERN_MIN_POSTS = 2
+_PATTERN_MAX_KEPT_SHARE = 0.1
+_PATTERN_MIN_LENGTH = 20
+
+# Классификатор: логистическая регрессия по хэшированным словам
+_FEATURE_DIM = 1 << 18
+
+
+def _lines(text: str) -> set:
+    """Строки поста без лишних пробелов; короткие строки («Подробнее», «Источник») не считаются шаблоном."""
+    lines = (" ".join(line.split()) for line in (text or "").splitlines())
+    return {line for line in lines if len(line) >= _PATTERN_MIN_LENGTH}
+
+
+def _rule_hits(text: str) -> list:
+    words = _WORD.findall(text or "")
+    hits = []
+    if _AD_MARKER.search(text or ""):
+        hits.append("ad_marker")
+    if _GIVEAWAY.search(text or "") and _GIVEAWAY_TERMS.search(text or ""):
+        hits.append("giveaway")
+    if _PROMO.search(text or ""):
+        hits.append("promo")
+    if not words:
+        # Пост из одной картинки, стикера или эмодзи — модели нечего из него взять
+        hits.append("no_text")
+    if len(words) < config.PREFILTER_MIN_WORDS:
+        hits.append("too_short")
+    links = len(_LINK.findall(text or ""))
+    if links >= 3 and len(words) < links * 10:
+        hits.append("link_heavy")
+    return hits
+
+
+def _features(text: str, has_media: bool) -> dict:
+    """Разреженный вектор признаков: хэши слов (нормированные на длину) и флаги поста."""
+    words = [word.lower() for word in _WORD.findall(text or "")]
+    features = Counter(zlib.crc32(word.encode("utf-8")) % _FEATURE_DIM for word in words)
+    norm = 1 / math.sqrt(len(words)) if words else 1.0
+    vector = {index: count * norm for index, count in features.items()}
+    vector[_FEATURE_DIM] = 1.0 if has_media else 0.0
+    vector[_FEATURE_DIM + 1] = math.log1p(len(words)) / 5
+    return vector
+
+
+def _logit(model: dict, vector: dict) -> float:
+    weights = model["weights"]
+    return model["bias"] + sum(weights.get(index, 0.0) * value for index, value in vector.items())
+
+
+def train_classifier(examples: list, epochs: int = 5, learning_rate: float = 0.1, l2: float = 1e-5) -> dict:
+    """Обучает линейный классификатор (логистическая регрессия, SGD) на примерах (text, has_media, kept).
+
+    prior — логарифм шансов «оставить» по всей выборке: при оценке вклад классификатора
+    считается относительно него, поэтому обычный пост получает около нуля, а в минус
+    уходят только посты, похожие на то, что модель стабильно выбрасывает.
+    """
+    data = [(_features(text, has_media), 1.0 if kept else 0.0) for text, has_media, kept in examples]
+    kept_share = sum(label for _, label in data) / len(data)
+    kept_share = min(max(kept_share, 0.01), 0.99)
+    prior = math.log(kept_share / (1 - kept_share))
+    model = {"bias": prior, "prior": prior, "weights": {}}
+    weights = model["weights"]
+    rng = random.Random(42)
+    for _ in range(epochs):
+        rng.shuffle(data)
+        for vector, label in data:
+            z = max(-30.0, min(30.0, _logit(model, vector)))
+            gradient = 1 / (1 + math.exp(-z)) - label
+            model["bias"] -= learning_rate * gradient
+            for index, value in vector.items():
+                weight = weights.get(index, 0.0)
+                weights[index] = weight - learning_rate * (gradient * value + l2 * weight)
+    return model
+
+
+def classifier_accuracy(model: dict, examples: list) -> float:
+    """Доля примеров (text, has_media, kept), на которых классификатор угадывает решение модели."""
+    if not examples:
+        return 0.0
+    hits = sum((_logit(model, _features(text, has_media)) > 0) == bool(kept) for text, has_media, kept in examples)
+    return hits / len(examples)
+
+
+def save_classifier(model: dict, path: str = None):
+    path = path or config.PREFILTER_MODEL_PATH
+    # Нулевые веса не храним: файл остаётся маленьким
+    weights = {str(index): round(weight, 6) for index, weight in model["weights"].items() if abs(weight) > 1e-6}
+    with open(path, "w", encoding="utf-8") as model_file:
+        json.dump({"bias": model["bias"], "prior": model["prior"], "weights": weights}, model_file)
+
+
+def load_classifier(path: str = None):
+    """Загружает классификатор из PREFILTER_MODEL_PATH; None, если он ещё не обучен."""
+    path = path or config.PREFILTER_MODEL_PATH
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as model_file:
+        model = json.load(model_file)
+    model["weights"] = {int(index): weight for index, weight in model["weights"].items()}
+    return model
+
+
+class Prefilter:
+    """Оценка постов перед упаковкой в пачки (посты приходят уже после compaction.Compactor).
+    Отсеянные посты копятся и записываются в базу (skip_reason, is_processed = 1) через flush();
+    счётчики копятся за весь запуск.
+    """
+
+    _FLUSH_EVERY = 500
+
+    def __init__(self):
+        self.seen = 0
+        self.dropped = 0
+        self.tokens_dropped = 0
+        self.reasons = Counter()
+        self._patterns = {}
+        self._skipped = []
+        self._model = load_classifier() if config.PREFILTER_ENABLED else None
+
+    def _channel_patterns(self, channel: str) -> set:
+        if not channel:
+            return set()
+        if channel not in self._patterns:
+            skipped = database.get_recent_channel_texts(channel, _PATTERN_SAMPLE, skipped=True)
+            kept = database.get_recent_channel_texts(channel, _PATTERN_SAMPLE, skipped=False)
+            counts = Counter(line for text in skipped for line in _lines(text))
+            kept_counts = Counter(line for text in kept for line in _lines(text))
+            self._patterns[channel] = {
+                line for line, count in counts.items()
+                if count >= _PATTERN_MIN_POSTS and kept_counts[line] <= _PATTERN_MAX_KEPT_SHARE * len(kept)
+            }
+        return self._patterns[channel]
+
+    def score(self, post) -> tuple[float, str]:
+        """Оценка поста (кортеж полей _POST_FIELDS) и главная причина снижения оценки (или None)."""
+        text, has_media = post[1], bool(post[3])
+        channel = post[4] if len(post) > 4 else None
+        contributions = [(reason, _RULES[reason]) for reason in _rule_hits(text)]
+        patterns = self._channel_patterns(channel)
+        if patterns and any(line in patterns for line in _lines(text)):
+            contributions.append(("channel_pattern", _CHANNEL_PATTERN_WEIGHT))
+        if self._model is not None:
+            contributions.append(("classifier", _logit(self._model, _features(text, has_media)) - self._model["prior"]))
+        score = _BASE_SCORE + sum(weight for _, weight in contributions)
+        negative = [item for item in contributions if item[1] < 0]
+        return score, min(negative, key=lambda item: item[1])[0] if negative else None
+
+    def keep(self, post) -> bool:
+        """True — пост идёт в пачку; False — отсеян (будет отмечен в базе при flush())."""
+        if not config.PREFILTER_ENABLED:
+            return True
+        self.seen += 1
+        score, reason = self.score(post)
+        if score >= config.PREFILTER_THRESHOLD:
+            return True
+        self.dropped += 1
+        self.tokens_dropped += estimate_tokens(post[1])
+        self.reasons[reason] += 1
+        self._skipped.append((post[0], reason))
+        if len(self._skipped) >= self._FLUSH_EVERY:
+            self.flush()
+        return False
+
+    def flush(self):
+        """Записывает отсеянные посты в базу."""
+        if self._skipped:
+            database.mark_posts_skipped(self._skipped)
+            self._skipped = []
+
+    @property
+    def drop_rate(self) -> float:
+        return self.dropped / self.seen if self.seen else 0.0
@@ -0,0 +1,95 @@
+import math
+from collections import defaultdict
+from . import config, tokens
+
+# Ранжирование необработанных постов по вовлечённости перед пачками для OpenAI.
+# Просмотры у каналов различаются на порядки, поэтому пост сравнивается только с постами
+# своего канала (перцентиль внутри канала), а новость, которую перепечатали другие каналы
+# (копии схлопнуты дедупликацией), получает надбавку.
+
+# Веса метрик: репост и реакция говорят о значимости больше, чем просмотр
+_FORWARD_WEIGHT = 3.0
+_REACTION_WEIGHT = 2.0
+# Надбавка за каждую e-кратную прибавку копий в других каналах
+_COPY_WEIGHT = 0.25
+# Перцентиль поста без метрик (старые посты, личные чаты) и единственного поста канала
+_NEUTRAL = 0.5
+
+
+def enabled() -> bool:
+    """Ранжирование включено и задано хотя бы одно ограничение."""
+    return config.RANKING_ENABLED and bool(config.RANKING_TOP_K or config.RANKING_TOP_PERCENT or config.RANKING_TOKEN_BUDGET)
+
+
+def engagement(views, forwards, reactions):
+    """Вовлечённость поста в логарифмической шкале или None, если метрик нет."""
+    if views is None and forwards is None and reactions is None:
+        return None
+    return (
+        math.log1p(views or 0)
+        + _FORWARD_WEIGHT * math.log1p(forwards or 0)
+        + _REACTION_WEIGHT * math.log1p(reactions or 0)
+    )
+
+
+def _channel_percentiles(values: list) -> list:
+    """Перцентили значений внутри канала (0 — худший пост, 1 — лучший; равные получают средний)."""
+    if len(values) < 2:
+        return [_NEUTRAL] * len(values)
+    order = sorted(range(len(values)), key=lambda i: values[i])
+    percentiles = [0.0] * len(values)
+    start = 0
+    while start < len(order):
+        end = start
+        while end + 1 < len(order) and values[order[end + 1]] == values[order[start]]:
+            end += 1
+        for position in range(start, end + 1):
+            percentiles[order[position]] = (start + end) / 2 / (len(values) - 1)
+        start = end + 1
+    return percentiles
+
+
+def rank(candidates: list) -> list:
+    """Сортирует кандидатов [(id, channel, views, forwards, reactions, copies, text_length), ...]
+    от самых значимых к наименее значимым. Возвращает [(id, score, tokens), ...].
+    """
+    by_channel = defaultdict(list)
+    for candidate in candidates:
+        by_channel[candidate[1]].append(candidate)
+
+    ranked = []
+    for posts in by_channel.values():
+        known = [(post, engagement(*post[2:5])) for post in posts]
+        measured = [(post, value) for post, value in known if value is not None]
+        percentiles = dict(zip((post[0] for post, _ in measured), _channel_percentiles([value for _, value in measured])))
+        for post_id, _, _, _, _, copies, text_length in posts:
+            score = percentiles.get(post_id, _NEUTRAL) + _COPY_WEIGHT * math.log1p(copies or 0)
+            ranked.append((post_id, score, tokens.estimate_tokens_for_length(text_length or 0)))
+    # При равной оценке выше более новый пост (id растут со временем)
+    ranked.sort(key=lambda item: (-item[1], -item[0]))
+    return ranked
+
+
+def select(ranked: list, already: int = 0) -> tuple[list, list]:
+    """Делит ранжированные посты на отобранные для OpenAI и отсеянные.
+
+    already — сколько постов этого запуска уже отправлено в OpenAI (готовые пачки):
+    они засчитываются в RANKING_TOP_K и RANKING_TOP_PERCENT.
+    """
+    total = len(ranked) + already
+    limits = []
+    if config.RANKING_TOP_K:
+        limits.append(config.RANKING_TOP_K)
+    if config.RANKING_TOP_PERCENT:
+        limits.append(math.ceil(total * config.RANKING_TOP_PERCENT / 100))
+    limit = max(0, min(limits) - already) if limits else len(ranked)
+
+    selected, dropped, used_tokens = [], [], 0
+    for post_id, _, post_tokens in ranked:
+        over_budget = config.RANKING_TOKEN_BUDGET and used_tokens + post_tokens > config.RANKING_TOKEN_BUDGET
+        if len(selected) >= limit or over_budget:
+            dropped.append(post_id)
+            continue
+        selected.append(post_id)
+        used_tokens += post_tokens
+    return selected, dropped
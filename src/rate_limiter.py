@@ -0,0 +1,140 @@
+import asyncio
+import time
+from . import config
+
+# Имена внешних сервисов, у каждого свой лимитер
+TELEGRAM = "telegram"    # MTProto (Telethon)
+BOT_API = "bot_api"      # Telegram Bot API
+OPENAI = "openai"
+TELEGRAPH = "telegraph"
+
+# Во сколько раз снижаем скорость при сигнале перегрузки и её нижняя граница
+_SLOWDOWN_FACTOR = 0.5
+_MIN_RATE_FRACTION = 1 / 16
+# Какую долю номинальной скорости возвращаем после каждого успешного запроса
+_RECOVERY_FRACTION = 0.1
+
+
+class RateLimiter:
+    """Адаптивный token bucket для одного внешнего сервиса.
+
+    Пока запросов мало, acquire() не ждёт вовсе; при всплеске пропускает не
+    больше burst запросов подряд, дальше — с номинальной скоростью. Реальные
+    сигналы сервиса (FloodWait, HTTP 429 / Retry-After) передаются в backoff():
+    все ожидающие запросы ждут указанное время, а скорость временно снижается
+    и затем постепенно восстанавливается через success().
+    """
+
+    def __init__(self, name: str, requests_per_minute: int, burst: int):
+        self.name = name
+        self.max_rate = requests_per_minute / 60.0
+        self.rate = self.max_rate
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Ждёт, пока сервис можно вызвать. Очередь ожидающих обслуживается по порядку."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def slow_down(self):
+        """Снижает скорость после сигнала перегрузки без полной блокировки."""
+        self.rate = max(self.max_rate * _MIN_RATE_FRACTION, self.rate * _SLOWDOWN_FACTOR)
+
+    def backoff(self, seconds: float):
+        """Блокирует сервис на seconds секунд (FloodWait, Retry-After) и снижает скорость."""
+        now = time.monotonic()
+        self._refill(now)
+        self.blocked_until = max(self.blocked_until, now + max(0.0, seconds))
+        self.tokens = 0.0
+        self.slow_down()
+        print(f"[rate-limit] {self.name}: пауза {seconds:.1f} с, скорость {self.rate * 60:.0f} запр/мин")
+
+    def success(self):
+        """Отмечает успешный запрос: скорость постепенно возвращается к номинальной."""
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * _RECOVERY_FRACTION)
+
+
+_limiters = {}
+
+
+def get(name: str) -> RateLimiter:
+    """Возвращает общий для процесса лимитер сервиса, создавая его по настройкам из config."""
+    limiter = _limiters.get(name)
+    if limiter is None:
+        rpm = {
+            TELEGRAM: config.RATE_LIMIT_TELEGRAM_RPM,
+            BOT_API: config.RATE_LIMIT_BOT_API_RPM,
+            OPENAI: config.RATE_LIMIT_OPENAI_RPM,
+            TELEGRAPH: config.RATE_LIMIT_TELEGRAPH_RPM,
+        }[name]
+        limiter = RateLimiter(name, rpm, config.RATE_LIMIT_BURST)
+        _limiters[name] = limiter
+    return limiter
+
+
+def retry_after_seconds(headers, default: float = 1.0) -> float:
+    """Достаёт паузу из заголовков HTTP-ответа (Retry-After, retry-after-ms, x-ratelimit-reset-*)."""
+    if not headers:
+        return default
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    # Формат OpenAI: "6m0s", "1s", "250ms"
+    for header in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+        value = headers.get(header)
+        if value:
+            seconds = _parse_duration(value)
+            if seconds is not None:
+                return seconds
+    return default
+
+
+def _parse_duration(value: str):
+    """Разбирает длительность вида '1m30s', '250ms', '2s' в секунды."""
+    total, number = 0.0, ""
+    i = 0
+    try:
+        while i < len(value):
+            ch = value[i]
+            if ch.isdigit() or ch == ".":
+                number += ch
+            elif value.startswith("ms", i):
+                total += float(number) / 1000
+                number = ""
+                i += 1
+            elif ch in "hms":
+                total += float(number) * {"h": 3600, "m": 60, "s": 1}[ch]
+                number = ""
+            else:
+                return None
+            i += 1
+    except ValueError:
+        return None
+    return total if not number else None
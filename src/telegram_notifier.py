@@ -1,12 +1,19 @@
 import telegram
-import random
+from telegram.error import RetryAfter
 import asyncio
 import re
-from . import config
+import time
+from . import config, metrics, rate_limiter
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    """Пауза из RetryAfter: в новых версиях python-telegram-bot это timedelta, в старых — число."""
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
 
 async def _send_to_all_recipients(message_text: str, parse_mode: str = 'Markdown'):
     """Внутренняя функция для отправки сообщения всем получателям из конфига."""
     bot = telegram.Bot(token=config.BOT_TOKEN)
+    limiter = rate_limiter.get(rate_limiter.BOT_API)
     
     if not config.TELEGRAM_RECIPIENTS:
         print("Список получателей (TELEGRAM_RECIPIENTS) пуст. Уведомление не отправлено.")
@@ -20,17 +27,30 @@ async def _send_to_all_recipients(message_text: str, parse_mode: str = 'Markdown
             print(f"Пропуск получателя из-за отсутствия chat_id: {recipient}")
             continue
 
-        try:
-            await bot.send_message(
-                chat_id=chat_id,
-                message_thread_id=message_thread_id,
-                text=message_text,
-                parse_mode=parse_mode
-            )
-            print(f"Уведомление успешно отправлено в чат {chat_id}" + (f" (топик {message_thread_id})" if message_thread_id else ""))
-            await asyncio.sleep(random.uniform(1, 3)) # Задержка между отправками
-        except Exception as e:
-            print(f"Ошибка при отправке уведомления в чат {chat_id}: {e}")
+        for attempt in range(2):
+            try:
+                await limiter.acquire()
+                started = time.perf_counter()
+                await bot.send_message(
+                    chat_id=chat_id,
+                    message_thread_id=message_thread_id,
+                    text=message_text,
+                    parse_mode=parse_mode
+                )
+                limiter.success()
+                metrics.call("bot_api_request_seconds", time.perf_counter() - started, {"method": "sendMessage", "outcome": "ok"}, chat_id=chat_id)
+                print(f"Уведомление успешно отправлено в чат {chat_id}" + (f" (топик {message_thread_id})" if message_thread_id else ""))
+                break
+            except RetryAfter as e:
+                metrics.call("bot_api_request_seconds", time.perf_counter() - started, {"method": "sendMessage", "outcome": "retry_after"}, chat_id=chat_id)
+                # Bot API сообщил, сколько ждать: ждём и пробуем ещё раз
+                limiter.backoff(_retry_after_seconds(e))
+                if attempt:
+                    print(f"Ошибка при отправке уведомления в чат {chat_id}: {e}")
+            except Exception as e:
+                metrics.call("bot_api_request_seconds", time.perf_counter() - started, {"method": "sendMessage", "outcome": "error"}, chat_id=chat_id)
+                print(f"Ошибка при отправке уведомления в чат {chat_id}: {e}")
+                break
 
 
 async def send_notification(summary: str, article_url: str):
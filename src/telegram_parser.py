@@ -1,41 +1,193 @@
 import asyncio
-import random
 from telethon.sync import TelegramClient
-from telethon.tl.types import Channel
-from . import config, database
+from telethon.errors import FloodWaitError
+from telethon.tl.types import Channel, InputPeerChannel
+from . import config, database, metrics, rate_limiter
 
-async def parse_channels():
-    """Парсит заданные каналы и сохраняет новые посты в базу данных."""
-    # Используем имя сессии, чтобы Telethon сохранил авторизацию в файл
-    async with TelegramClient(config.SESSION_NAME, config.API_ID, config.API_HASH) as client:
-        print("Парсер запущен...")
-        for channel_name in config.TELEGRAM_CHANNELS:
-            if not channel_name:
-                continue
+# Сколько постов копим в памяти перед записью в базу одной транзакцией
+ADD_POSTS_FLUSH_SIZE = 200
+# Сколько сообщений Telethon получает одним запросом GetHistory
+_HISTORY_PAGE_SIZE = 100
+# Сколько сообщений по id запрашивается одним GetMessages при обновлении вовлечённости
+_REFRESH_PAGE_SIZE = 100
+
+def _engagement(message):
+    """(views, forwards, reactions) сообщения; None там, где Telegram метрику не отдаёт."""
+    reactions = getattr(message, "reactions", None)
+    reaction_count = sum(result.count for result in reactions.results) if reactions and reactions.results else None
+    return getattr(message, "views", None), getattr(message, "forwards", None), reaction_count
+
+async def _resolve_channel(client: TelegramClient, channel_name: str):
+    """Возвращает (peer, username, title) канала или None, если это не канал.
+
+    Сначала смотрим в кэш базы данных и строим InputPeerChannel без обращения
+    к Telegram; get_entity вызываем только при промахе или устаревшей записи.
+    """
+    ttl = config.TELEGRAM_ENTITY_CACHE_TTL_HOURS * 3600
+    cached = database.get_channel_entity(channel_name, ttl) if ttl else None
+    if cached:
+        peer_id, access_hash, username, title = cached
+        return InputPeerChannel(channel_id=peer_id, access_hash=access_hash), username, title
+
+    await rate_limiter.get(rate_limiter.TELEGRAM).acquire()
+    entity = await client.get_entity(channel_name)
+    if not isinstance(entity, Channel):
+        return None
+    database.save_channel_entity(channel_name, entity.id, entity.access_hash, entity.username, entity.title)
+    return entity, entity.username, entity.title
+
+async def _parse_channel(client: TelegramClient, channel_name: str):
+    """Парсит один канал и сохраняет его посты в базу данных.
+
+    Если канал уже парсился, забираем только посты новее сохранённой отметки
+    (min_id), листая историю назад до предыдущего запуска. Иначе — последние
+    TELEGRAM_PARSE_LIMIT постов.
+    """
+    resolved = await _resolve_channel(client, channel_name)
+    if resolved is None:
+        return
+    peer, username, title = resolved
+
+    state = database.get_channel_state(channel_name)
+    if state:
+        last_message_id = state[0]
+        limit = config.TELEGRAM_INCREMENTAL_MAX or None
+        print(f"Парсинг канала: {title} (новые посты после #{last_message_id})")
+        messages = client.iter_messages(peer, min_id=last_message_id, limit=limit)
+    else:
+        last_message_id = 0
+        limit = config.TELEGRAM_PARSE_LIMIT
+        print(f"Парсинг канала: {title} (лимит: {config.TELEGRAM_PARSE_LIMIT} постов)")
+        messages = client.iter_messages(peer, limit=limit)
+
+    limiter = rate_limiter.get(rate_limiter.TELEGRAM)
+    await limiter.acquire()
+    newest_id, newest_date, fetched = last_message_id, 0, 0
+    buffer, inserted = [], 0
+    async for message in messages:
+        fetched += 1
+        # Каждая страница истории — отдельный запрос к Telegram
+        if fetched % _HISTORY_PAGE_SIZE == 0:
+            await limiter.acquire()
+        # Отметку двигаем по любому сообщению, даже если сам пост не сохраняем
+        if message.id > newest_id:
+            newest_id, newest_date = message.id, int(message.date.timestamp())
+        # Формируем прямую ссылку на пост
+        source_link = f"https://t.me/{username}/{message.id}"
+        # Проверяем наличие медиа (фото, видео, документ)
+        has_media = bool(message.photo or message.video or message.document)
+
+        # Сохраняем пост, даже если нет текста, но есть медиа
+        if message.text or has_media:
+            buffer.append((
+                channel_name,
+                message.id,
+                message.text if message.text else "", # Сохраняем пустую строку, если текста нет
+                int(message.date.timestamp()),
+                source_link,
+                has_media,
+                *_engagement(message)
+            ))
+            # Пишем в базу пачками: одна транзакция на ADD_POSTS_FLUSH_SIZE постов
+            if len(buffer) >= ADD_POSTS_FLUSH_SIZE:
+                inserted += database.add_posts(buffer)
+                buffer = []
+
+    inserted += database.add_posts(buffer)
+    print(f"Канал {channel_name}: получено {fetched} сообщений, новых постов сохранено: {inserted}")
+    metrics.inc("telegram_messages_total", fetched)
+    metrics.inc("telegram_posts_saved_total", inserted)
+
+    if state and limit and fetched >= limit:
+        print(f"Внимание: в канале {channel_name} больше {limit} новых постов, более старые из них пропущены.")
+
+    # Отметку сохраняем только после того, как все посты канала записаны
+    if newest_id > last_message_id:
+        database.update_channel_state(channel_name, newest_id, newest_date)
+
+async def _parse_channel_guarded(client: TelegramClient, channel_name: str, semaphore: asyncio.Semaphore, on_channel_parsed=None):
+    """Парсит канал в пределах лимита параллельности, соблюдая FloodWait для этого канала.
+
+    После успешного парсинга вызывает on_channel_parsed(channel_name), если он задан.
+    """
+    limiter = rate_limiter.get(rate_limiter.TELEGRAM)
+    async with semaphore:
+        attempt = 0
+        while True:
             try:
-                entity = await client.get_entity(channel_name)
-                if isinstance(entity, Channel):
-                    print(f"Парсинг канала: {entity.title} (лимит: {config.TELEGRAM_PARSE_LIMIT} постов)")
-                    async for message in client.iter_messages(entity, limit=config.TELEGRAM_PARSE_LIMIT):
-                        # Формируем прямую ссылку на пост
-                        source_link = f"https://t.me/{entity.username}/{message.id}"
-                        # Проверяем наличие медиа (фото, видео, документ)
-                        has_media = bool(message.photo or message.video or message.document)
-
-                        # Сохраняем пост, даже если нет текста, но есть медиа
-                        if message.text or has_media:
-                            database.add_post(
-                                channel=channel_name,
-                                message_id=message.id,
-                                text=message.text if message.text else "", # Сохраняем пустую строку, если текста нет
-                                date=int(message.date.timestamp()),
-                                source_link=source_link,
-                                has_media=has_media
-                            )
-                    # Задержка после обработки каждого канала
-                    await asyncio.sleep(random.uniform(1, 3))
+                await _parse_channel(client, channel_name)
+                limiter.success()
+                if on_channel_parsed is not None:
+                    await on_channel_parsed(channel_name)
+                break
+            except FloodWaitError as e:
+                # Ждём ровно столько, сколько попросил Telegram; остальные каналы продолжают
+                # работу, но общий темп запросов к Telegram снижается
+                limiter.slow_down()
+                attempt += 1
+                if attempt > config.TELEGRAM_FLOOD_RETRIES:
+                    print(f"FloodWait для канала {channel_name}: попытки исчерпаны, канал пропущен.")
+                    return
+                print(f"FloodWait для канала {channel_name}: ждём {e.seconds} с (попытка {attempt}).")
+                metrics.inc("telegram_flood_waits_total", stage="parse")
+                metrics.inc("telegram_flood_wait_seconds_total", e.seconds)
+                await asyncio.sleep(e.seconds)
             except Exception as e:
                 print(f"Ошибка при парсинге канала {channel_name}: {e}")
+                # Запись в кэше могла устареть (смена username, access_hash) — разрешим канал заново
+                database.invalidate_channel_entity(channel_name)
+                return
+
+async def _refresh_channel(client: TelegramClient, channel_name: str, since: int, semaphore: asyncio.Semaphore):
+    """Обновляет просмотры, репосты и реакции необработанных постов канала (не старше since).
+
+    При парсинге свежий пост ещё не набрал просмотров, поэтому перед ранжированием
+    метрики запрашиваются заново — по 100 сообщений за запрос.
+    """
+    message_ids = database.get_unprocessed_message_ids(channel_name, since)
+    if not message_ids:
+        return
+    limiter = rate_limiter.get(rate_limiter.TELEGRAM)
+    async with semaphore:
+        try:
+            resolved = await _resolve_channel(client, channel_name)
+            if resolved is None:
+                return
+            peer = resolved[0]
+            for start in range(0, len(message_ids), _REFRESH_PAGE_SIZE):
+                await limiter.acquire()
+                messages = await client.get_messages(peer, ids=message_ids[start:start + _REFRESH_PAGE_SIZE])
+                metrics.inc("telegram_refreshed_messages_total", len(messages))
+                database.update_engagement([
+                    (channel_name, message.id, *_engagement(message)) for message in messages if message is not None
+                ])
+            limiter.success()
+        except FloodWaitError as e:
+            # Ранжирование обойдётся метриками, сохранёнными при парсинге
+            limiter.slow_down()
+            metrics.inc("telegram_flood_waits_total", stage="refresh")
+            print(f"FloodWait при обновлении метрик канала {channel_name} ({e.seconds} с), метрики не обновлены.")
+        except Exception as e:
+            print(f"Ошибка при обновлении метрик канала {channel_name}: {e}")
+
+async def parse_channels(on_channel_parsed=None, refresh_since: int = None):
+    """Парсит заданные каналы и сохраняет новые посты в базу данных.
+
+    Каналы обрабатываются параллельно через один клиент Telethon,
+    не более TELEGRAM_PARSE_CONCURRENCY одновременно. Необязательный
+    асинхронный колбэк on_channel_parsed получает имя каждого канала,
+    посты которого уже записаны в базу. Если задан refresh_since, после
+    парсинга в той же сессии обновляется вовлечённость необработанных постов.
+    """
+    # Используем имя сессии, чтобы Telethon сохранил авторизацию в файл
+    async with TelegramClient(config.SESSION_NAME, config.API_ID, config.API_HASH) as client:
+        print(f"Парсер запущен (параллельно каналов: {config.TELEGRAM_PARSE_CONCURRENCY})...")
+        semaphore = asyncio.Semaphore(config.TELEGRAM_PARSE_CONCURRENCY)
+        channels = [name for name in config.TELEGRAM_CHANNELS if name]
+        await asyncio.gather(*(_parse_channel_guarded(client, name, semaphore, on_channel_parsed) for name in channels))
+        if refresh_since is not None:
+            print("Обновление просмотров и реакций необработанных постов...")
+            await asyncio.gather(*(_refresh_channel(client, name, refresh_since, semaphore) for name in channels))
         print("Парсинг завершен.")
 
 if __name__ == '__main__':
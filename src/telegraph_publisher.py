@@ -1,32 +1,49 @@
-import random
-import asyncio
+import re
+import time
 from telegraph import Telegraph
-from . import config
+from . import config, metrics, rate_limiter
+
+def _flood_wait_seconds(error: Exception):
+    """Возвращает паузу из ошибки Telegraph вида FLOOD_WAIT_N или None."""
+    m = re.search(r"FLOOD_WAIT_(\d+)", str(error))
+    return int(m.group(1)) if m else None
 
 async def publish_to_telegraph(title: str, html_content: str) -> str:
     """Публикует статью в Telegra.ph и возвращает ссылку.
 
     Использует access_token из конфига, если он задан. Иначе создаёт аккаунт один раз.
     """
+    limiter = rate_limiter.get(rate_limiter.TELEGRAPH)
     # Инициализируем клиент с токеном, если он задан, иначе создаём аккаунт и переинициализируем
     if config.TELEGRAPH_ACCESS_TOKEN:
         telegraph = Telegraph(access_token=config.TELEGRAPH_ACCESS_TOKEN)
     else:
         telegraph = Telegraph()
+        await limiter.acquire()
         account = telegraph.create_account(short_name=config.TELEGRAPH_AUTHOR_NAME or 'AI Digest')
         token = account.get('access_token')
         # Рекомендуется сохранить token в .env вручную после первого получения
         telegraph = Telegraph(access_token=token)
-    try:
-        response = telegraph.create_page(
-            title=title,
-            html_content=html_content,
-            author_name=config.TELEGRAPH_AUTHOR_NAME or 'AI Digest',
-            author_url=config.TELEGRAPH_AUTHOR_URL or None
-        )
-        # Задержка после публикации
-        await asyncio.sleep(random.uniform(1, 3))
-        return response['url']
-    except Exception as e:
-        print(f"Ошибка при публикации в Telegra.ph: {e}")
-        return ""
+    for attempt in range(2):
+        try:
+            await limiter.acquire()
+            started = time.perf_counter()
+            response = telegraph.create_page(
+                title=title,
+                html_content=html_content,
+                author_name=config.TELEGRAPH_AUTHOR_NAME or 'AI Digest',
+                author_url=config.TELEGRAPH_AUTHOR_URL or None
+            )
+            limiter.success()
+            metrics.call("telegraph_request_seconds", time.perf_counter() - started, {"method": "createPage", "outcome": "ok"})
+            return response['url']
+        except Exception as e:
+            metrics.call("telegraph_request_seconds", time.perf_counter() - started, {"method": "createPage", "outcome": "error"})
+            wait = _flood_wait_seconds(e)
+            if wait is not None and not attempt:
+                # Telegraph попросил подождать — ждём и пробуем ещё раз
+                limiter.backoff(wait)
+                continue
+            print(f"Ошибка при публикации в Telegra.ph: {e}")
+            return ""
+    return ""